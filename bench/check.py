@@ -0,0 +1,440 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import zlib
+
+import numpy
+
+from minebash import cache
+from minebash import convert
+from minebash import diff
+from minebash import entities
+from minebash import export
+from minebash import nbt
+from minebash import orthomap
+from minebash import snapshot
+from minebash import trim
+from minebash import watch
+from minebash import world
+
+import generate
+
+
+class Checker:
+    """Checks, on generated worlds, that the parts of the package which write worlds, cache maps or work
+    in parallel give the same results as reading the world directly. Each check_* method is one check,
+    which raises an AssertionError if the results differ. Worlds are generated on first use, and any
+    check that modifies a world works on its own copy."""
+    def __init__(self, path, colours=None, biomes=None, regions=(2, 1), chunks=4, seed=0):
+        self.path = path
+        self.colours = colours
+        self.biomes = biomes
+        self.regions = regions
+        self.chunks = chunks
+        self.seed = seed
+        self.failures = {}
+
+
+    def get_checks(self):
+        """Returns the names of all the checks, in alphabetical order."""
+        return sorted(name[len('check_'):] for name in dir(self) if name.startswith('check_'))
+
+
+    def run(self, checks=None):
+        """Run the given checks (or all of them), and return a dict of the tracebacks of any that failed."""
+        self.failures = {}
+        for name in checks or self.get_checks():
+            print 'checking', name
+            try:
+                getattr(self, 'check_' + name)()
+            except Exception:
+                self.failures[name] = traceback.format_exc()
+                print 'FAILED', name
+        return self.failures
+
+
+    def check_roundtrip(self):
+        """Saving the chunks of each region to a new region file and reading them back gives the same data,
+        and saving over an existing region replaces and removes only the chunks given."""
+        wld = self._get_world()
+        savepath = self._get_temp_path()
+        for coords, region in sorted(wld.regions.iteritems()):
+            raw = region.read_chunks(raw=True)
+            saved = world.Region(savepath, coords, wld.anvil)
+            saved.save(raw)
+            assert world.Region(savepath, coords, wld.anvil).read_chunks(raw=True) == raw, \
+                'region {0} differs after saving'.format(coords)
+        self._assert_same_blocks(wld, world.World(savepath))
+
+        region = world.World(savepath).get_region((0, 0))
+        raw = region.read_chunks(raw=True)
+        replaced, removed = (0, 0), (1, 0)
+        raw[replaced] = raw[replaced][0] + 1, self._get_new_chunk(wld, replaced)
+        region.save({replaced: raw[replaced]}, removed=[removed])
+        del raw[removed]
+        assert world.Region(savepath, (0, 0), wld.anvil).read_chunks(raw=True) == raw, \
+            'saving over a region changed chunks it wasn\'t given'
+
+
+    def check_parallel(self):
+        """Maps drawn by several worker processes are the same as maps drawn in this process."""
+        wld = self._get_world()
+        for type in 'block', 'biome', 'heightmap':
+            serial = self._get_map(wld)._generate_map(wld, type)
+            parallel = self._get_map(wld).set_workers(2)._generate_map(wld, type)
+            self._assert_same_image(serial, parallel, '{0} map drawn in parallel'.format(type))
+
+
+    def check_cache(self):
+        """Maps drawn through the region cache, after chunks have been modified and within a bounding box,
+        are the same as maps drawn without it; and the cache store stays within its size limit."""
+        wld = self._copy_world()
+        cached = self._get_map(wld).set_cache(cache.RegionCache(self._get_temp_path()))
+        cached._generate_map(wld)
+        self._modify_chunk(wld, (1, 1))
+        self._assert_same_image(cached._generate_map(wld), self._get_map(wld)._generate_map(wld),
+                                'map drawn through the cache after a chunk was modified')
+        bcrop = (8, world.CSIZE * 2 - 9, 8, world.CSIZE * 3 - 1)
+        self._assert_same_image(cached._draw_region_image(wld.get_region((0, 0)), 'block', bcrop),
+                                self._get_map(wld)._generate_region_map(wld.get_region((0, 0)), 'block', bcrop),
+                                'cropped region drawn through the cache')
+
+        store = cache.CacheStore(self._get_temp_path(), 1000)
+        for i in range(20):
+            store.put(str(i), chr(i) * (50 + 10 * i))
+            assert os.path.getsize(store.datapath) <= store.maxbytes, 'cache store has grown past its size limit'
+        assert store.get('19') == (None, chr(19) * 240), 'the latest tile was not kept in the cache store'
+
+
+    def check_slice(self):
+        """A slice covering every height draws the same map as no slice, and slices and cutaways
+        drawn in parallel are the same as those drawn in this process."""
+        wld = self._get_world()
+        height = world.SECHEIGHT * world.SECTIONS if wld.anvil else world.CHEIGHT
+        self._assert_same_image(self._get_map(wld).set_slice((0, height - 1))._generate_map(wld),
+                                self._get_map(wld)._generate_map(wld), 'map sliced at every height')
+        for ylimits, skip_ceiling in ((0, 60), False), ((0, 70), True):
+            serial = self._get_map(wld).set_slice(ylimits, skip_ceiling)._generate_map(wld)
+            parallel = self._get_map(wld).set_slice(ylimits, skip_ceiling).set_workers(2)._generate_map(wld)
+            self._assert_same_image(serial, parallel, 'map sliced at {0} drawn in parallel'.format(ylimits))
+
+
+    def check_watch(self):
+        """A watched map that has had modified and removed chunks redrawn is the same as a map drawn from scratch."""
+        wld = self._copy_world()
+        watcher = watch.Watcher(self._get_map(wld), wld, os.path.join(self._get_temp_path(), 'map.png'))
+        watcher.redraw_all()
+        # modify the world as another process would, without the watcher's world knowing
+        other = world.World(wld.path)
+        self._modify_chunk(other, (1, 1))
+        other.get_region((1, 0)).save(removed=[(2, 2)])
+        watcher.update([(0, 0), (1, 0)])
+        self._assert_same_image(watcher.image, self._get_map(wld)._generate_map(wld), 'watched map after chunks changed')
+
+
+    def check_iter_chunks(self):
+        """iter_chunks yields each chunk once, in order, within its filters, with payloads that match reading
+        the chunks directly, whatever the window."""
+        wld = self._copy_world()
+        chunks = wld.get_chunk_list()
+        raw = wld.get_chunks(raw=True)
+
+        coords = [coords for coords, chunk in wld.iter_chunks(payload='raw')]
+        assert coords == sorted(chunks, key=lambda (cx, cz): (cz / world.RSIZE, cx / world.RSIZE, cz, cx)), \
+            'chunks are not in region order'
+        for order in world.ORDERS:
+            assert sorted(coords for coords, chunk in wld.iter_chunks(order=order, payload='lazy')) == sorted(chunks), \
+                'chunks in {0} order are not each yielded once'.format(order)
+        for window in 1, 5:
+            assert dict(wld.iter_chunks(payload='raw', window=window)) == raw, \
+                'raw chunks read {0} at a time differ'.format(window)
+        for coords, ref in wld.iter_chunks(payload='lazy'):
+            assert ref.load(raw=True) == raw[coords], 'lazily loaded chunk {0} differs'.format(coords)
+
+        whitelist = set([(0, 0), (3, 2), (world.RSIZE + 1, 1), (world.RSIZE - 1, 0)])
+        assert set(coords for coords, chunk in wld.iter_chunks(whitelist, payload='lazy')) == whitelist & set(chunks), \
+            'chunks outside the whitelist were yielded'
+        rect = (2, world.RSIZE + 1, 1, 2)
+        assert set(coords for coords, chunk in wld.iter_chunks(rect=rect, payload='lazy')) == \
+            set((cx, cz) for cx, cz in chunks if rect[0] <= cx <= rect[1] and rect[2] <= cz <= rect[3]), \
+            'chunks outside the rectangle were yielded'
+        since = max(mtime for mtime, data in raw.itervalues())
+        self._modify_chunk(wld, (world.RSIZE + 2, 3))
+        assert [coords for coords, chunk in wld.iter_chunks(since=since, payload='lazy')] == [(world.RSIZE + 2, 3)], \
+            'unmodified chunks were yielded'
+
+
+    def check_diff(self):
+        """A diff finds chunks that were added, removed and modified, but not chunks that were only saved again,
+        counts the blocks that differ, and gives the same report whether it is run in parallel or not."""
+        old = self._get_world()
+        new = self._copy_world()
+        added, removed, modified, touched = (self.chunks, 0), (1, 2), (world.RSIZE + 1, 1), (2, 1)
+        region = new.get_region((0, 0))
+        mtime, data = region.read_chunks(raw=True)[touched]
+        region.save({added: (mtime, self._get_new_chunk(new, added)), touched: (mtime + 1, data)}, removed=[removed])
+        self._modify_chunk(new, modified)
+
+        serial = diff.WorldDiff(old, new).compare()
+        assert (serial.added, serial.removed, serial.changed) == (set([added]), set([removed]), set([modified])), \
+            'diff found {0} added, {1} removed and {2} changed'.format(
+                sorted(serial.added), sorted(serial.removed), sorted(serial.changed))
+        assert serial.unchanged == len(old.get_chunk_list()) - 2, 'diff counted {0} unchanged chunks'.format(serial.unchanged)
+        serial.compare_blocks()
+        assert serial.blocks[modified] > 0, 'no blocks differ in the modified chunk'
+        assert serial.report() == diff.WorldDiff(old, new).set_workers(2).compare().compare_blocks().report(), \
+            'diff report differs when run in parallel'
+
+
+    def check_snapshot(self):
+        """Restoring a snapshot after chunks have been modified and removed gives back the same region files,
+        and a later snapshot only stores the chunks that changed."""
+        wld = self._copy_world()
+        regionpath = os.path.join(wld.path, 'region')
+        original = self._read_files(regionpath)
+        store = snapshot.SnapshotStore(self._get_temp_path())
+        store.take(wld, 'a')
+
+        self._modify_chunk(wld, (world.RSIZE, 0))
+        wld.get_region((0, 0)).save(removed=[(3, 3)])
+        modified = self._read_files(regionpath)
+        end = store.index['end']
+        store.take(wld, 'b')
+        assert store.index['end'] - end == len(wld.get_chunks([(world.RSIZE, 0)], raw=True)[world.RSIZE, 0][1]), \
+            'snapshot stored more than the modified chunk'
+
+        store.restore('a', wld)
+        assert self._read_files(regionpath) == original, 'region files differ after restoring a snapshot'
+        store.restore('b', wld)
+        assert self._read_files(regionpath) == modified, 'region files differ after restoring a later snapshot'
+
+
+    def check_export(self):
+        """Exported arrays hold the same data as the chunks they were exported from, in parallel or not,
+        and exporting again after chunks have been modified and removed brings them up to date."""
+        wld = self._copy_world()
+        ylimits = (8, 119)
+        for workers in 1, 2:
+            exporter = export.ArrayExport(self._get_temp_path()).set_slice(ylimits).set_workers(workers)
+            exporter.export(wld)
+            self._assert_exported(exporter, wld, ylimits)
+        self._modify_chunk(wld, (world.RSIZE + 3, 2))
+        wld.get_region((0, 0)).save(removed=[(2, 3)])
+        exporter.export(wld)
+        self._assert_exported(exporter, wld, ylimits)
+
+
+    def check_trim(self):
+        """Trimming removes exactly the chunks that match every rule, leaves the rest as they were,
+        and changes nothing in a dry run."""
+        natural = set(coords for coords, chunk in self._get_world().get_chunks().iteritems()
+                      if numpy.in1d(chunk.get_data('block'), trim.NATURAL_BLOCKS).all())
+        assert 0 < len(natural) < len(self._get_world().get_chunk_list()), 'generated world has no chunks to tell apart'
+        rect = (1, world.RSIZE + 1, 1, 2)
+        inside = lambda (cx, cz): rect[0] <= cx <= rect[1] and rect[2] <= cz <= rect[3]
+
+        for rules, matches in (
+                (lambda trimmer: trimmer.set_rect(rect), lambda coords: not inside(coords)),
+                (lambda trimmer: trimmer.set_rect(rect, outside=False), inside),
+                (lambda trimmer: trimmer.set_natural(), lambda coords: coords in natural),
+                (lambda trimmer: trimmer.set_rect(rect).set_natural(), lambda coords: not inside(coords) and coords in natural),
+                (lambda trimmer: trimmer.set_age(1), lambda coords: False)):
+            wld = self._copy_world()
+            chunks = wld.get_chunks(raw=True)
+            files = self._read_files(os.path.join(wld.path, 'region'))
+            rules(trim.Trimmer(wld).set_workers(2)).trim(dryrun=True)
+            assert self._read_files(os.path.join(wld.path, 'region')) == files, 'a dry run changed the world'
+
+            trimmer = rules(trim.Trimmer(wld).set_workers(2)).trim()
+            expected = set(coords for coords in chunks if matches(coords))
+            trimmed = set((rx * world.RSIZE + cx, rz * world.RSIZE + cz)
+                          for (rx, rz), chunklist in trimmer.trimmed.iteritems() for cx, cz in chunklist)
+            assert trimmed == expected, 'trimmed {0} instead of {1}'.format(sorted(trimmed), sorted(expected))
+            assert world.World(wld.path).get_chunks(raw=True) == {coords: payload for coords, payload in chunks.iteritems()
+                                                                  if coords not in expected}, 'chunks that were kept differ'
+
+
+    def check_convert(self):
+        """A McRegion world converted to Anvil has the same blocks, data values and heightmap,
+        and the same region files whether it is converted in parallel or not."""
+        mcregion = self._get_world(anvil=False)
+        converted = [convert.WorldConverter(mcregion, os.path.join(self._get_temp_path(), 'world')).set_workers(workers).convert()
+                     for workers in 1, 2]
+        assert all(wld.anvil for wld in converted), 'converted world is not Anvil'
+        self._assert_same_blocks(converted[0], mcregion, world.CHEIGHT)
+        chunks = converted[0].get_chunks()
+        for coords, chunk in mcregion.get_chunks().iteritems():
+            assert numpy.array_equal(chunks[coords].get_data('heightmap'), chunk.get_data('heightmap')), \
+                'heightmap of chunk {0} differs'.format(coords)
+        assert self._read_files(os.path.join(converted[0].path, 'region')) == \
+            self._read_files(os.path.join(converted[1].path, 'region')), 'regions converted in parallel differ'
+
+
+    def check_entities(self):
+        """A selective NBT scan finds the same tags as decoding the whole chunk, and the entity index
+        finds the entities that were put in a world, and forgets them when their chunk is replaced."""
+        reader = nbt.NBTReader()
+        names = ('xPos', 'zPos', 'Sections', 'Entities', 'HeightMap')
+        for coords, (mtime, data) in self._get_world().get_chunks(raw=True).iteritems():
+            data = zlib.decompress(data)
+            expected = dict((name, payload) for type, name, payload in reader.from_string(data)[0][2][0][2] if name in names)
+            assert reader.find_tags(data, names) == expected, 'tags found in chunk {0} differ'.format(coords)
+
+        wld = self._copy_world()
+        zombie = ('Compound', '', [('String', 'id', 'Zombie'), ('String', 'CustomName', u'Zo\xeb'.encode('utf-8')),
+                                   ('List', 'Pos', [('Double', '', 24.5), ('Double', '', 70.0), ('Double', '', 40.5)])])
+        chest = ('Compound', '', [('String', 'id', 'Chest'), ('Integer', 'x', world.RSIZE * world.CSIZE + 3),
+                                  ('Integer', 'y', 64), ('Integer', 'z', 5), ('List', 'Items', [('Compound', '', [])] * 3)])
+        self._put_entities(wld, (1, 2), [zombie], [])
+        self._put_entities(wld, (world.RSIZE, 0), [], [chest])
+
+        index = entities.EntityIndex(self._get_temp_path()).set_workers(2).update(wld)
+        found = sorted(index.query(), key=lambda entity: entity['id'])
+        assert found == [{'kind': 'tile', 'id': 'Chest', 'x': world.RSIZE * world.CSIZE + 3, 'y': 64, 'z': 5, 'Items': 3},
+                         {'kind': 'entity', 'id': 'Zombie', 'x': 24.5, 'y': 70.0, 'z': 40.5, 'CustomName': u'Zo\xeb'}], \
+            'found entities {0}'.format(found)
+        assert [entity['id'] for entity in index.query(box=(0, world.CSIZE * 4, 0, world.CSIZE * 4))] == ['Zombie'], \
+            'query by box found the wrong entities'
+        assert [entity['id'] for entity in index.query(kind='tile')] == ['Chest'], 'query by kind found the wrong entities'
+
+        self._modify_chunk(wld, (1, 2))
+        assert [entity['id'] for entity in index.update(wld).query()] == ['Chest'], \
+            'entities are still indexed after their chunk was replaced'
+
+
+    def _get_world(self, anvil=True):
+        """Returns the generated world of the given format, generating it if this is its first use."""
+        path = os.path.join(self.path, 'anvil' if anvil else 'mcregion')
+        if not os.path.exists(path):
+            generate.WorldGenerator('mixed', anvil, self.seed).generate(path, self.regions, self.chunks)
+        return world.World(path)
+
+
+    def _copy_world(self, anvil=True):
+        """Returns a copy of the generated world of the given format, for a check to modify."""
+        path = self._get_temp_path()
+        os.rmdir(path)
+        shutil.copytree(self._get_world(anvil).path, path)
+        return world.World(path)
+
+
+    def _get_temp_path(self):
+        return tempfile.mkdtemp(dir=self.path)
+
+
+    def _get_new_chunk(self, wld, (cx, cz)):
+        """Returns compressed data for a chunk with different terrain from the generated chunk at the same coords."""
+        generator = generate.WorldGenerator('mixed', wld.anvil, self.seed)
+        terrain = 'ocean' if generator._get_chunk_terrain((cx, cz)) != 'ocean' else 'hills'
+        return zlib.compress(generate.WorldGenerator(terrain, wld.anvil, self.seed).get_chunk((cx, cz)))
+
+
+    def _modify_chunk(self, wld, (cx, cz)):
+        """Replace a chunk of a world with different terrain, and reload the world."""
+        self._save_chunk(wld, (cx, cz), self._get_new_chunk(wld, (cx, cz)))
+
+
+    def _save_chunk(self, wld, (cx, cz), data):
+        """Replace a chunk of a world with compressed data, with an mtime later than any chunk generated
+        so far and than the chunk it replaces, and reload the world."""
+        region = wld.get_region((cx / world.RSIZE, cz / world.RSIZE))
+        lx, lz = cx % world.RSIZE, cz % world.RSIZE
+        mtime = max(int(time.time()), region.chunkinfo[lx, lz]['mtime'] if (lx, lz) in region.chunkinfo else 0) + 1
+        region.save({(lx, lz): (mtime, data)})
+        wld.reload()
+
+
+    def _put_entities(self, wld, (cx, cz), entitylist, tilelist):
+        """Replace a chunk of a world with the generated chunk with lists of entity and tile entity compounds,
+        and reload the world."""
+        tags = nbt.NBTReader().from_string(generate.WorldGenerator('mixed', wld.anvil, self.seed).get_chunk((cx, cz)))
+        level = tags[0][2][0][2]
+        for i, (type, name, payload) in enumerate(level):
+            if name in ('Entities', 'TileEntities'):
+                level[i] = type, name, entitylist if name == 'Entities' else tilelist
+        self._save_chunk(wld, (cx, cz), zlib.compress(nbt.NBTWriter().to_string(tags)))
+
+
+    def _read_files(self, path):
+        """Returns a dict of the contents of the files in a directory, indexed by name."""
+        contents = {}
+        for name in os.listdir(path):
+            with open(os.path.join(path, name), 'rb') as rfile:
+                contents[name] = rfile.read()
+        return contents
+
+
+    def _assert_exported(self, exporter, wld, ylimits):
+        """Check that the arrays of an export match the chunks of a world, with zeros where there are no chunks."""
+        assert sorted(exporter.get_regions()) == sorted(wld.regionlist), 'exported regions differ'
+        chunks = wld.get_chunks()
+        for rx, rz in wld.regionlist:
+            for type in exporter.types:
+                array = exporter.load((rx, rz), type)
+                for cz in range(world.RSIZE):
+                    for cx in range(world.RSIZE):
+                        exported = array[cx * world.CSIZE:(cx + 1) * world.CSIZE, cz * world.CSIZE:(cz + 1) * world.CSIZE]
+                        coords = rx * world.RSIZE + cx, rz * world.RSIZE + cz
+                        if coords not in chunks:
+                            assert not exported.any(), 'exported {0} data where there is no chunk {1}'.format(type, coords)
+                            continue
+                        data = chunks[coords].get_data(type)
+                        if data.ndim == 3:
+                            data = data[:, :, ylimits[0]:ylimits[1] + 1]
+                        assert numpy.array_equal(exported, data), 'exported {0} data of chunk {1} differs'.format(type, coords)
+
+
+    def _get_map(self, wld):
+        return orthomap.OrthoMap(wld, self.colours, self.biomes)
+
+
+    def _assert_same_image(self, image, expected, what):
+        assert image.size == expected.size, '{0} is {1}, not {2}'.format(what, image.size, expected.size)
+        assert image.tobytes() == expected.tobytes(), '{0} differs'.format(what)
+
+
+    def _assert_same_blocks(self, wld, expected, height=None):
+        """Check that two worlds have the same chunks, with the same block IDs and data values,
+        up to a height if given, and only air above it."""
+        chunks, expectedchunks = wld.get_chunks(), expected.get_chunks()
+        assert sorted(chunks) == sorted(expectedchunks), 'worlds have different chunks'
+        for coords, chunk in chunks.iteritems():
+            for type in 'block', 'blockdata':
+                array, expectedarray = chunk.get_data(type), expectedchunks[coords].get_data(type)
+                top = height or expectedarray.shape[2]
+                assert numpy.array_equal(array[:, :, :top], expectedarray[:, :, :top]) and not array[:, :, top:].any(), \
+                    '{0} data of chunk {1} differs'.format(type, coords)
+
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser('Check that a generated world reads back the same after being written, cached or processed in parallel.')
+    argp.add_argument('--regions', '-r', type=int, nargs=2, default=(2, 1), metavar=('WIDTH', 'DEPTH'))
+    argp.add_argument('--chunks', '-c', type=int, default=4,
+                      help='width of the square of chunks to generate in each region')
+    argp.add_argument('--seed', type=int, default=0)
+    argp.add_argument('--checks', '-k', nargs='*', help='only run these checks')
+    argp.add_argument('--colours')
+    argp.add_argument('--biomes')
+    args = argp.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        checker = Checker(path, args.colours, args.biomes, args.regions, args.chunks, args.seed)
+        unknown = set(args.checks or ()) - set(checker.get_checks())
+        if unknown:
+            argp.error('unknown checks: {0}; must be among {1}'.format(', '.join(sorted(unknown)), ', '.join(checker.get_checks())))
+        failures = checker.run(args.checks)
+    finally:
+        shutil.rmtree(path)
+
+    for name, error in sorted(failures.iteritems()):
+        print
+        print name, 'failed:'
+        print error
+    print '{0} checks failed'.format(len(failures)) if failures else 'all checks passed'
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,160 @@
+import argparse
+import math
+import os
+import random
+import time
+import zlib
+
+import numpy
+
+from minebash import nbt
+from minebash import world
+
+
+TERRAINS = ('flat', 'hills', 'ocean', 'mixed')
+
+
+class WorldGenerator:
+    """Generates synthetic worlds of a set size and terrain, in either Anvil or McRegion format,
+    written with the same region and NBT formats the rest of the package reads."""
+    def __init__(self, terrain='mixed', anvil=True, seed=0):
+        self.terrain = terrain
+        self.anvil = anvil
+        self.height = world.SECHEIGHT * world.SECTIONS if anvil else world.CHEIGHT
+        self.random = random.Random(seed)
+        # random phases for the height noise, so that each seed gives different terrain
+        self.phases = [self.random.uniform(0, 2 * math.pi) for i in range(6)]
+
+
+    def generate(self, path, (width, depth), chunks=world.RSIZE):
+        """Write a world of width x depth regions to path, with a square of chunks x chunks
+        chunks in the northwest of each region."""
+        if not os.path.exists(os.path.join(path, 'region')):
+            os.makedirs(os.path.join(path, 'region'))
+        open(os.path.join(path, 'level.dat'), 'ab').close()
+
+        for rz in range(depth):
+            for rx in range(width):
+                print 'generating region {0} of {1}'.format(rz * width + rx + 1, width * depth)
+                region = world.Region(path, (rx, rz), self.anvil)
+                region.save({(cx, cz): (int(time.time()), zlib.compress(self.get_chunk((rx * world.RSIZE + cx, rz * world.RSIZE + cz))))
+                             for cz in range(chunks) for cx in range(chunks)})
+
+
+    def get_chunk(self, (cx, cz)):
+        """Returns the uncompressed NBT data for a chunk at global chunk coordinates."""
+        blocks, heights = self._get_terrain((cx, cz))
+        data = numpy.zeros_like(blocks)
+        # colour a few blocks of wool with random data values, to exercise the data arrays
+        wool = blocks == 35
+        data[wool] = [self.random.randint(0, 15) for i in range(wool.sum())]
+        skylight = numpy.where(numpy.arange(self.height) >= heights[:, :, numpy.newaxis], 15, 0)
+        blocklight = numpy.zeros_like(blocks)
+
+        tags = [('Integer', 'xPos', cx & 0xffffffff),
+                ('Integer', 'zPos', cz & 0xffffffff),
+                ('Long', 'LastUpdate', 0),
+                ('Byte', 'TerrainPopulated', 1),
+                ('List', 'Entities', []),
+                ('List', 'TileEntities', [])]
+
+        if self.anvil:
+            sections = []
+            for sy in range(world.SECTIONS):
+                ys = slice(sy * world.SECHEIGHT, (sy + 1) * world.SECHEIGHT)
+                if blocks[:, :, ys].any():
+                    # sections are stored in YZX order
+                    section = [('Byte', 'Y', sy)]
+                    for name, array, bits in (('Blocks', blocks, 8), ('Data', data, 4),
+                                              ('SkyLight', skylight, 4), ('BlockLight', blocklight, 4)):
+                        section.append(('Byte Array', name, self._pack(array[:, :, ys].transpose(2, 1, 0).flatten(), bits)))
+                    sections.append(('Compound', '', section))
+            tags += [('Byte Array', 'Biomes', self._get_biomes((cx, cz)).T.flatten().tolist()),
+                     ('Integer Array', 'HeightMap', heights.T.flatten().tolist()),
+                     ('List', 'Sections', sections)]
+        else:
+            # McRegion chunks are stored in XZY order
+            for name, array, bits in (('Blocks', blocks, 8), ('Data', data, 4),
+                                      ('SkyLight', skylight, 4), ('BlockLight', blocklight, 4)):
+                tags.append(('Byte Array', name, self._pack(array.flatten(), bits)))
+            tags.append(('Byte Array', 'HeightMap', heights.T.flatten().tolist()))
+
+        return nbt.NBTWriter().to_string([('Compound', '', [('Compound', 'Level', tags)])])
+
+
+    def _get_terrain(self, (cx, cz)):
+        """Returns an (x, z, y) block array for a chunk, and an (x, z) array of the height
+        of the first non-solid block above the terrain in each column."""
+        xs, zs = numpy.indices((world.CSIZE, world.CSIZE))
+        xs, zs = xs + cx * world.CSIZE, zs + cz * world.CSIZE
+        terrain = self._get_chunk_terrain((cx, cz))
+        p = self.phases
+
+        if terrain == 'flat':
+            ground = numpy.zeros_like(xs) + 64
+        elif terrain == 'ocean':
+            ground = (48 + 6 * numpy.sin(xs / 23.0 + p[0]) * numpy.cos(zs / 29.0 + p[1])).astype(int)
+        else:
+            ground = (80 + 20 * numpy.sin(xs / 37.0 + p[2]) * numpy.cos(zs / 41.0 + p[3])
+                      + 6 * numpy.sin(xs / 7.0 + p[4]) * numpy.sin(zs / 11.0 + p[5])).astype(int)
+        ground = ground.clip(1, self.height - 8)
+
+        ys = numpy.arange(self.height)
+        below = ys < ground[:, :, numpy.newaxis]
+        blocks = numpy.where(below, 1, 0) # stone
+        blocks[ys[numpy.newaxis, numpy.newaxis, :] >= ground[:, :, numpy.newaxis] - 3] *= 3 # dirt
+        top = (ys == ground[:, :, numpy.newaxis] - 1)
+        blocks[top] = 2 # grass
+        blocks[:, :, 0] = 7 # bedrock
+        if terrain == 'ocean':
+            blocks[~below & (ys < 64)] = 9 # water
+            blocks[top] = 12 # sand
+
+        heights = numpy.maximum(ground, 64) if terrain == 'ocean' else ground.copy()
+        if terrain == 'hills':
+            # a few trees: a trunk of wood topped with leaves, which are partly transparent
+            for x, z in ((x, z) for x in range(2, 14, 5) for z in range(2, 14, 5) if self.random.random() < 0.5):
+                y = ground[x, z]
+                blocks[x - 2:x + 3, z - 2:z + 3, y + 3:y + 6] = 18
+                blocks[x, z, y:y + 5] = 17
+                heights[x - 2:x + 3, z - 2:z + 3] = numpy.maximum(heights[x - 2:x + 3, z - 2:z + 3], y + 6)
+        elif terrain == 'flat':
+            blocks[(xs % 8 == 0) & (zs % 8 == 0), 64] = 35 # wool markers
+            heights[(xs % 8 == 0) & (zs % 8 == 0)] = 65
+        return blocks.astype(numpy.uint8), heights
+
+
+    def _get_chunk_terrain(self, (cx, cz)):
+        """Returns the terrain type for a chunk, choosing by position if the terrain is mixed."""
+        if self.terrain != 'mixed':
+            return self.terrain
+        return TERRAINS[(cx / 4 + cz / 4) % 3]
+
+
+    def _get_biomes(self, (cx, cz)):
+        terrain = self._get_chunk_terrain((cx, cz))
+        biome = {'flat': 1, 'hills': 4, 'ocean': 0}[terrain]
+        return numpy.zeros((world.CSIZE, world.CSIZE), int) + biome
+
+
+    def _pack(self, values, bits=8):
+        """Pack a flat array of values into a list of bytes, two to a byte (first in the low bits) if 4-bit."""
+        values = numpy.asarray(values, numpy.uint8)
+        if bits == 4:
+            values = values[0::2] & 15 | (values[1::2] & 15) << 4
+        return values.tolist()
+
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser('Generate a synthetic world for benchmarking.')
+    argp.add_argument('path')
+    argp.add_argument('--regions', '-r', type=int, nargs=2, default=(1, 1), metavar=('WIDTH', 'DEPTH'))
+    argp.add_argument('--chunks', '-c', type=int, default=world.RSIZE,
+                      help='width of the square of chunks to fill in each region')
+    argp.add_argument('--terrain', '-t', choices=TERRAINS, default='mixed')
+    argp.add_argument('--mcregion', action='store_true', help='write a McRegion world instead of Anvil')
+    argp.add_argument('--seed', type=int, default=0)
+    args = argp.parse_args()
+
+    WorldGenerator(args.terrain, not args.mcregion, args.seed).generate(args.path, args.regions, args.chunks)
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from minebash import obliquemap
+from minebash import orthomap
+from minebash import world
+
+import generate
+
+
+class Benchmark:
+    """Times each stage of reading and drawing a world separately, and reports the results
+    in chunks per second and megabytes per second."""
+    def __init__(self, path, colours=None, biomes=None, oblique_chunks=4):
+        self.path = path
+        self.colours = colours
+        self.biomes = biomes
+        self.oblique_chunks = oblique_chunks
+        self.results = {}
+
+
+    def run(self, stages=None):
+        """Run the given stages (or all of them) in order, and return the results.
+        Each stage's input is prepared by the stages before it, but only the stage itself is timed."""
+        wld = self._time('header', lambda: world.World(self.path), lambda wld: (
+            len(wld.get_chunk_list()), len(wld.regions) * 8192))
+        regions = sorted(wld.regions.itervalues(), key=lambda region: region.coords)
+
+        raw = {}
+        self._time('read', lambda: raw.update((region.coords, region.read_chunks(raw=True)) for region in regions),
+                   lambda result: (sum(len(chunks) for chunks in raw.itervalues()),
+                                   sum(len(data) for chunks in raw.itervalues() for mtime, data in chunks.itervalues())))
+        payloads = [data for chunks in raw.itervalues() for mtime, data in chunks.itervalues()]
+
+        decompressed = self._time('zlib', lambda: [zlib.decompress(data) for data in payloads],
+                                  lambda result: (len(result), sum(len(data) for data in result)))
+
+        chunks = self._time('nbt', lambda: [world.AnvilChunk(data) if wld.anvil else world.Chunk(data) for data in decompressed],
+                            lambda result: (len(result), sum(len(data) for data in decompressed)))
+
+        types = ('block', 'heightmap', 'biome', 'blockdata', 'skylight', 'blocklight') if wld.anvil else ('block', 'heightmap')
+        for type in types:
+            self._time('get_data:' + type, lambda: [chunk.get_data(type) for chunk in chunks],
+                       lambda result: (len(result), sum(data.nbytes for data in result)))
+
+        ortho = orthomap.OrthoMap(wld, self.colours, self.biomes)
+        self._time('ortho', lambda: [ortho._generate_region_map(region) for region in regions],
+                   lambda result: (len(payloads), sum(len(image.tobytes()) for image in result)))
+
+        if self.oblique_chunks:
+            oblique = obliquemap.ObliqueMap(wld, self.colours, self.biomes)
+            cx, cz = min(wld.get_chunk_list())
+            size = self.oblique_chunks * world.CSIZE
+            bcrop = (cx * world.CSIZE, cx * world.CSIZE + size - 1, cz * world.CSIZE, cz * world.CSIZE + size - 1)
+            self._time('oblique', lambda: oblique._generate_map(wld, 'block', bcrop),
+                       lambda result: (len(oblique._crop_coords(wld.get_chunk_list(), bcrop, world.CSIZE)),
+                                       len(result.tobytes())))
+
+        savepath = tempfile.mkdtemp()
+        try:
+            saved = [world.Region(savepath, region.coords, wld.anvil) for region in regions]
+            self._time('save', lambda: [region.save(raw[region.coords]) for region in saved],
+                       lambda result: (len(payloads), sum(os.path.getsize(region.path) for region in saved)))
+        finally:
+            shutil.rmtree(savepath)
+
+        if stages:
+            self.results = {name: result for name, result in self.results.iteritems()
+                            if name in stages or name.split(':')[0] in stages}
+        return self.results
+
+
+    def _time(self, name, stage, measure):
+        """Time a stage, and record how many chunks and bytes it processed.
+        measure is called with the stage's result, and returns (chunks, bytes)."""
+        print 'timing', name
+        start = time.time()
+        result = stage()
+        seconds = time.time() - start
+        chunks, bytes = measure(result)
+        self.results[name] = {
+            'seconds': seconds,
+            'chunks': chunks,
+            'bytes': bytes,
+            'chunks_per_s': chunks / seconds if seconds else None,
+            'mb_per_s': bytes / seconds / (1 << 20) if seconds else None,
+            }
+        return result
+
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare two sets of results, returning a dict of the stages that are slower than the baseline
+    by more than the tolerance, with the ratio of old to new throughput for each."""
+    regressions = {}
+    for name, result in results.iteritems():
+        old = baseline.get(name, {}).get('chunks_per_s')
+        if old and result['chunks_per_s'] and result['chunks_per_s'] < old * (1 - tolerance):
+            regressions[name] = result['chunks_per_s'] / old
+    return regressions
+
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser('Benchmark the stages of reading and drawing a world.')
+    argp.add_argument('--world', '-w', help='an existing world to benchmark; otherwise one is generated')
+    argp.add_argument('--regions', '-r', type=int, nargs=2, default=(1, 1), metavar=('WIDTH', 'DEPTH'))
+    argp.add_argument('--chunks', '-c', type=int, default=8,
+                      help='width of the square of chunks to generate in each region')
+    argp.add_argument('--terrain', '-t', choices=generate.TERRAINS, default='mixed')
+    argp.add_argument('--mcregion', action='store_true', help='generate a McRegion world instead of Anvil')
+    argp.add_argument('--seed', type=int, default=0)
+    argp.add_argument('--stages', '-s', nargs='*', help='only report these stages')
+    argp.add_argument('--oblique-chunks', type=int, default=2,
+                      help='width of the square of chunks to draw in the oblique stage (0 to skip it)')
+    argp.add_argument('--colours')
+    argp.add_argument('--biomes')
+    argp.add_argument('--output', '-o', help='write results to a JSON file instead of stdout')
+    argp.add_argument('--compare', help='a previous JSON results file to check for regressions against')
+    argp.add_argument('--tolerance', type=float, default=0.1,
+                      help='fraction of throughput a stage may lose before it counts as a regression')
+    args = argp.parse_args()
+
+    # keep progress messages out of the results, which may be going to stdout
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    path = args.world or tempfile.mkdtemp()
+    try:
+        if not args.world:
+            generate.WorldGenerator(args.terrain, not args.mcregion, args.seed).generate(path, args.regions, args.chunks)
+        results = Benchmark(path, args.colours, args.biomes, args.oblique_chunks).run(args.stages)
+    finally:
+        if not args.world:
+            shutil.rmtree(path)
+        sys.stdout = stdout
+
+    report = {
+        'params': {'world': args.world, 'regions': args.regions, 'chunks': args.chunks, 'terrain': args.terrain,
+                   'anvil': not args.mcregion, 'seed': args.seed},
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'time': int(time.time())},
+        'stages': results,
+        }
+
+    if args.compare:
+        with open(args.compare, 'rb') as cfile:
+            report['regressions'] = compare(results, json.load(cfile)['stages'], args.tolerance)
+
+    if args.output:
+        with open(args.output, 'wb') as ofile:
+            json.dump(report, ofile, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    sys.exit(1 if report.get('regressions') else 0)
@@ -0,0 +1,38 @@
+from PySide import QtGui
+
+
+class MBMapTile(QtGui.QGraphicsPixmapItem):
+    """The map of a whole region, drawn as a single item. Its pixmaps may be reduced by a factor
+    to save memory when the view is zoomed out, in which case the item is scaled up to cover the region."""
+    def __init__(self, tab, (rx, rz), rsize, csize):
+        QtGui.QGraphicsPixmapItem.__init__(self)
+
+        self.setZValue(1)
+        self.setPos(rx * rsize * csize, rz * rsize * csize)
+
+        self.tab = tab
+        self.coords = rx, rz
+        self.rsize = rsize
+        self.csize = csize
+        self.factor = 1 # the factor the pixmaps are reduced by
+        self.stale = True # whether the tile needs to be redrawn
+        self.overlays = {} # pixmaps of other map types, drawn over the block map when enabled
+
+
+    def set_layers(self, layers, factor=1):
+        """Set the block map pixmap, and keep any other types as overlays."""
+        self.setPixmap(layers['block'])
+        self.overlays = {type: pixmap for type, pixmap in layers.iteritems() if type != 'block'}
+        self.setScale(factor)
+        self.factor = factor
+        self.stale = False
+
+
+    def paint(self, painter, option, widget=None):
+        """Draw the map, with the biome overlay if enabled."""
+        QtGui.QGraphicsPixmapItem.paint(self, painter, option, widget)
+
+        if self.tab.biomecheck.isChecked() and 'biome' in self.overlays:
+            painter.setOpacity(0.5)
+            painter.drawPixmap(0, 0, self.overlays['biome'])
+            painter.setOpacity(1)
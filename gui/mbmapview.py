@@ -1,22 +1,107 @@
+import math
+
 from PySide import QtCore
 from PySide import QtGui
 
 
 class MBMapView(QtGui.QGraphicsView):
+    """A view of a world's map, which can be zoomed with the mouse wheel. The chunks under the cursor
+    are worked out from its position, so the map needs no item per chunk for hovering and selection.
+    Emits viewchanged whenever the visible area changes, after a short delay to let scrolling settle."""
+    viewchanged = QtCore.Signal()
+
     def __init__(self, scene, tab):
         QtGui.QGraphicsView.__init__(self, scene)
-        
-        self.setRubberBandSelectionMode(QtCore.Qt.ContainsItemShape)
+
+        self.setMouseTracking(1)
+        self.setTransformationAnchor(QtGui.QGraphicsView.AnchorUnderMouse)
 
         self.tab = tab
-        
-        
+        self.zoom = 1.0
+        self.origin = None # view position where a box selection started
+        self.rubberband = QtGui.QRubberBand(QtGui.QRubberBand.Rectangle, self.viewport())
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(1)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.viewchanged.emit)
+        self.horizontalScrollBar().valueChanged.connect(self.timer.start)
+        self.verticalScrollBar().valueChanged.connect(self.timer.start)
+
+
+    def set_zoom(self, zoom):
+        """Set the scale of the view, between 1/64 and 8 screen pixels per block."""
+        self.zoom = min(max(zoom, 1 / 64.0), 8)
+        self.setTransform(QtGui.QTransform.fromScale(self.zoom, self.zoom))
+        self.timer.start()
+
+
+    def get_factor(self):
+        """Returns the factor to reduce map tiles by at the current zoom: the largest power of two,
+        up to 16, that leaves at least one tile pixel per screen pixel."""
+        factor = 1
+        while factor < 16 and self.zoom * factor * 2 <= 1:
+            factor *= 2
+        return factor
+
+
+    def visible_rect(self):
+        """Returns the area of the scene that is currently visible."""
+        return self.mapToScene(self.viewport().rect()).boundingRect()
+
+
+    def wheelEvent(self, event):
+        """Zoom in or out by a step for each notch of the wheel, keeping the point under the mouse in place."""
+        self.set_zoom(self.zoom * 1.25 ** (event.delta() / 120.0))
+
+
+    def resizeEvent(self, event):
+        QtGui.QGraphicsView.resizeEvent(self, event)
+        self.timer.start()
+
+
     def mousePressEvent(self, event):
-        """Starts a rubber band if the box tool is selected."""
-        self.setDragMode(QtGui.QGraphicsView.RubberBandDrag if self.tab.win.box.isChecked()
-                         else QtGui.QGraphicsView.NoDrag)
-        QtGui.QGraphicsView.mousePressEvent(self, event)
-        
-        
+        """Starts a selection with the brush or box tool, unless a pasted selection is being moved."""
+        if self.tab.paste:
+            QtGui.QGraphicsView.mousePressEvent(self, event)
+            return
+
+        pos = self.mapToScene(event.pos())
+        coords = self.tab.get_chunk_at(pos.x(), pos.y())
+        # select or deselect, depending where the selection starts
+        self.tab.select = coords not in self.tab.selected
+        if self.tab.win.brush.isChecked():
+            self.tab.highlight_chunks([coords])
+        elif self.tab.win.box.isChecked():
+            self.origin = event.pos()
+            self.rubberband.setGeometry(QtCore.QRect(self.origin, QtCore.QSize()))
+            self.rubberband.show()
+
+
+    def mouseMoveEvent(self, event):
+        """Updates the coordinate labels, and any selection in progress."""
+        pos = self.mapToScene(event.pos())
+        self.tab.update_labels(int(math.floor(pos.x())), int(math.floor(pos.y())))
+
+        if self.tab.paste:
+            QtGui.QGraphicsView.mouseMoveEvent(self, event)
+        elif event.buttons() & QtCore.Qt.LeftButton:
+            if self.tab.win.brush.isChecked():
+                self.tab.highlight_chunks([self.tab.get_chunk_at(pos.x(), pos.y())])
+            elif self.origin is not None:
+                rect = QtCore.QRect(self.origin, event.pos()).normalized()
+                self.rubberband.setGeometry(rect)
+                self.tab.highlight_box(self.mapToScene(rect).boundingRect())
+
+
     def mouseReleaseEvent(self, event):
+        if self.tab.paste:
+            QtGui.QGraphicsView.mouseReleaseEvent(self, event)
+            return
+        self.origin = None
+        self.rubberband.hide()
         self.tab.update_selection()
+
+
+    def leaveEvent(self, event):
+        self.tab.clear_labels()
@@ -0,0 +1,65 @@
+import numpy
+from PySide import QtCore
+from PySide import QtGui
+
+
+class MBOverlay(QtGui.QGraphicsItem):
+    """A single item drawn over the whole map, showing the tab's selection, and darkening the map
+    while there is a pasted selection above it. Each region with selected or highlighted chunks has
+    a small image with a pixel per chunk, scaled up when drawn; images are only rebuilt for regions
+    whose selection has changed."""
+    def __init__(self, tab, rsize, csize):
+        QtGui.QGraphicsItem.__init__(self)
+
+        self.setZValue(2.5)
+
+        self.tab = tab
+        self.rsize = rsize
+        self.csize = csize
+        self.images = {} # selection images, indexed by region coords
+        self.rect = QtCore.QRectF()
+        self.dimmed = False
+
+
+    def update_regions(self, regions):
+        """Rebuild the images of regions whose selection or highlighting has changed."""
+        rbsize = self.rsize * self.csize
+        for rx, rz in regions:
+            selected, highlighted = self.tab.selected.get_mask((rx, rz)), self.tab.highlighted.get_mask((rx, rz))
+            if not (selected.any() or highlighted.any()):
+                self.images.pop((rx, rz), None)
+            else:
+                # BGRA, to suit QImage's ARGB32 format on little-endian machines
+                colours = numpy.zeros((self.rsize, self.rsize, 4), numpy.uint8)
+                colours[selected] = 255, 255, 255, 128
+                colours[highlighted] = (0, 255, 0, 128) if self.tab.select else (0, 0, 255, 128)
+                data = colours.tostring()
+                self.images[rx, rz] = QtGui.QImage(data, self.rsize, self.rsize, QtGui.QImage.Format_ARGB32).copy()
+
+        rect = QtCore.QRectF()
+        for rx, rz in self.images:
+            rect = rect.united(QtCore.QRectF(rx * rbsize, rz * rbsize, rbsize, rbsize))
+        if rect != self.rect:
+            self.prepareGeometryChange()
+            self.rect = rect
+        for rx, rz in regions:
+            self.update(QtCore.QRectF(rx * rbsize, rz * rbsize, rbsize, rbsize))
+
+
+    def set_dimmed(self, dimmed):
+        """Set whether to darken everything below the overlay."""
+        self.prepareGeometryChange()
+        self.dimmed = dimmed
+        self.update()
+
+
+    def boundingRect(self):
+        return self.rect.united(self.scene().sceneRect()) if self.dimmed else self.rect
+
+
+    def paint(self, painter, option, widget=None):
+        if self.dimmed:
+            painter.fillRect(self.boundingRect(), QtGui.QColor(0, 0, 0, 128))
+        rbsize = self.rsize * self.csize
+        for (rx, rz), image in self.images.iteritems():
+            painter.drawImage(QtCore.QRectF(rx * rbsize, rz * rbsize, rbsize, rbsize), image)
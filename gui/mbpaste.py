@@ -1,28 +1,83 @@
+import numpy
+from PySide import QtCore
 from PySide import QtGui
 
 
-class MBPaste(QtGui.QGraphicsItemGroup):
-    def __init__(self, wld, csize):
-        QtGui.QGraphicsItemGroup.__init__(self)
-        
+class MBPaste(QtGui.QGraphicsItem):
+    """A selection of chunks copied from a world, drawn as a single item which can be dragged around
+    the view in chunk-sized steps. Its map is composited from whole-region renders of the source world:
+    one piece per region, cropped to the selected chunks in it, with the other chunks cleared.
+    Once merged, it stays in the view as a layer, and its chunks are placed by its offset."""
+    def __init__(self, tab, wld, chunks, rsize, csize):
+        QtGui.QGraphicsItem.__init__(self)
+
+        self.setZValue(3)
+
+        self.tab = tab
         self.world = wld
+        self.chunks = chunks # selection of chunks, in the source world's coords
+        self.rsize = rsize
         self.csize = csize
-        self.chunks = {}
-        
-        self.setZValue(3)
+        self.pieces = {} # (x, z, dict of pixmaps indexed by type), indexed by source region coords
+
+        self.rect = QtCore.QRectF()
+        for rx, rz in self.chunks.masks:
+            x0, z0, x1, z1 = self._get_box((rx, rz))
+            self.rect = self.rect.united(QtCore.QRectF(x0, z0, x1 - x0, z1 - z0))
+
+
+    def get_offset(self):
+        """Returns how many chunks the selection has been moved by, along x and z."""
+        return int(self.pos().x()) / self.csize, int(self.pos().y()) / self.csize
+
+
+    def get_regions(self):
+        """Returns a list of the source regions with selected chunks in them."""
+        return [self.world.get_region(coords) for coords in self.chunks.masks if self.world.get_region(coords)]
+
+
+    def set_region_images(self, (rx, rz), images):
+        """Cut the selected chunks out of a dict of images of a source region, indexed by type."""
+        mask = self.chunks.get_mask((rx, rz)).repeat(self.csize, 0).repeat(self.csize, 1)
+        x0, z0, x1, z1 = self._get_box((rx, rz))
+        rbsize = self.rsize * self.csize
+        box = slice(z0 - rz * rbsize, z1 - rz * rbsize), slice(x0 - rx * rbsize, x1 - rx * rbsize)
+
+        pixmaps = {}
+        for type, image in images.iteritems():
+            colours = numpy.array(image)
+            colours[~mask, 3] = 0
+            # BGRA, to suit QImage's ARGB32 format on little-endian machines
+            data = numpy.ascontiguousarray(colours[box][:, :, (2, 1, 0, 3)]).tostring()
+            pixmaps[type] = QtGui.QPixmap.fromImage(QtGui.QImage(data, x1 - x0, z1 - z0, QtGui.QImage.Format_ARGB32))
+        self.pieces[rx, rz] = x0, z0, pixmaps
+        self.update(QtCore.QRectF(x0, z0, x1 - x0, z1 - z0))
+
+
+    def boundingRect(self):
+        return self.rect
+
+
+    def paint(self, painter, option, widget=None):
+        for x, z, pixmaps in self.pieces.itervalues():
+            painter.drawPixmap(x, z, pixmaps['block'])
+            if self.tab.biomecheck.isChecked() and 'biome' in pixmaps:
+                painter.setOpacity(0.5)
+                painter.drawPixmap(x, z, pixmaps['biome'])
+                painter.setOpacity(1)
+
 
-        
     def mousePressEvent(self, event):
         """Records the starting point of a mouse drag on the pasted selection."""
         self.drag_origin = event.scenePos().x(), event.scenePos().y()
-        
-        
+
+
     def mouseMoveEvent(self, event):
         """Moves the pasted selection around the view, in chunk-sized increments."""
         ox, oz = self.drag_origin
         dx, dz = int(event.scenePos().x() - ox), int(event.scenePos().y() - oz)
         mx, mz = 0, 0
-        
+
         if abs(dx) / self.csize:
             mx = dx / self.csize * self.csize
         if abs(dz) / self.csize:
@@ -30,6 +85,10 @@ class MBPaste(QtGui.QGraphicsItemGroup):
 
         self.setPos(self.pos().x() + mx, self.pos().y() + mz)
         self.drag_origin = ox + mx, oz + mz
-        
-        
-        
+
+
+    def _get_box(self, (rx, rz)):
+        """Returns the edges in blocks (w, n, e, s) of the selected chunks in a source region, in its own coords."""
+        zs, xs = self.chunks.get_mask((rx, rz)).nonzero()
+        return ((rx * self.rsize + int(xs.min())) * self.csize, (rz * self.rsize + int(zs.min())) * self.csize,
+                (rx * self.rsize + int(xs.max()) + 1) * self.csize, (rz * self.rsize + int(zs.max()) + 1) * self.csize)
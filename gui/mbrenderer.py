@@ -0,0 +1,67 @@
+import threading
+
+from PIL import Image
+from PySide import QtCore
+
+
+# the shared pool is given one batch of regions at a time, by one renderer at a time
+_poollock = threading.Lock()
+
+
+class MBRenderer(QtCore.QThread):
+    """Renders maps of a list of regions in a background thread, with a shared pool of worker processes
+    if one is given, which renderers take turns to use a batch of regions at a time. Regions are started
+    in the order given, and each region's images are sent to the main thread as soon as they are drawn,
+    reduced in size by an optional factor.
+    Rendering can be cancelled, after which the regions that were not finished can be read from remaining()."""
+    rendered = QtCore.Signal(object, object) # region coords, dict of images indexed by type
+
+    def __init__(self, mapobj, regions, types=('block',), refresh=False, factor=1, pool=None, parent=None):
+        QtCore.QThread.__init__(self, parent)
+
+        self.map = mapobj
+        self.regions = list(regions)
+        self.types = types
+        self.refresh = refresh
+        self.factor = factor
+        self.pool = pool
+
+        self.done = set() # coords of regions that have been sent
+        self.cancelled = False
+
+
+    def run(self):
+        # the pool is shared by all renders, so it can't be stopped; regions are passed to it a batch
+        # at a time, so that a cancelled render leaves at most one batch for the workers to finish
+        batchsize = self.map.workers * 2 if self.pool else max(len(self.regions), 1)
+        for start in range(0, len(self.regions), batchsize):
+            batch = self.regions[start:start + batchsize]
+            if self.pool:
+                with _poollock:
+                    if not self._render_batch(batch):
+                        return
+            elif not self._render_batch(batch):
+                return
+
+
+    def _render_batch(self, batch):
+        """Render a batch of regions and send their images, returning False if cancelled."""
+        for coords, images in self.map._render_region_layers(batch, self.types, self.refresh, self.pool):
+            if self.cancelled:
+                return False
+            if self.factor > 1:
+                images = {type: image.resize((image.size[0] / self.factor, image.size[1] / self.factor), Image.BOX)
+                          for type, image in images.iteritems()}
+            self.done.add(coords)
+            self.rendered.emit(coords, images)
+        return True
+
+
+    def cancel(self):
+        """Stop rendering as soon as possible. Regions already being drawn by other processes are discarded."""
+        self.cancelled = True
+
+
+    def remaining(self):
+        """Returns the regions that have not been sent."""
+        return [region for region in self.regions if region.coords not in self.done]
@@ -0,0 +1,103 @@
+import numpy
+
+
+class MBSelection:
+    """A set of chunks, stored as a bitmap for each region that has any chunks in it, indexed [z, x].
+    Works like a set of global chunk coords, but whole selections and rectangles are combined with
+    a few array operations per region. Methods that modify the selection return the coords of the
+    regions they changed, so that only those need to be redrawn."""
+    def __init__(self, rsize):
+        self.rsize = rsize
+        self.masks = {} # bitmaps of selected chunks, indexed by region coords
+
+
+    def __len__(self):
+        return sum(int(mask.sum()) for mask in self.masks.itervalues())
+
+
+    def __contains__(self, (cx, cz)):
+        mask = self.masks.get((cx / self.rsize, cz / self.rsize))
+        return mask is not None and bool(mask[cz % self.rsize, cx % self.rsize])
+
+
+    def __iter__(self):
+        for (rx, rz), mask in self.masks.iteritems():
+            for cz, cx in zip(*mask.nonzero()):
+                yield rx * self.rsize + int(cx), rz * self.rsize + int(cz)
+
+
+    def copy(self):
+        selection = MBSelection(self.rsize)
+        selection.masks = {coords: mask.copy() for coords, mask in self.masks.iteritems()}
+        return selection
+
+
+    def get_mask(self, (rx, rz)):
+        """Returns the bitmap of a region, which is empty if no chunks in it are selected."""
+        mask = self.masks.get((rx, rz))
+        return mask if mask is not None else numpy.zeros((self.rsize, self.rsize), bool)
+
+
+    def set_mask(self, (rx, rz), mask):
+        """Replace the bitmap of a region. Returns whether anything changed."""
+        if not mask.any():
+            return self.masks.pop((rx, rz), None) is not None
+        if (rx, rz) in self.masks and (self.masks[rx, rz] == mask).all():
+            return False
+        self.masks[rx, rz] = mask
+        return True
+
+
+    def clear(self):
+        changed, self.masks = self.masks.keys(), {}
+        return changed
+
+
+    def add_chunks(self, chunks):
+        """Add a list of chunk coords."""
+        changed = set()
+        for cx, cz in chunks:
+            mask = self.get_mask((cx / self.rsize, cz / self.rsize))
+            if not mask[cz % self.rsize, cx % self.rsize]:
+                mask[cz % self.rsize, cx % self.rsize] = True
+                self.masks[cx / self.rsize, cz / self.rsize] = mask
+                changed.add((cx / self.rsize, cz / self.rsize))
+        return list(changed)
+
+
+    def add(self, other):
+        """Add all the chunks in another selection."""
+        return [coords for coords, mask in other.masks.items() if self.set_mask(coords, self.get_mask(coords) | mask)]
+
+
+    def subtract(self, other):
+        """Remove all the chunks in another selection."""
+        return [coords for coords, mask in other.masks.items() if self.set_mask(coords, self.get_mask(coords) & ~mask)]
+
+
+    def intersect(self, other):
+        """Remove all the chunks that are not in another selection."""
+        return [coords for coords, mask in self.masks.items() if self.set_mask(coords, mask & other.get_mask(coords))]
+
+
+    def invert(self, within):
+        """Select exactly the chunks in another selection (e.g. of all existing chunks) that are not selected now."""
+        return [coords for coords in set(self.masks) | set(within.masks)
+                if self.set_mask(coords, within.get_mask(coords) & ~self.get_mask(coords))]
+
+
+    def fill_rect(self, (w, n, e, s), value=True, within=None):
+        """Select (or deselect, if value is false) the chunks from w to e and n to s, not including e and s,
+        and optionally only those in another selection."""
+        changed = []
+        for rx in range(w / self.rsize, (e - 1) / self.rsize + 1):
+            for rz in range(n / self.rsize, (s - 1) / self.rsize + 1):
+                rect = numpy.zeros((self.rsize, self.rsize), bool)
+                rect[max(n - rz * self.rsize, 0):max(s - rz * self.rsize, 0),
+                     max(w - rx * self.rsize, 0):max(e - rx * self.rsize, 0)] = True
+                if within is not None:
+                    rect &= within.get_mask((rx, rz))
+                mask = self.get_mask((rx, rz))
+                if self.set_mask((rx, rz), mask | rect if value else mask & ~rect):
+                    changed.append((rx, rz))
+        return changed
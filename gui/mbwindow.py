@@ -1,14 +1,23 @@
+import os
+
+from PySide import QtCore
 from PySide import QtGui
 
 
 class MBWindow(QtGui.QMainWindow):
+    eventreceived = QtCore.Signal(object)
+    
     def __init__(self):
         QtGui.QMainWindow.__init__(self)
         
+        self.pid = os.getpid()
         self.init_ui()
+        self.eventreceived.connect(self.show_event)
         
         # init tools
         
+        self.invertbtn.triggered.connect(lambda: self.tabs.currentWidget().invert_selection())
+        self.clearbtn.triggered.connect(lambda: self.tabs.currentWidget().clear_selection())
         self.mergebtn.triggered.connect(lambda: self.tabs.currentWidget().merge_chunks())
         self.cancelbtn.triggered.connect(lambda: self.tabs.currentWidget().cancel_merge())
         self.update_toolbar()
@@ -48,6 +57,9 @@ class MBWindow(QtGui.QMainWindow):
         self.box.setCheckable(1)
         self.seltools.addAction(self.box)
         
+        self.invertbtn = self.tools.addAction('Invert')
+        self.clearbtn = self.tools.addAction('Clear')
+        
         # clipboard tools
         
         self.tools.addSeparator()
@@ -65,6 +77,11 @@ class MBWindow(QtGui.QMainWindow):
         
         self.copylabel = QtGui.QLabel('')
         self.status.addWidget(self.copylabel)
+        
+        self.progress = QtGui.QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.hide()
+        self.status.addPermanentWidget(self.progress)
     
 
     def update_toolbar(self):
@@ -75,10 +92,35 @@ class MBWindow(QtGui.QMainWindow):
         else:
             self.tools.setEnabled(1)
             self.seltools.setEnabled(1 if not tab.paste else 0)
+            self.invertbtn.setEnabled(1 if not tab.paste else 0)
+            self.clearbtn.setEnabled(1 if tab.selected and not tab.paste else 0)
             self.copybtn.setEnabled(1 if tab.selected else 0)
-            self.pastebtn.setEnabled(1 if self.cliptab and not tab.paste else 0)
+            self.pastebtn.setEnabled(1 if self.cliptab and not tab.paste and self.cliptab.world.anvil == tab.world.anvil else 0)
             self.mergebtn.setEnabled(1 if tab.paste else 0)
             self.cancelbtn.setEnabled(1 if tab.paste else 0)
             
             
+    def handle(self, event):
+        """Receives instrumentation events, which may come from a background thread,
+        and passes them to the main thread to be shown. Only messages, warnings and progress are shown;
+        timers, counters and events from worker processes are ignored."""
+        if os.getpid() != self.pid or event['type'] not in ('message', 'warning', 'progress'):
+            return
+        if QtCore.QThread.currentThread() == self.thread():
+            self.show_event(event)
+        else:
+            self.eventreceived.emit(event)
+            
+            
+    def show_event(self, event):
+        """Shows instrumentation events in the status bar: messages as text, and region progress
+        in a progress bar."""
+        if event['type'] in ('message', 'warning'):
+            self.status.showMessage(event['name'], 5000)
+        elif event['type'] == 'progress' and event['name'] == 'regions':
+            self.progress.setMaximum(event['total'])
+            self.progress.setValue(event['done'])
+            self.progress.setVisible(event['done'] < event['total'])
+            
+            
 
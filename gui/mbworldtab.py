@@ -1,8 +1,14 @@
+import math
+
+import numpy
+from PySide import QtCore
 from PySide import QtGui
 
-import mbmapchunk
+import mbmaptile
 import mbmapview
+import mboverlay
 import mbpaste
+import mbselection
 
 
 class MBWorldTab(QtGui.QWidget):
@@ -14,15 +20,23 @@ class MBWorldTab(QtGui.QWidget):
         self.rsize = rsize
         self.csize = csize
         
-        self.chunks = {} # dict of chunks, indexed by coords
-        self.merged = {} # dict of merged chunks as (world, chunk) tuples, indexed by coords
+        self.tiles = {} # dict of region tiles in or near the view, indexed by region coords
+        self.merged = {} # dict of merged chunks as (world, coords in that world) tuples, indexed by coords
+        self.merges = [] # merged selections, kept in the view as layers until saved
         
-        self.selected = set() # currently selected chunks in this world
-        self.copied = set() # last copied chunks in this world
+        self.existing = mbselection.MBSelection(rsize) # chunks that exist in this world, or have been merged into it
+        self.selected = mbselection.MBSelection(rsize) # currently selected chunks in this world
+        self.copied = mbselection.MBSelection(rsize) # last copied chunks in this world
+        self.highlighted = mbselection.MBSelection(rsize) # chunks being selected or deselected by a tool
 
         self.select = True # whether tools will select or deselect chunks
         
+        self.renderers = [] # background renders in progress
+        self.pending = [] # regions left unfinished when rendering was paused, to be resumed
+        self.progress = [0, 0] # regions rendered, and regions to render
+        
         self.init_ui()
+        self.update_existing()
 
         
     def init_ui(self):
@@ -41,14 +55,11 @@ class MBWorldTab(QtGui.QWidget):
         mainlayout.addWidget(tools)
         mainlayout.addWidget(info)
         
-        # chunk groups to act as layers, each with its own z-value
+        # region tiles are drawn at a z-value of 1, merged selections at 2, and a pasted selection at 3,
+        # with the overlay in between
         
-        self.chunkgrp = QtGui.QGraphicsItemGroup()
-        self.scene.addItem(self.chunkgrp)
-        self.chunkgrp.setZValue(1)
-        self.mergegrp = QtGui.QGraphicsItemGroup()
-        self.scene.addItem(self.mergegrp)
-        self.mergegrp.setZValue(2)
+        self.overlay = mboverlay.MBOverlay(self, self.rsize, self.csize)
+        self.scene.addItem(self.overlay)
         self.paste = None # a pasted, unmerged selection of chunks
         
         # tools row
@@ -65,6 +76,10 @@ class MBWorldTab(QtGui.QWidget):
         self.generate = QtGui.QPushButton('Generate', self)
         toolslayout.addWidget(self.generate)
         
+        self.stop = QtGui.QPushButton('Stop', self)
+        self.stop.setEnabled(0)
+        toolslayout.addWidget(self.stop)
+        
         # info row
         
         infolayout = QtGui.QHBoxLayout(info)
@@ -104,70 +119,135 @@ class MBWorldTab(QtGui.QWidget):
         self.labels['Region'].setText('Region: {0}, {1}'.format(rx, rz))
             
             
-    def highlight_chunk(self, (cx, cz)):
-        """Mark a chunk to be highlighted by a selection tool."""
-        if (cx, cz) in self.chunks:
-            self.scene.itemAt(cx * self.csize, cz * self.csize).setSelected(1)
+    def get_chunk_at(self, x, z):
+        """Returns the coords of the chunk containing a point in the scene."""
+        return int(math.floor(x / self.csize)), int(math.floor(z / self.csize))
+
+
+    def update_existing(self):
+        """Re-read which chunks exist, from the world's region headers and the chunks merged into it."""
+        self.existing = mbselection.MBSelection(self.rsize)
+        for (rx, rz), region in self.world.regions.iteritems():
+            if region.chunkinfo:
+                mask = numpy.zeros((self.rsize, self.rsize), bool)
+                xs, zs = zip(*region.chunkinfo)
+                mask[zs, xs] = True
+                self.existing.set_mask((rx, rz), mask)
+        self.existing.add_chunks(self.merged)
+
+
+    def highlight_chunks(self, chunks):
+        """Mark chunks to be highlighted by a selection tool, if they exist and would change."""
+        self.overlay.update_regions(self.highlighted.add_chunks(
+            coords for coords in chunks if coords in self.existing and self.select != (coords in self.selected)))
+
+
+    def highlight_box(self, rect):
+        """Highlight the chunks that lie completely inside a rectangle in the scene, instead of any highlighted before."""
+        w, n = int(math.ceil(rect.left() / self.csize)), int(math.ceil(rect.top() / self.csize))
+        e, s = int(math.floor(rect.right() / self.csize)), int(math.floor(rect.bottom() / self.csize))
+        box = mbselection.MBSelection(self.rsize)
+        box.fill_rect((w, n, e, s), within=self.existing)
+        box.subtract(self.selected) if self.select else box.intersect(self.selected)
+        self.overlay.update_regions([coords for coords in set(self.highlighted.masks) | set(box.masks)
+                                     if self.highlighted.set_mask(coords, box.get_mask(coords))])
+
 
-        
     def update_selection(self):
         """Adds or removes all highlighted chunks from the selection."""
-        for chunk in self.scene.selectedItems():
-            self.selected.add(chunk.coords) if self.select else self.selected.discard(chunk.coords)
-            chunk.setSelected(0)
-        self.selectlabel.setText('Chunks selected: {0}'.format(len(self.selected) if self.selected else ''))
-        self.win.copybtn.setEnabled(1 if self.selected else 0)
-        
-        
+        self.selected.add(self.highlighted) if self.select else self.selected.subtract(self.highlighted)
+        self.overlay.update_regions(self.highlighted.clear())
+        self.selection_changed()
+
+
+    def invert_selection(self):
+        """Select all the chunks that are not selected, and deselect the rest."""
+        self.overlay.update_regions(self.selected.invert(self.existing))
+        self.selection_changed()
+
+
+    def clear_selection(self):
+        """Deselect all chunks."""
+        self.overlay.update_regions(self.selected.clear())
+        self.selection_changed()
+
+
+    def selection_changed(self):
+        """Update the selection label and tools."""
+        count = len(self.selected)
+        self.selectlabel.setText('Chunks selected: {0}'.format(count if count else ''))
+        self.win.update_toolbar()
+
+
+    def set_tile(self, (rx, rz), layers, factor=1):
+        """Add the tile of a region to the view, or update the one already there."""
+        if (rx, rz) not in self.tiles:
+            self.tiles[rx, rz] = mbmaptile.MBMapTile(self, (rx, rz), self.rsize, self.csize)
+            self.scene.addItem(self.tiles[rx, rz])
+        self.tiles[rx, rz].set_layers(layers, factor)
+
+
+    def remove_tile(self, (rx, rz)):
+        """Remove the tile of a region from the view, freeing its pixmaps."""
+        self.scene.removeItem(self.tiles.pop((rx, rz)))
+
+
+    def update_bounds(self):
+        """Set the scrollable area of the view to cover all the world's regions, whether their tiles are loaded or not."""
+        rbsize = self.rsize * self.csize
+        regions = list(self.world.regionlist) + [(cx / self.rsize, cz / self.rsize) for cx, cz in self.merged]
+        if regions:
+            xs, zs = zip(*regions)
+            self.scene.setSceneRect(QtCore.QRectF(min(xs) * rbsize, min(zs) * rbsize,
+                                                  (max(xs) - min(xs) + 1) * rbsize, (max(zs) - min(zs) + 1) * rbsize))
+
+
     def paste_chunks(self, ctab):
-        """Adds a pasted selection to the view, and puts the tab into paste mode."""
-        paste = mbpaste.MBPaste(ctab.world, self.csize)
-        for cx, cz in ctab.copied:
-            chunk = mbmapchunk.MBMapChunk(self, (cx, cz), self.csize)
-            chunk.setPos(cx * self.csize, cz * self.csize)
-            self.scene.addItem(chunk)
-            paste.addToGroup(chunk)
-            paste.chunks[cx, cz] = chunk
-        self.paste = paste
+        """Adds a pasted selection to the view, and puts the tab into paste mode.
+        Returns the pasted selection, whose map still needs to be drawn."""
+        self.paste = mbpaste.MBPaste(self, ctab.world, ctab.copied.copy(), self.rsize, self.csize)
 
         # show paste and darken view
         self.scene.addItem(self.paste)
-        self.scene.update()
-        
-        # move to pasted selection (and update fully to avoid bugs with darkening)
-        self.view.setViewportUpdateMode(QtGui.QGraphicsView.FullViewportUpdate)
+        self.overlay.set_dimmed(True)
         self.view.ensureVisible(self.paste)
-        self.view.setViewportUpdateMode(QtGui.QGraphicsView.MinimalViewportUpdate)
             
         # clear selection, update gui
-        self.selected.clear()
-        self.pastelabel.setText('{0} chunks pasted from {1}.'.format(len(self.paste.chunks), self.win.cliptab.world.name))
+        self.clear_selection()
+        self.pastelabel.setText('{0} chunks pasted from {1}.'.format(len(self.paste.chunks), ctab.world.name))
+        return self.paste
             
             
     def merge_chunks(self):
-        """Merges a pasted selection of chunks into the current view's chunks,
-        and allows further editing of the world."""
-        for chunk in self.paste.chunks.itervalues():
-            cx, cz = int(chunk.scenePos().x() / self.csize), int(chunk.scenePos().y() / self.csize)
-            self.mergegrp.addToGroup(chunk)
-            self.merged[cx, cz] = self.paste.world, chunk
+        """Merges a pasted selection of chunks into the current view's chunks, by its offset from where
+        it was copied, and allows further editing of the world."""
+        dx, dz = self.paste.get_offset()
+        chunks = [(cx + dx, cz + dz) for cx, cz in self.paste.chunks]
+        self.merged.update(((cx + dx, cz + dz), (self.paste.world, (cx, cz))) for cx, cz in self.paste.chunks)
+        self.existing.add_chunks(chunks)
+        self.paste.setZValue(2)
+        self.merges.append(self.paste)
             
-        self.pastelabel.setText('{0} chunks merged.'.format(len(self.paste.chunks)))
-        #self.scene.destroyItemGroup(self.paste)
+        self.pastelabel.setText('{0} chunks merged.'.format(len(chunks)))
         self.paste = None
-        self.scene.update()
+        self.overlay.set_dimmed(False)
+        self.update_bounds()
         self.win.update_toolbar()
         
         
     def cancel_merge(self):
         """Removes a pasted selection without merging it."""
-        for chunk in self.paste.chunks.itervalues():
-            self.scene.removeItem(chunk)
+        self.scene.removeItem(self.paste)
             
         self.pastelabel.setText('')
-        self.scene.destroyItemGroup(self.paste)
         self.paste = None
-        self.scene.update()
+        self.overlay.set_dimmed(False)
         self.win.update_toolbar()
-        
-        
\ No newline at end of file
+
+
+    def clear_merges(self):
+        """Removes merged selections from the view, once they have been saved into the world."""
+        for merge in self.merges:
+            self.scene.removeItem(merge)
+        self.merges = []
+        self.merged = {}
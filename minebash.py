@@ -1,14 +1,15 @@
 import argparse
+import math
 import os
 import sys
 
-from PIL import Image
 from PySide import QtGui
 
 from gui import mbwindow
 from gui import mbworldtab
-from gui import mbmapchunk
-from gui import mbpaste
+from gui import mbrenderer
+from minebash import cache
+from minebash import instrument
 from minebash import orthomap
 from minebash import world
 
@@ -16,7 +17,11 @@ from minebash import world
 class MineBash:
     def __init__(self, wpaths=None, colours=None, biomes=None):
         self.win = mbwindow.MBWindow()
-        self.map = orthomap.OrthoMap(colours, biomes)
+        self.map = orthomap.OrthoMap(None, colours, biomes).set_workers(0).set_cache(cache.RegionCache())
+        instrument.add_sink(instrument.PrintSink())
+        instrument.add_sink(self.win)
+        # one pool of worker processes for all renders, started before any render threads
+        self.pool = self.map._get_pool()
 
         if wpaths:
             for wpath in wpaths.split(','):
@@ -26,35 +31,51 @@ class MineBash:
         self.win.save.triggered.connect(self.save)
         self.win.copybtn.triggered.connect(self.copy)
         self.win.pastebtn.triggered.connect(self.paste)
+        self.win.tabs.currentChanged.connect(self._tab_changed)
 
 
+    def close(self):
+        """Stop the worker processes, when the application quits."""
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+    
+    
     def save(self):
         """Save merged data to the current world, overwriting it (for now)."""
         tab = self.win.tabs.currentWidget()
         
+        # don't read from regions while they are being rewritten
+        self._cancel_renders(tab)
+        for renderer in list(tab.renderers):
+            renderer.wait()
+        
         # combine merged chunks from all worlds
         newchunks = {}
-        for mworld in set(wld for wld, mchunk in tab.merged.itervalues()):
+        for mworld in set(wld for wld, coords in tab.merged.itervalues()):
             # get chunks from original world, using original chunk coordinates
-            chunks = mworld.get_chunks(set(mchunk.coords for wld, mchunk in tab.merged.itervalues() if wld == mworld), raw=True)
+            chunks = mworld.get_chunks(set(coords for wld, coords in tab.merged.itervalues() if wld == mworld), raw=True)
             # place them in newchunks dict by their new coords
-            newchunks.update({(cx, cz): chunks[mchunk.coords] for (cx, cz), (wld, mchunk) in tab.merged.iteritems()})
+            newchunks.update({(cx, cz): chunks[coords] for (cx, cz), (wld, coords) in tab.merged.iteritems()
+                              if wld == mworld and coords in chunks})
         
         regionlist = set((cx / world.RSIZE, cz / world.RSIZE) for cx, cz in newchunks.iterkeys())
         for rnum, (rx, rz) in enumerate(regionlist):
             # load existing region, or create a new one
-            print 'saving region {0} of {1}:'.format(rnum + 1, len(regionlist), (rx, rz))
+            instrument.message('saving region {0} of {1}: {2}'.format(rnum + 1, len(regionlist), (rx, rz)))
+            instrument.progress('regions', rnum, len(regionlist), region=(rx, rz))
             region = tab.world.get_region((rx, rz))
             if not region:
-                print 'creating new region'
-                region = world.Region(tab.world.path, (rx, rz)) # assumes Anvil for now
+                instrument.message('creating new region')
+                region = world.Region(tab.world.path, (rx, rz), tab.world.anvil)
             
             # save, using new chunks that are in this region
             region.save({(cx % world.RSIZE, cz % world.RSIZE): chunk for (cx, cz), chunk in newchunks.iteritems()
                          if (cx / world.RSIZE, cz / world.RSIZE) == (rx, rz)})
+        instrument.progress('regions', len(regionlist), len(regionlist))
         
-        tab.merged = {}
-        self._draw_map(tab, refresh=1, whitelist=newchunks.keys())
+        tab.clear_merges()
+        self._draw_map(tab, whitelist=newchunks.keys())
     
     
     def open(self):
@@ -63,7 +84,7 @@ class MineBash:
         if os.path.exists(os.path.join(wpath, 'level.dat')):
             self._add_tab(wpath)
         else:
-            print 'Not a world dir!'
+            instrument.warning('Not a world dir!')
             
             
     def copy(self):
@@ -79,15 +100,16 @@ class MineBash:
             
             
     def paste(self):
-        """Creates pixmaps of the copied chunks from the copy tab, creates a pasted selection
-        and sends it to the paste tab."""
+        """Creates a pasted selection of the copied chunks from the copy tab in the current tab,
+        and draws its map from the source world."""
         ctab = self.win.cliptab
         ptab = self.win.tabs.currentWidget()
         
-        if ctab is not None:
-            # add pasted chunks to this view and draw pixmaps for these chunks
-            ptab.paste_chunks(ctab)
-            self._draw_map(ptab, paste_only=1)
+        if ctab is not None and ctab.world.anvil != ptab.world.anvil:
+            instrument.warning("Can't paste chunks between McRegion and Anvil worlds; convert the McRegion world first.")
+        elif ctab is not None:
+            # add pasted chunks to this view and draw their map, normally from the cache
+            self._draw_layer(ptab, ptab.paste_chunks(ctab))
             self.win.update_toolbar()
             
             
@@ -95,99 +117,151 @@ class MineBash:
         """Adds a new tab to the window, with the world located at wpath."""
         tab = mbworldtab.MBWorldTab(self.win, world.World(wpath), world.RSIZE, world.CSIZE)
 
-        self._draw_map(tab)
-        tab.generate.clicked.connect(lambda: self._draw_map(tab, refresh=1))
-        tab.biomecheck.stateChanged.connect(lambda: self._draw_map(tab))
+        tab.generate.clicked.connect(lambda: self._draw_map(tab, refresh=True))
+        tab.stop.clicked.connect(lambda: self._cancel_renders(tab))
+        tab.biomecheck.stateChanged.connect(lambda: tab.scene.update())
+        tab.view.viewchanged.connect(lambda: self._update_tiles(tab))
 
         self.win.tabs.addTab(tab, tab.world.name)
         self.win.tabs.setCurrentWidget(tab)
+        self._draw_map(tab)
         
         
-    def _draw_map(self, tab, refresh=False, whitelist=None, paste_only=False):
-        """Gets images of all the chunks in the current tab's world,
-        as well as any pasted or merged in, and adds their pixmaps to the view.
-        Takes an optional chunk whitelist."""
-        if refresh:
-            tab.chunks = {}
-
-        biomes = tab.biomecheck.isChecked()
-            
-        if not paste_only:
-            # redraw all chunks on the map that need redrawing (regenerating image cache if specified)
-            print 'drawing map chunks'
-            for (cx, cz), pixmap in self._get_chunk_pixmaps(tab.world, biomes, refresh, whitelist).iteritems():
-                if (cx, cz) not in tab.chunks:
-                    tab.chunks[cx, cz] = mbmapchunk.MBMapChunk(tab, (cx, cz), tab.csize)
-                    tab.chunks[cx, cz].setPos(cx * tab.csize, cz * tab.csize)
-                    tab.scene.addItem(tab.chunks[cx, cz])
-                tab.chunks[cx, cz].setPixmap(pixmap)
-        
-            # redraw merged chunks, if any, from each of their original worlds
-            if tab.merged and not paste_only:
-                print 'redrawing merged chunks'
-                
-                # merged chunks are indexed by coords in current tab
-                # but images must be generated using coords from original world
-                for mworld in set(wld for wld, chunk in tab.merged.itervalues()):
-                    chunklist, mchunks = zip(*((chunk.coords, chunk) for wld, chunk in tab.merged.itervalues() if wld == mworld))
-                    # draw pixmaps for merged chunks from this world, using their original coords
-                    pixmaps = self._get_chunk_pixmaps(mworld, biomes, refresh, chunklist)
-                    for chunk in mchunks:
-                        chunk.setPixmap(pixmaps[chunk.coords])
-                
-        # redraw pasted selection, if any, from its original world
-        if tab.paste:
-            print 'redrawing pasted chunks from', tab.paste.world.path
+    def _draw_map(self, tab, refresh=False, whitelist=None):
+        """Starts drawing the visible part of a tab's world, as well as any chunks pasted or merged in,
+        in the background. Tiles already loaded are redrawn, or only those of regions containing chunks
+        in an optional whitelist; the rest of the world is drawn as it comes into view."""
+        self._cancel_renders(tab)
+        instrument.message('drawing map')
+        
+        # re-read region headers, to find chunks and regions that have changed since the last draw
+        regions = None if whitelist is None else set((cx / world.RSIZE, cz / world.RSIZE) for cx, cz in whitelist)
+        tab.world.reload(regions)
+        tab.update_existing()
+        tab.update_bounds()
+        for coords, tile in tab.tiles.items():
+            if coords not in tab.world.regions:
+                tab.remove_tile(coords)
+            elif regions is None or coords in regions:
+                tile.stale = True
+        self._update_tiles(tab, refresh)
+        
+        # redraw merged and pasted selections, if any, from their original worlds
+        for layer in tab.merges + ([tab.paste] if tab.paste else []):
+            self._draw_layer(tab, layer, refresh)
+        
+        
+    def _draw_layer(self, tab, layer, refresh=False):
+        """Starts drawing a pasted or merged selection in the background, from renders of its source regions."""
+        instrument.message('drawing {0} chunks from {1}'.format(len(layer.chunks), layer.world.name))
+        self._render(tab, layer.world, layer.get_regions(), refresh, layer.set_region_images)
+        
+        
+    def _update_tiles(self, tab, refresh=False):
+        """Load the tiles of regions in and around the visible part of a tab's view, reduced to suit its zoom,
+        and unload tiles that are well out of view, so that memory use follows the view rather than the size
+        of the world. Tiles that are missing, stale or at the wrong level of detail are drawn in the background,
+        replacing any tile render already in progress."""
+        rbsize = world.RSIZE * world.CSIZE
+        rect = tab.view.visible_rect()
+        factor = tab.view.get_factor()
+        w, n = int(math.floor(rect.left() / rbsize)) - 1, int(math.floor(rect.top() / rbsize)) - 1
+        e, s = int(math.floor(rect.right() / rbsize)) + 1, int(math.floor(rect.bottom() / rbsize)) + 1
+        
+        # keep an extra ring of tiles, so that scrolling back and forth doesn't keep reloading them
+        for rx, rz in tab.tiles.keys():
+            if not (w - 1 <= rx <= e + 1 and n - 1 <= rz <= s + 1):
+                tab.remove_tile((rx, rz))
+        
+        for renderer in tab.renderers:
+            if renderer.tiles:
+                renderer.cancel()
+        regions = [region for (rx, rz), region in tab.world.regions.iteritems() if w <= rx <= e and n <= rz <= s
+                   and ((rx, rz) not in tab.tiles or tab.tiles[rx, rz].stale or tab.tiles[rx, rz].factor != factor)]
+        if regions:
+            self._render(tab, tab.world, regions, refresh,
+                         lambda coords, images: tab.set_tile(coords, self._get_pixmaps(images), factor), factor, tiles=True)
+        
+        
+    def _render(self, tab, wld, regions, refresh, callback, factor=1, tiles=False):
+        """Render regions of a world in a background thread, nearest to the centre of the tab's view first,
+        reduced by an optional factor. As each region is finished, its coords and a dict of its images
+        are passed to callback on the main thread. Renders of tiles are marked, so they can be replaced."""
+        types = ('block', 'biome') if wld.anvil else ('block',)
+        renderer = mbrenderer.MBRenderer(self.map, self._order_regions(tab, regions), types, refresh, factor, self.pool, tab)
+        renderer.job = wld, refresh, callback, factor
+        renderer.tiles = tiles
+        renderer.keep = False # whether to resume the remaining regions when the tab is shown again
+        renderer.rendered.connect(lambda coords, images: self._region_rendered(tab, coords, images, callback))
+        renderer.finished.connect(lambda: self._render_finished(tab, renderer))
+        
+        if not tab.renderers:
+            tab.progress = [0, 0]
+        tab.progress[1] += len(renderer.regions)
+        tab.renderers.append(renderer)
+        tab.stop.setEnabled(1)
+        renderer.start()
+        
+        
+    def _region_rendered(self, tab, coords, images, callback):
+        """Receives a rendered region from a background thread, and passes its images on."""
+        callback(coords, images)
+        tab.progress[0] += 1
+        if tab is self.win.tabs.currentWidget():
+            instrument.progress('regions', tab.progress[0], tab.progress[1], region=coords)
+        
+        
+    def _render_finished(self, tab, renderer):
+        """Clean up after a background render, keeping any unfinished regions to resume later if needed."""
+        tab.renderers.remove(renderer)
+        if renderer.cancelled and renderer.keep and renderer.remaining():
+            tab.pending.append((renderer.remaining(),) + renderer.job)
+        if not tab.renderers:
+            tab.stop.setEnabled(0)
+            if tab is self.win.tabs.currentWidget():
+                instrument.progress('regions', tab.progress[1], tab.progress[1])
+                if not tab.pending:
+                    instrument.message('done.')
+        
+        
+    def _cancel_renders(self, tab, keep=False):
+        """Cancel any background renders in a tab. If keep is true, their unfinished regions
+        will be rendered when the tab is next shown; otherwise any such regions are discarded.
+        Tile renders are never kept, since the tiles needed are worked out again when the tab is shown."""
+        for renderer in tab.renderers:
+            renderer.keep = keep and not renderer.tiles
+            renderer.cancel()
+        if not keep:
+            tab.pending = []
             
-            for (cx, cz), pixmap in self._get_chunk_pixmaps(tab.paste.world, biomes, refresh, tab.paste.chunks.keys()).iteritems():
-                tab.paste.chunks[cx, cz].setPixmap(pixmap)
-                    
-        print 'done.'
-        print
-        
-        
-    def _get_chunk_pixmaps(self, wld, biomes=False, refresh=False, whitelist=None):
-        """Gets images of each region and chops them into images of all chunks in the region.
-        Returns images as pixmaps. Optionally adds a biome overlay first."""
-        pixmaps = {}
-        regions = wld.get_region_list(whitelist)
-        for rnum, (rx, rz) in enumerate(regions):
-            print 'mapping {0} region {1} of {2}'.format(wld.name, rnum + 1, len(regions))
-            img = self._get_region_image(wld, (rx, rz), 'block', refresh)
-            if biomes:
-                img = Image.blend(img, self._get_region_image(wld, (rx, rz), 'biome', refresh), 0.5)
             
-            pixmaps.update({(rx * world.RSIZE + cx, rz * world.RSIZE + cz):
-                                QtGui.QPixmap.fromImage(QtGui.QImage(
-                                    img.crop((cx * world.CSIZE, cz * world.CSIZE, (cx + 1) * world.CSIZE, (cz + 1) * world.CSIZE)).tostring('raw', 'BGRA'),
-                                    world.CSIZE, world.CSIZE, QtGui.QImage.Format_ARGB32))
-                                for cx, cz in wld.get_region_chunk_list((rx, rz), whitelist)})
-        return pixmaps
+    def _tab_changed(self):
+        """Pause rendering in tabs that are no longer visible, and resume it in the current tab."""
+        current = self.win.tabs.currentWidget()
+        for index in range(self.win.tabs.count()):
+            tab = self.win.tabs.widget(index)
+            if tab is not current:
+                self._cancel_renders(tab, keep=True)
+        if current is not None:
+            pending, current.pending = current.pending, []
+            for regions, wld, refresh, callback, factor in pending:
+                self._render(current, wld, regions, refresh, callback, factor)
+            self._update_tiles(current)
             
             
-    def _get_region_image(self, wld, (rx, rz), type='block', refresh=False, whitelist=None):
-        """Returns an image of a region. Will use cached images if available, unless refresh specified.
-        Caches images in a subdirectory for the current world."""
-        if type not in ('block', 'biome', 'height'):
-            type = 'block'
-        
-        cachepath = os.path.join(os.getcwd(), 'cache', wld.name)
-        if not os.path.exists(cachepath):
-            os.makedirs(cachepath)
-        path = os.path.join(cachepath, '{0}_{1}.{2}.png'.format(type, rx, rz))
-        
-        if os.path.exists(path) and not refresh:
-            # use cached region image
-            img = Image.open(path)
-            print 'found', path
-        else:
-            # draw a new region image and cache it
-            print 'preparing to draw {0} map at region {1}'.format(type, (rx, rz))
-            img = self.map.draw_region(wld, (rx, rz), type)
-            img.save(path)
-            print 'cached', path
-
-        return img
+    def _order_regions(self, tab, regions):
+        """Sort regions by the distance of their centres from the centre of the tab's view."""
+        centre = tab.view.mapToScene(tab.view.viewport().rect().center())
+        rbsize = world.RSIZE * world.CSIZE
+        return sorted(regions, key=lambda region: ((region.coords[0] + 0.5) * rbsize - centre.x()) ** 2
+                                                  + ((region.coords[1] + 0.5) * rbsize - centre.y()) ** 2)
+        
+        
+    def _get_pixmaps(self, images):
+        """Converts a dict of images to a dict of pixmaps, with the same keys."""
+        return {type: QtGui.QPixmap.fromImage(QtGui.QImage(
+                    img.tobytes('raw', 'BGRA'), img.size[0], img.size[1], QtGui.QImage.Format_ARGB32))
+                for type, img in images.iteritems()}
     
 
 
@@ -201,6 +275,8 @@ if __name__ == '__main__':
     args = argp.parse_args()
     
     app = QtGui.QApplication(sys.argv)
-    MineBash(args.world, args.colours, args.biomes)
-    sys.exit(app.exec_())
+    minebash = MineBash(args.world, args.colours, args.biomes)
+    status = app.exec_()
+    minebash.close()
+    sys.exit(status)
 
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+from PIL import Image
+
+import instrument
+import util
+import world
+
+
+class CacheStore:
+    """A store of raw binary tiles, packed end to end in a single data file
+    and indexed by key. The data file is memory-mapped for each read, so that threads don't share a mapping
+    and it is never held open while the file is replaced.
+    The data file is kept within maxbytes, by evicting the least recently used tiles and compacting it.
+    A lock file allows several processes (e.g. the GUI and the CLI) to share the store."""
+    def __init__(self, path=None, maxbytes=1 << 30):
+        self.path = path or os.path.join(os.getcwd(), 'cache')
+        self.maxbytes = maxbytes
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.indexpath = os.path.join(self.path, 'index.json')
+        self.datapath = os.path.join(self.path, 'tiles.dat')
+        self.lockpath = os.path.join(self.path, 'lock')
+
+        self.index = {'end': 0, 'tiles': {}}
+        self.indexstamp = None
+        self.touched = {} # access times of tiles read since the index was last written
+
+
+    def get(self, key):
+        """Returns the (info, data) stored under a key, or None if it isn't in the store."""
+        with self._lock(False):
+            self._load_index()
+            if key not in self.index['tiles']:
+                return None
+            offset, length, atime, info = self.index['tiles'][key]
+            data = self._read_data([(offset, length)])[0]
+        self.touched[key] = time.time()
+        return info, data
+
+
+    def put(self, key, data, info=None):
+        """Store data under a key, along with a small JSON-serializable info value.
+        Evicts the least recently used tiles first if the store would grow past its size limit."""
+        with self._lock(True):
+            self._load_index()
+            self.index['tiles'].pop(key, None)
+            self._evict(len(data))
+            offset = self.index['end']
+            with open(self.datapath, 'ab') as dfile:
+                dfile.seek(offset)
+                dfile.truncate()
+                dfile.write(data)
+            self.index['end'] = offset + len(data)
+            self.index['tiles'][key] = [offset, len(data), time.time(), info]
+            self._save_index()
+
+
+    def flush(self):
+        """Write the access times of tiles read since the index was last written,
+        so that reads count towards keeping tiles in the store in other processes and later runs."""
+        if not self.touched:
+            return
+        with self._lock(True):
+            self._load_index()
+            self._merge_touches()
+            self._save_index()
+
+
+    def _merge_touches(self):
+        tiles = self.index['tiles']
+        for key, atime in self.touched.iteritems():
+            if key in tiles:
+                tiles[key][2] = max(tiles[key][2], atime)
+        self.touched = {}
+
+
+    def _evict(self, space=0):
+        """Drop least recently used tiles until there is room for a number of bytes more within
+        the size limit, then compact the data file if appending them would take it past the limit."""
+        self._merge_touches()
+        tiles = self.index['tiles']
+        live = sum(length for offset, length, atime, info in tiles.itervalues())
+        for key in sorted(tiles, key=lambda key: tiles[key][2]):
+            if live + space <= self.maxbytes:
+                break
+            live -= tiles.pop(key)[1]
+
+        if self.index['end'] + space > self.maxbytes and live < self.index['end']:
+            self._compact()
+
+
+    def _compact(self):
+        """Rewrite the data file with only the tiles still in the index, replacing the old one.
+        Must be called with the exclusive lock held, so that no reader has the old file mapped."""
+        tiles = self.index['tiles']
+        keys = sorted(tiles, key=lambda key: tiles[key][0])
+        temppath = self.datapath + '.tmp'
+        offset = 0
+        with open(temppath, 'wb') as dfile:
+            for key, data in zip(keys, self._read_data([tiles[key][:2] for key in keys])):
+                dfile.write(data)
+                tiles[key][0] = offset
+                offset += len(data)
+        util.replace_file(temppath, self.datapath)
+        self.index['end'] = offset
+
+
+    def _read_data(self, spans):
+        """Returns the data at a list of (offset, length) spans of the data file, read through
+        a memory map that is closed again before returning."""
+        if not spans:
+            return []
+        with open(self.datapath, 'rb') as dfile:
+            mapped = mmap.mmap(dfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return [mapped[offset:offset + length] for offset, length in spans]
+        finally:
+            mapped.close()
+
+
+    def _load_index(self):
+        """Re-read the index, if another process has changed it since it was last read."""
+        if not os.path.exists(self.indexpath):
+            return
+        stat = os.stat(self.indexpath)
+        stamp = stat.st_mtime, stat.st_size, stat.st_ino
+        if stamp != self.indexstamp:
+            with open(self.indexpath, 'rb') as ifile:
+                self.index = json.load(ifile)
+            self.indexstamp = stamp
+
+
+    def _save_index(self):
+        util.write_json(self.indexpath, self.index)
+        self.indexstamp = None
+
+
+    def _lock(self, exclusive):
+        return util.FileLock(self.lockpath, exclusive)
+
+
+
+class RegionCache:
+    """A cache of rendered region images, stored as raw RGBA tiles in a CacheStore.
+    Images are keyed by the absolute world path, region coordinates and render parameters.
+    The header mtime of each chunk is stored alongside each image, so that only chunks
+    modified since the image was drawn need to be redrawn and patched into it."""
+    def __init__(self, path=None, maxbytes=1 << 30):
+        self.store = CacheStore(path, maxbytes)
+
+
+    def get_region_image(self, mapobj, region, type='block', refresh=False):
+        """Returns an image of a region, drawn with the given map.
+        Uses the cached image if available, redrawing any chunks whose mtime has changed,
+        or redraws the whole region if refresh is specified."""
+        return self.get_region_layers(mapobj, region, (type,), refresh)[type]
+
+
+    def get_region_layers(self, mapobj, region, types=('block',), refresh=False):
+        """Returns a dict of images of several types of map of a region, indexed by type.
+        Each type is cached separately; any that are missing or out of date are drawn
+        together, so that each chunk that needs drawing is only decoded once."""
+        region.reload()
+        mtimes = region.get_mtimes()
+
+        images = {}
+        missing = []
+        changed, removed = set(), set()
+        for type in types:
+            cached = None if refresh else self.store.get(self._get_key(mapobj, region, type))
+            if cached is None:
+                instrument.count('cache_misses')
+                missing.append(type)
+            else:
+                instrument.count('cache_hits')
+                (width, height), data = cached
+                images[type] = Image.frombuffer('RGBA', (width, height), data[4096:], 'raw', 'RGBA', 0, 1).copy()
+                oldmtimes = self._unpack_mtimes(data[:4096])
+                changed.update(coords for coords, mtime in mtimes.iteritems() if oldmtimes.get(coords) != mtime)
+                removed.update(coords for coords in oldmtimes if coords not in mtimes)
+
+        stale = [type for type in images if changed or removed]
+        if missing:
+            instrument.message('drawing {0} map at region {1}'.format('/'.join(missing), region.coords))
+            images.update(mapobj._generate_region_layers(region, missing))
+        if stale:
+            instrument.message('updating {0} of {1} chunks in {2} map at region {3}'.format(
+                len(changed) + len(removed), len(mtimes), '/'.join(stale), region.coords))
+            instrument.count('chunks_redrawn', len(changed))
+            self._patch_images(mapobj, region, dict((type, images[type]) for type in stale), changed, removed)
+
+        for type in missing + stale:
+            self.store.put(self._get_key(mapobj, region, type), self._pack_mtimes(mtimes) + images[type].tobytes(),
+                           images[type].size)
+        self.store.flush() # record the use of tiles that were only read
+        return images
+
+
+    def _patch_images(self, mapobj, region, images, changed, removed):
+        """Draw only the changed chunks of a region, and paste them into existing images
+        of each type. Chunks that have been removed are cleared."""
+        rx, rz = region.coords
+        csize = mapobj.csize
+        if changed:
+            patches = mapobj._generate_region_layers(region, images.keys(),
+                chunks=set((rx * world.RSIZE + cx, rz * world.RSIZE + cz) for cx, cz in changed))
+            for type, image in images.iteritems():
+                for cx, cz in changed:
+                    box = (cx * csize, cz * csize, (cx + 1) * csize, (cz + 1) * csize)
+                    image.paste(patches[type].crop(box), box)
+        for image in images.itervalues():
+            for cx, cz in removed:
+                image.paste((0, 0, 0, 0), (cx * csize, cz * csize, (cx + 1) * csize, (cz + 1) * csize))
+
+
+    def _get_key(self, mapobj, region, type):
+        """Returns the store key for an image of a region drawn with a given map and type."""
+        params = (os.path.abspath(region.worldpath), region.coords, type) + mapobj.get_render_params()
+        return hashlib.sha1(repr(params)).hexdigest()
+
+
+    def _unpack_mtimes(self, data):
+        """Unpack a table of chunk mtimes, in the same layout as a region header's mtime table.
+        Chunks that are not present are stored with an mtime of -1."""
+        mtimes = struct.unpack('>1024i', data)
+        return {(cx, cz): mtimes[cx + cz * world.RSIZE]
+                for cz in range(world.RSIZE) for cx in range(world.RSIZE) if mtimes[cx + cz * world.RSIZE] != -1}
+
+
+    def _pack_mtimes(self, mtimes):
+        table = [mtimes.get((cx, cz), -1) for cz in range(world.RSIZE) for cx in range(world.RSIZE)]
+        return struct.pack('>1024i', *table)
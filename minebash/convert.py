@@ -0,0 +1,122 @@
+import os
+import shutil
+import zlib
+
+import numpy
+
+import instrument
+import nbt
+import util
+import world
+
+
+ANVIL_VERSION = 19133 # level.dat version of Anvil worlds; McRegion worlds are 19132
+UNKNOWN_BIOME = 255 # biomes are filled in by the game for columns set to this
+
+
+class WorldConverter(util.Parallel):
+    """Converts a McRegion world into a new Anvil world, or in place, alongside the old region files.
+    Each chunk's XZY block, data and light arrays are reshaped into YZX sections, leaving out sections with
+    no blocks in them; the heightmap is carried over, and biomes are left for the game to fill in.
+    Regions are converted in parallel if there are several workers, each written out as soon as it is done.
+    Only the overworld's regions are converted; other files are copied as they are, apart from the
+    version in level.dat."""
+    def __init__(self, wld, destpath):
+        self.world = wld
+        self.destpath = destpath
+
+
+    def convert(self):
+        """Convert the world, and returns the converted world."""
+        if self.world.anvil:
+            raise ValueError('{0} is already an Anvil world'.format(self.world.name))
+        with instrument.operation('convert'):
+            self._copy_files()
+            jobs = [(region, self.destpath) for coords, region in sorted(self.world.get_regions().iteritems())]
+            for rnum, ((rx, rz), converted) in enumerate(util.imap_jobs(_convert_region, jobs, self.workers)):
+                instrument.progress('regions', rnum + 1, len(jobs), region=(rx, rz))
+                instrument.count('chunks_converted', converted)
+        instrument.message('converted {0} regions to {1}'.format(len(jobs), self.destpath))
+        return world.World(self.destpath)
+
+
+    def _copy_files(self):
+        """Copy everything but the region files to the new world, and mark its level.dat as Anvil."""
+        if os.path.abspath(self.destpath) != os.path.abspath(self.world.path):
+            if not os.path.exists(self.destpath):
+                os.makedirs(self.destpath)
+            for name in os.listdir(self.world.path):
+                if name == 'region':
+                    continue
+                srcpath, destpath = os.path.join(self.world.path, name), os.path.join(self.destpath, name)
+                if os.path.isdir(srcpath):
+                    if os.path.exists(destpath):
+                        shutil.rmtree(destpath)
+                    shutil.copytree(srcpath, destpath)
+                else:
+                    shutil.copy2(srcpath, destpath)
+
+        levelpath = os.path.join(self.destpath, 'level.dat')
+        if os.path.exists(levelpath) and os.path.getsize(levelpath):
+            tags = nbt.NBTReader().from_file(levelpath)
+            data = tags[0][2][0][2]
+            version = ('Integer', 'version', ANVIL_VERSION)
+            for i, tag in enumerate(data):
+                if tag[1] == 'version':
+                    data[i] = version
+                    break
+            else:
+                data.append(version)
+            nbt.NBTWriter().to_file(levelpath, tags)
+
+
+
+def convert_chunk(chunk):
+    """Returns the NBT data of an Anvil chunk converted from a McRegion chunk."""
+    blocks = chunk.get_data('block') # x, z, y
+    arrays = [('Blocks', blocks), ('Data', chunk.get_data('blockdata'))] + [
+        (tagname, _unpack_nibbles(chunk.find_tag(tagname), chunk.cheight)) for tagname in ('SkyLight', 'BlockLight')]
+
+    sections = []
+    for s in range(chunk.cheight / world.SECHEIGHT):
+        ys = slice(s * world.SECHEIGHT, (s + 1) * world.SECHEIGHT)
+        if not blocks[:, :, ys].any():
+            continue
+        section = [('Byte', 'Y', s)]
+        for tagname, array in arrays:
+            # sections are stored in YZX order
+            values = array[:, :, ys].transpose(2, 1, 0).flatten()
+            values = values if tagname == 'Blocks' else _pack_nibbles(values)
+            section.append(('Byte Array', tagname, tuple(values.astype(numpy.ubyte).tolist())))
+        sections.append(('Compound', '', section))
+
+    # the old heightmap is a byte per column in ZX order, the same as the new one
+    tags = [tag for tag in chunk.tags if tag[1] not in ('Blocks', 'Data', 'SkyLight', 'BlockLight', 'HeightMap')]
+    tags.extend([('List', 'Sections', sections),
+                 ('Integer Array', 'HeightMap', tuple(chunk.find_tag('HeightMap'))),
+                 ('Byte Array', 'Biomes', (UNKNOWN_BIOME,) * (world.CSIZE * world.CSIZE))])
+    return nbt.NBTWriter().to_string([('Compound', '', [('Compound', 'Level', tags)])])
+
+
+def _convert_region((region, destpath)):
+    """Convert the chunks of a McRegion region, and write them to an Anvil region in a world directory,
+    replacing any chunks already in it. Returns the region's coords and the number of chunks converted."""
+    chunks = {}
+    for (cx, cz), chunk in region.iter_chunks():
+        if chunk is None:
+            continue # unreadable chunks have already been warned about
+        chunks[cx, cz] = region.chunkinfo[cx, cz]['mtime'], zlib.compress(convert_chunk(chunk))
+    dest = world.Region(destpath, region.coords, True)
+    dest.save(chunks, removed=dest.chunkinfo.keys())
+    return region.coords, len(chunks)
+
+
+def _unpack_nibbles(data, height):
+    """Returns an (x, z, y) array of 4-bit values in XZY order, packed two to a byte, the first in the low bits."""
+    data = numpy.array(data, numpy.ubyte)
+    return numpy.dstack((data & 15, data >> 4)).reshape((world.CSIZE, world.CSIZE, height))
+
+
+def _pack_nibbles(values):
+    """Pack a flat array of 4-bit values two to a byte, the first in the low bits."""
+    return (values[0::2] & 15) | (values[1::2] & 15) << 4
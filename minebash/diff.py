@@ -0,0 +1,153 @@
+import hashlib
+import itertools
+
+import numpy
+from PIL import Image
+
+import instrument
+import util
+import world
+
+
+# colours of change maps: unchanged chunks, chunks only in the new or old world, chunks whose data differs,
+# and (if blocks have been compared) changed chunks whose blocks are all the same, e.g. with new entities or light
+CHANGE_COLOURS = {'unchanged': (64, 64, 64), 'added': (0, 224, 0), 'removed': (224, 0, 0),
+                  'changed': (255, 160, 0), 'touched': (0, 128, 255)}
+
+
+class WorldDiff(util.Parallel):
+    """Finds the chunks that differ between two versions of a world, e.g. two backups, or a world and a copy
+    that chunks have been pasted into. Region headers are compared first: chunks present in only one world
+    have been added or removed, chunks with the same mtime and length are taken to be unchanged, and chunks
+    with different lengths have changed. Only the remaining chunks have their compressed data read and hashed,
+    in parallel if there are several workers. Blocks are only decoded and compared on request."""
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+        # sets of global chunk coordinates
+        self.added = set()
+        self.removed = set()
+        self.changed = set()
+        self.unchanged = 0 # only counted, since it is usually most of the world
+        self.blocks = {} # number of differing blocks in each changed chunk, if compared
+
+
+    def compare(self, whitelist=None):
+        """Compare the two worlds, within an optional whitelist of global chunk coordinates."""
+        with instrument.operation('diff'):
+            self.added, self.removed, self.changed, self.unchanged, self.blocks = set(), set(), set(), 0, {}
+            suspects = [] # (old region, new region, global coords of chunks to hash)
+            for rx, rz in sorted(set(self.old.regionlist) | set(self.new.regionlist)):
+                oldregion, newregion = self.old.get_region((rx, rz)), self.new.get_region((rx, rz))
+                oldinfo = oldregion.chunkinfo if oldregion else {}
+                newinfo = newregion.chunkinfo if newregion else {}
+                hashlist = set()
+                for cx, cz in set(oldinfo) | set(newinfo):
+                    coords = rx * world.RSIZE + cx, rz * world.RSIZE + cz
+                    if whitelist is not None and coords not in whitelist:
+                        continue
+                    if (cx, cz) not in oldinfo:
+                        self.added.add(coords)
+                    elif (cx, cz) not in newinfo:
+                        self.removed.add(coords)
+                    elif oldinfo[cx, cz]['sectorlength'] != newinfo[cx, cz]['sectorlength']:
+                        self.changed.add(coords)
+                    elif oldinfo[cx, cz]['mtime'] == newinfo[cx, cz]['mtime']:
+                        self.unchanged += 1
+                    else:
+                        hashlist.add(coords)
+                if hashlist:
+                    suspects.append((oldregion, newregion, hashlist))
+            instrument.message('{0} chunks differ by header; hashing {1} more in {2} regions'.format(
+                len(self.added) + len(self.removed) + len(self.changed), sum(len(chunks) for o, n, chunks in suspects), len(suspects)))
+
+            for rnum, (changed, unchanged) in enumerate(util.imap_jobs(_compare_region_hashes, suspects, self.workers)):
+                instrument.progress('regions', rnum + 1, len(suspects))
+                instrument.count('chunks_hashed', 2 * (len(changed) + unchanged))
+                self.changed.update(changed)
+                self.unchanged += unchanged
+        return self
+
+
+    def compare_blocks(self, chunks=None):
+        """Decode the changed chunks (or only those in a list) in both worlds, and count the blocks
+        that differ in each of them, by ID or data value. Chunks are read one window at a time."""
+        chunks = self.changed if chunks is None else set(chunks) & self.changed
+        with instrument.operation('diff_blocks'):
+            for cnum, (((cx, cz), oldchunk), (coords, newchunk)) in enumerate(itertools.izip(
+                    self.old.iter_chunks(chunks), self.new.iter_chunks(chunks))):
+                instrument.progress('chunks', cnum + 1, len(chunks))
+                if oldchunk is None or newchunk is None:
+                    continue # unreadable chunks have already been warned about
+                self.blocks[cx, cz] = _count_block_differences(oldchunk, newchunk)
+        return self
+
+
+    def report(self):
+        """Returns a text listing of the chunks that differ, with a summary line."""
+        lines = ['{0} chunks added, {1} removed, {2} changed, {3} unchanged'.format(
+            len(self.added), len(self.removed), len(self.changed), self.unchanged)]
+        rows = lambda (cx, cz): (cz, cx)
+        lines.extend('+ {0}, {1}'.format(cx, cz) for cx, cz in sorted(self.added, key=rows))
+        lines.extend('- {0}, {1}'.format(cx, cz) for cx, cz in sorted(self.removed, key=rows))
+        for cx, cz in sorted(self.changed, key=rows):
+            lines.append('~ {0}, {1}'.format(cx, cz) if (cx, cz) not in self.blocks else
+                         '~ {0}, {1}: {2} blocks'.format(cx, cz, self.blocks[cx, cz]))
+        return '\n'.join(lines)
+
+
+    def draw_map(self, imgpath):
+        """Draws a change map with one pixel per chunk, coloured by CHANGE_COLOURS,
+        covering every chunk in either world. Only region headers are read."""
+        regions = set(self.old.regionlist) | set(self.new.regionlist)
+        if not regions:
+            instrument.warning('no regions to draw')
+            return
+        rxs, rzs = zip(*regions)
+        rw, rn = min(rxs), min(rzs)
+        pixels = numpy.zeros(((max(rzs) + 1 - rn) * world.RSIZE, (max(rxs) + 1 - rw) * world.RSIZE, 4), numpy.uint8)
+
+        # chunks in either world are unchanged until shown otherwise
+        for wld in self.old, self.new:
+            for (rx, rz), region in wld.get_regions().iteritems():
+                bx, bz = (rx - rw) * world.RSIZE, (rz - rn) * world.RSIZE
+                pixels[bz:bz + world.RSIZE, bx:bx + world.RSIZE][region.get_mtime_table() >= 0] = \
+                    CHANGE_COLOURS['unchanged'] + (255,)
+        for name, chunks in ('added', self.added), ('removed', self.removed), ('changed', self.changed):
+            for cx, cz in chunks:
+                colour = 'touched' if name == 'changed' and self.blocks.get((cx, cz)) == 0 else name
+                pixels[cz - rn * world.RSIZE, cx - rw * world.RSIZE] = CHANGE_COLOURS[colour] + (255,)
+
+        zs, xs = numpy.nonzero(pixels[:, :, 3])
+        Image.fromarray(pixels[zs.min():zs.max() + 1, xs.min():xs.max() + 1], 'RGBA').save(imgpath)
+        instrument.message('saved change map to {0}'.format(imgpath))
+
+
+
+def _compare_region_hashes((oldregion, newregion, chunks)):
+    """Hash the compressed data of chunks in the same region of two worlds. Returns a list of global coords
+    of chunks whose data differs, and the number that are the same. Module-level so that it can be pickled."""
+    rx, rz = oldregion.coords
+    hashes = {coords: _hash_payload(payload) for coords, payload in oldregion.iter_chunks(chunks, payload='raw')}
+    changed = []
+    for (cx, cz), payload in newregion.iter_chunks(chunks, payload='raw'):
+        if _hash_payload(payload) is None or hashes.get((cx, cz)) != _hash_payload(payload):
+            changed.append((rx * world.RSIZE + cx, rz * world.RSIZE + cz))
+    return changed, len(chunks) - len(changed)
+
+
+def _hash_payload(payload):
+    """Returns a hash of the compressed data of a raw chunk, or None if it couldn't be read."""
+    if payload is not None:
+        mtime, data = payload
+        return hashlib.sha1(data).digest()
+
+
+def _count_block_differences(oldchunk, newchunk):
+    """Returns the number of blocks whose ID or data value differs between two versions of a chunk.
+    If their heights differ, non-air blocks above the shorter one count as different."""
+    old, new = [(chunk.get_data('block') << 4) | chunk.get_data('blockdata') for chunk in oldchunk, newchunk]
+    height = min(old.shape[2], new.shape[2])
+    return int((old[:, :, :height] != new[:, :, :height]).sum() +
+               (old[:, :, height:] > 0).sum() + (new[:, :, height:] > 0).sum())
@@ -0,0 +1,158 @@
+import json
+import os
+import zlib
+
+import instrument
+import nbt
+import util
+import world
+
+
+# tags recorded along with the type and position of each entity: sign text, spawner mobs, names, health,
+# and for lists such as a chest's Items, only their length
+ENTITY_FIELDS = ('CustomName', 'EntityId', 'Text1', 'Text2', 'Text3', 'Text4', 'Items', 'Health')
+KINDS = ('entity', 'tile')
+
+
+class EntityIndex(util.Parallel):
+    """An index of the entities (mobs, items, minecarts...) and tile entities (chests, signs, spawners...)
+    in a world, with the type, position and a few chosen fields of each. There is one small JSON file per region,
+    which also records the header mtime of each chunk, so that updating the index only reads chunks modified since.
+    Only the Entities and TileEntities lists are decoded from each chunk; the rest of its NBT data is skipped over.
+    Queries read only the index files, so they never open a region file."""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.indexpath = os.path.join(self.path, 'index.json')
+        self.lockpath = os.path.join(self.path, 'lock')
+
+        self.fields = ENTITY_FIELDS
+
+
+    def set_fields(self, fields):
+        """Set the names of the tags to record for each entity, if it has them."""
+        self.fields = tuple(fields)
+        return self
+
+
+    def update(self, wld, refresh=False):
+        """Bring the index up to date with a world, reading only chunks whose header mtime has changed
+        since it was last updated, unless refresh is specified or the fields to record have changed."""
+        settings = {'world': os.path.abspath(wld.path), 'fields': list(self.fields)}
+        with instrument.operation('index_entities'), util.FileLock(self.lockpath, True):
+            if refresh or self._load_json(self.indexpath) != settings:
+                for coords in self._get_indexed_regions():
+                    os.remove(self._get_path(coords))
+            for coords in set(self._get_indexed_regions()) - set(wld.regionlist):
+                os.remove(self._get_path(coords))
+
+            jobs = [(region, self._load_json(self._get_path(coords)), self.fields)
+                    for coords, region in sorted(wld.get_regions().iteritems())]
+            for rnum, ((rx, rz), entry, scanned) in enumerate(util.imap_jobs(_index_region, jobs, self.workers)):
+                instrument.progress('regions', rnum + 1, len(jobs), region=(rx, rz))
+                instrument.count('chunks_scanned', scanned)
+                if entry is not None:
+                    util.write_json(self._get_path((rx, rz)), entry)
+            util.write_json(self.indexpath, settings)
+        return self
+
+
+    def query(self, ids=None, box=None, ylimits=None, kind=None):
+        """Returns a list of the indexed entities with one of a list of IDs (e.g. 'Chest', 'MobSpawner', 'Zombie'),
+        within an inclusive bounding box (w, e, n, s) and range of heights (bottom, top) in blocks,
+        and of one of the KINDS, each of which is optional. Each entity is a dict of its 'kind', 'id',
+        'x', 'y' and 'z', and any of the recorded fields that it has."""
+        ids = set(ids) if ids is not None else None
+        rbsize = world.RSIZE * world.CSIZE
+        results = []
+        with instrument.operation('query_entities'), util.FileLock(self.lockpath, False):
+            for rx, rz in sorted(self._get_indexed_regions()):
+                if box is not None and not (box[0] < (rx + 1) * rbsize and rx * rbsize <= box[1] and
+                                            box[2] < (rz + 1) * rbsize and rz * rbsize <= box[3]):
+                    continue
+                for cx, cz, ekind, eid, x, y, z, fields in self._load_json(self._get_path((rx, rz)))['entities']:
+                    if ((ids is None or eid in ids) and (kind is None or ekind == kind) and
+                        (box is None or box[0] <= x < box[1] + 1 and box[2] <= z < box[3] + 1) and
+                        (ylimits is None or ylimits[0] <= y < ylimits[1] + 1)):
+                        entity = {'kind': ekind, 'id': eid, 'x': x, 'y': y, 'z': z}
+                        entity.update(fields)
+                        results.append(entity)
+        instrument.message('found {0} entities'.format(len(results)))
+        return results
+
+
+    def _get_indexed_regions(self):
+        """Returns a list of the coords of the regions in the index."""
+        return [(int(filename.split('.')[1]), int(filename.split('.')[2])) for filename in os.listdir(self.path)
+                if filename.startswith('r.') and filename.endswith('.json')]
+
+
+    def _get_path(self, (rx, rz)):
+        return os.path.join(self.path, 'r.{0}.{1}.json'.format(rx, rz))
+
+
+    def _load_json(self, path):
+        if os.path.exists(path):
+            with open(path, 'rb') as jfile:
+                return json.load(jfile)
+
+
+
+def _index_region((region, previous, fields)):
+    """Index the entities in a region, given its previous index entry or None. Entities in chunks whose
+    header mtime hasn't changed are kept; the rest are read from the chunks with a selective NBT scan.
+    Returns the region's coords, its new index entry (or None if nothing has changed), and the number of chunks scanned."""
+    rx, rz = region.coords
+    mtimes = region.get_mtimes()
+    oldmtimes = {(cx, cz): mtime for cx, cz, mtime in previous['mtimes']} if previous else {}
+    modified = set((cx, cz) for (cx, cz), mtime in mtimes.iteritems() if oldmtimes.get((cx, cz)) != mtime)
+    if previous and not modified and len(mtimes) == len(oldmtimes):
+        return region.coords, None, 0
+    entities = [entity for entity in previous['entities']
+                if (entity[0], entity[1]) in mtimes and (entity[0], entity[1]) not in modified] if previous else []
+
+    reader = nbt.NBTReader()
+    for (cx, cz), payload in region.iter_chunks(set((rx * world.RSIZE + cx, rz * world.RSIZE + cz) for cx, cz in modified),
+                                                payload='raw'):
+        data = None
+        if payload is not None:
+            try:
+                data = zlib.decompress(payload[1])
+            except zlib.error as error:
+                instrument.warning('zlib error with chunk {0}: {1}'.format((cx, cz), error))
+        if data is None:
+            del mtimes[cx, cz] # unreadable chunks are retried next time
+            continue
+        tags = reader.find_tags(data, ('Entities', 'TileEntities'))
+        for ekind, tagname in zip(KINDS, ('Entities', 'TileEntities')):
+            for type, name, compound in tags.get(tagname, []):
+                entities.append(_get_entity((cx, cz), ekind, dict((tag[1], tag) for tag in compound), fields))
+
+    entry = {'mtimes': [[cx, cz, mtime] for (cx, cz), mtime in sorted(mtimes.iteritems())], 'entities': entities}
+    return region.coords, entry, len(modified)
+
+
+def _get_entity((cx, cz), kind, tags, fields):
+    """Returns an index record of an entity, given a dict of its tags indexed by name:
+    [cx, cz, kind, id, x, y, z, dict of recorded fields]. Lists are recorded by their length."""
+    if kind == 'entity':
+        x, y, z = (tag[2] for tag in tags['Pos'][2]) if 'Pos' in tags else (None, None, None)
+    else:
+        x, y, z = (_signed(tags[name][2]) if name in tags else None for name in ('x', 'y', 'z'))
+    recorded = {}
+    for name in fields:
+        if name in tags:
+            type, name, payload = tags[name]
+            if type == 'List':
+                recorded[name] = len(payload)
+            elif type == 'String':
+                recorded[name] = payload.decode('utf-8', 'replace')
+            elif type not in ('Compound', 'Byte Array', 'Integer Array'):
+                recorded[name] = payload
+    return [cx, cz, kind, tags['id'][2].decode('utf-8', 'replace') if 'id' in tags else None, x, y, z, recorded]
+
+
+def _signed(value):
+    """Returns a 32-bit integer read as unsigned as a signed one."""
+    return value - (1 << 32) if value >= 1 << 31 else value
@@ -0,0 +1,182 @@
+import json
+import os
+
+import numpy
+from numpy.lib import format as npformat
+
+import instrument
+import util
+import world
+
+
+# types of data that can be exported: the dtype of each, and whether it has a value per block or per column
+EXPORT_TYPES = {'block': (numpy.uint16, True), 'blockdata': (numpy.uint8, True),
+                'skylight': (numpy.uint8, True), 'blocklight': (numpy.uint8, True),
+                'heightmap': (numpy.uint8, False), 'biome': (numpy.uint8, False)}
+MCREGION_TYPES = ('block', 'blockdata', 'heightmap')
+
+
+class ArrayExport(util.Parallel):
+    """Exports block data from a world as plain .npy arrays, one file per region and type, which can be
+    memory-mapped with numpy.load(path, mmap_mode='r') and sliced without decoding any NBT.
+    Per-block arrays have shape (512, 512, height), indexed [x, z, y] in blocks from the region's corner
+    and from the bottom of the exported range of heights; per-column arrays have shape (512, 512), indexed [x, z].
+    Missing chunks are left as zeros. An index records the header mtime of each exported chunk,
+    so that exporting again only rewrites chunks that have been modified since."""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.indexpath = os.path.join(self.path, 'index.json')
+        self.lockpath = os.path.join(self.path, 'lock')
+
+        self.types = ('block', 'blockdata', 'biome', 'heightmap')
+        self.ylimits = None
+        self.rect = None
+
+
+    def set_types(self, types):
+        """Set the types of data to export, from EXPORT_TYPES."""
+        for type in types:
+            if type not in EXPORT_TYPES:
+                raise ValueError('unknown type {0}; must be one of {1}'.format(type, ', '.join(sorted(EXPORT_TYPES))))
+        self.types = tuple(types)
+        return self
+
+
+    def set_slice(self, ylimits=None):
+        """Export only blocks within an inclusive (bottom, top) range of heights."""
+        self.ylimits = ylimits
+        return self
+
+
+    def set_rect(self, rect=None):
+        """Export only chunks within an inclusive rectangle (w, e, n, s) of global chunk coordinates."""
+        self.rect = rect
+        return self
+
+
+    def get_regions(self):
+        """Returns a list of the coords of the exported regions."""
+        return [tuple(entry['coords']) for entry in self._load_index()['regions'].itervalues()]
+
+
+    def load(self, (rx, rz), type='block'):
+        """Returns a read-only memory map of an exported array of a region."""
+        return numpy.load(self._get_path((rx, rz), type), mmap_mode='r')
+
+
+    def export(self, wld, refresh=False):
+        """Export the world, rewriting only chunks whose header mtime has changed since the last export
+        to this directory, unless refresh is specified or the export settings have changed."""
+        height = world.SECHEIGHT * world.SECTIONS if wld.anvil else world.CHEIGHT
+        bottom, top = self.ylimits or (0, height - 1)
+        ylimits = max(bottom, 0), min(top, height - 1)
+        types = self.types if wld.anvil else tuple(type for type in self.types if type in MCREGION_TYPES)
+        if types != self.types:
+            instrument.warning('McRegion worlds only have {0} data'.format(', '.join(MCREGION_TYPES)))
+
+        settings = {'world': os.path.abspath(wld.path), 'anvil': wld.anvil, 'types': list(types),
+                    'ylimits': list(ylimits), 'rect': list(self.rect) if self.rect else None}
+        with instrument.operation('export'), util.FileLock(self.lockpath, True):
+            index = self._load_index()
+            if refresh or index['settings'] != settings:
+                if index['regions'] and not refresh:
+                    instrument.message('export settings have changed; exporting all chunks again')
+                for entry in index['regions'].itervalues():
+                    self._remove_region(tuple(entry['coords']))
+                index = {'settings': settings, 'regions': {}}
+
+            # remove regions that are no longer in the world, or have no chunks in the rectangle
+            regions = {self._get_key(coords): region for coords, region in wld.get_regions().iteritems()
+                       if _get_export_mtimes(region, self.rect)}
+            for key in set(index['regions']) - set(regions):
+                self._remove_region(tuple(index['regions'].pop(key)['coords']))
+
+            jobs = [(region, self.path, types, ylimits, self.rect,
+                     {(cx, cz): mtime for cx, cz, mtime in index['regions'][key]['mtimes']} if key in index['regions'] else None)
+                    for key, region in sorted(regions.iteritems())]
+            for rnum, ((rx, rz), mtimes, written) in enumerate(util.imap_jobs(_export_region, jobs, self.workers)):
+                instrument.progress('regions', rnum + 1, len(jobs), region=(rx, rz))
+                instrument.count('chunks_exported', written)
+                index['regions'][self._get_key((rx, rz))] = {
+                    'coords': [rx, rz], 'mtimes': [[cx, cz, mtime] for (cx, cz), mtime in sorted(mtimes.iteritems())]}
+            util.write_json(self.indexpath, index)
+        instrument.message('exported {0} regions to {1}'.format(len(jobs), self.path))
+
+
+    def _get_key(self, (rx, rz)):
+        return 'r.{0}.{1}'.format(rx, rz)
+
+
+    def _get_path(self, (rx, rz), type):
+        return _get_array_path(self.path, (rx, rz), type)
+
+
+    def _remove_region(self, (rx, rz)):
+        for type in EXPORT_TYPES:
+            if os.path.exists(self._get_path((rx, rz), type)):
+                os.remove(self._get_path((rx, rz), type))
+
+
+    def _load_index(self):
+        if os.path.exists(self.indexpath):
+            with open(self.indexpath, 'rb') as ifile:
+                return json.load(ifile)
+        return {'settings': None, 'regions': {}}
+
+
+
+def _export_region((region, path, types, ylimits, rect, previous)):
+    """Write the chunks of a region that are new or modified since a previous export into its arrays,
+    given a dict of the mtimes of the chunks exported before, or None to export the region from scratch.
+    Chunks that have been removed are cleared. Returns the region's coords, a dict of the mtimes of the chunks
+    now exported, indexed by REGIONAL coords, and the number of chunks written."""
+    rx, rz = region.coords
+    mtimes = _get_export_mtimes(region, rect)
+    bsize = world.RSIZE * world.CSIZE
+    paths = {type: _get_array_path(path, (rx, rz), type) for type in types}
+    if previous is not None and not all(os.path.exists(apath) for apath in paths.itervalues()):
+        previous = None # some of the arrays are missing
+    previous = previous or {}
+    modified = [(cx, cz) for (cx, cz), mtime in mtimes.iteritems() if previous.get((cx, cz)) != mtime]
+    removed = set(previous) - set(mtimes)
+    if not modified and not removed and previous:
+        return region.coords, mtimes, 0
+
+    arrays = {}
+    for type, apath in paths.iteritems():
+        dtype, perblock = EXPORT_TYPES[type]
+        shape = (bsize, bsize, ylimits[1] - ylimits[0] + 1) if perblock else (bsize, bsize)
+        arrays[type] = npformat.open_memmap(apath, 'r+' if previous else 'w+', dtype, shape)
+
+    for cx, cz in removed:
+        for array in arrays.itervalues():
+            array[cx * world.CSIZE:(cx + 1) * world.CSIZE, cz * world.CSIZE:(cz + 1) * world.CSIZE] = 0
+    written = 0
+    for (cx, cz), chunk in region.iter_chunks(set((rx * world.RSIZE + cx, rz * world.RSIZE + cz) for cx, cz in modified)):
+        if chunk is None:
+            del mtimes[cx, cz] # unreadable chunks have already been warned about, and are retried next time
+            continue
+        for type, array in arrays.iteritems():
+            data = chunk.get_data(type, ylimits=ylimits)
+            if EXPORT_TYPES[type][1]:
+                data = data[:, :, ylimits[0]:ylimits[1] + 1]
+            array[cx * world.CSIZE:(cx + 1) * world.CSIZE, cz * world.CSIZE:(cz + 1) * world.CSIZE] = data
+        written += 1
+
+    for array in arrays.itervalues():
+        array.flush()
+    return region.coords, mtimes, written
+
+
+def _get_export_mtimes(region, rect=None):
+    """Returns a dict of the header mtimes of the chunks in a region within an optional inclusive rectangle
+    (w, e, n, s) of GLOBAL chunk coordinates, indexed by REGIONAL coords."""
+    rx, rz = region.coords
+    return {(cx, cz): mtime for (cx, cz), mtime in region.get_mtimes().iteritems()
+            if rect is None or (rect[0] <= rx * world.RSIZE + cx <= rect[1] and rect[2] <= rz * world.RSIZE + cz <= rect[3])}
+
+
+def _get_array_path(path, (rx, rz), type):
+    return os.path.join(path, 'r.{0}.{1}.{2}.npy'.format(rx, rz, type))
@@ -0,0 +1,226 @@
+"""Structured progress, timing and counter events.
+
+The rest of the package reports what it is doing through the functions here,
+which pass events on to any sinks that have been attached with add_sink.
+When no sinks are attached, every function returns immediately, so instrumentation
+costs next to nothing.
+
+Events are dicts with a 'type', a 'name' and a 'time', plus:
+    message   text messages, such as those that used to be printed
+    warning   problems that don't stop an operation, such as a corrupt chunk
+    progress  'done' and 'total' counts, plus any other details given
+    timer     the 'seconds' spent in one stage (read, decompress, parse, colour, paste, save...)
+    count     an 'amount' to add to a counter (bytes read, chunks decoded, cache hits...)
+    start/end the start and end of an operation; end events include its 'seconds'
+              and the process's 'peak_memory' in bytes, if it can be found
+"""
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
+
+
+_sinks = []
+
+
+def add_sink(sink):
+    """Attach a sink, which is any object with a handle(event) method. Returns the sink."""
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def is_active():
+    """Returns whether any sinks are attached."""
+    return bool(_sinks)
+
+
+def emit(type, name, **data):
+    """Send an event to all attached sinks."""
+    if _sinks:
+        data.update(type=type, name=name, time=time.time())
+        for sink in list(_sinks):
+            sink.handle(data)
+
+
+def message(text):
+    if _sinks:
+        emit('message', text)
+
+
+def warning(text):
+    if _sinks:
+        emit('warning', text)
+
+
+def progress(name, done, total, **data):
+    """Report that done out of total items (e.g. regions or chunks) have been processed."""
+    if _sinks:
+        emit('progress', name, done=done, total=total, **data)
+
+
+def count(name, amount=1):
+    """Add an amount to a named counter."""
+    if _sinks:
+        emit('count', name, amount=amount)
+
+
+def timer(stage):
+    """Returns a context manager that times a stage, for use in a with statement."""
+    return _Timer(stage) if _sinks else _null
+
+
+def operation(name):
+    """Returns a context manager that marks the start and end of an operation,
+    such as drawing a map, for use in a with statement."""
+    return _Operation(name) if _sinks else _null
+
+
+def replay(timers, counters):
+    """Emit the totals collected by a Summary elsewhere, such as in a worker process."""
+    for stage, (seconds, calls) in timers.iteritems():
+        emit('timer', stage, seconds=seconds, calls=calls)
+    for name, amount in counters.iteritems():
+        emit('count', name, amount=amount)
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process in bytes, or None if it can't be found."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on mac os, and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+class _Null:
+    def __enter__(self):
+        pass
+
+
+    def __exit__(self, *exc):
+        pass
+
+_null = _Null()
+
+
+
+class _Timer:
+    def __init__(self, stage):
+        self.stage = stage
+
+
+    def __enter__(self):
+        self.start = time.time()
+
+
+    def __exit__(self, *exc):
+        emit('timer', self.stage, seconds=time.time() - self.start)
+
+
+
+class _Operation:
+    def __init__(self, name):
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.time()
+        emit('start', self.name)
+
+
+    def __exit__(self, *exc):
+        emit('end', self.name, seconds=time.time() - self.start, peak_memory=peak_memory())
+
+
+
+class PrintSink:
+    """Prints messages and warnings to a file (stdout by default), as the package used to.
+    Progress is printed too if verbose is true."""
+    def __init__(self, file=None, verbose=False):
+        self.file = file or sys.stdout
+        self.verbose = verbose
+
+
+    def handle(self, event):
+        if event['type'] in ('message', 'warning'):
+            self.file.write('{0}{1}\n'.format('warning: ' if event['type'] == 'warning' else '', event['name']))
+        elif event['type'] == 'progress' and self.verbose:
+            self.file.write('{0} {1} of {2}\n'.format(event['name'], event['done'], event['total']))
+
+
+
+class Summary:
+    """Totals up timers and counters, and records each operation's duration and peak memory."""
+    def __init__(self):
+        self.timers = {} # total seconds and number of calls, indexed by stage
+        self.counters = {}
+        self.operations = []
+        self.warnings = 0
+
+
+    def handle(self, event):
+        type, name = event['type'], event['name']
+        if type == 'timer':
+            seconds, calls = self.timers.get(name, (0, 0))
+            self.timers[name] = seconds + event['seconds'], calls + event.get('calls', 1)
+        elif type == 'count':
+            self.counters[name] = self.counters.get(name, 0) + event['amount']
+        elif type == 'end':
+            self.operations.append({'name': name, 'seconds': event['seconds'], 'peak_memory': event['peak_memory']})
+        elif type == 'warning':
+            self.warnings += 1
+
+
+
+class TextSummary(Summary):
+    """A Summary that can be formatted as a table of text."""
+    def text(self):
+        lines = []
+        for op in self.operations:
+            memory = ', peak memory {0:.1f} MB'.format(op['peak_memory'] / 1048576.0) if op['peak_memory'] else ''
+            lines.append('{0}: {1:.2f}s{2}'.format(op['name'], op['seconds'], memory))
+        for stage, (seconds, calls) in sorted(self.timers.iteritems(), key=lambda (stage, (seconds, calls)): -seconds):
+            lines.append('  {0:<12} {1:>9.3f}s {2:>9} calls'.format(stage, seconds, calls))
+        for name, amount in sorted(self.counters.iteritems()):
+            lines.append('  {0:<24} {1:>12}'.format(name, amount))
+        if self.warnings:
+            lines.append('  {0} warnings'.format(self.warnings))
+        return '\n'.join(lines)
+
+
+
+class JSONExporter(Summary):
+    """A Summary that can be exported as JSON. If keep_events is true, every event is kept
+    and exported as well."""
+    def __init__(self, keep_events=False):
+        Summary.__init__(self)
+        self.events = [] if keep_events else None
+
+
+    def handle(self, event):
+        Summary.handle(self, event)
+        if self.events is not None:
+            self.events.append(event)
+
+
+    def export(self, path):
+        data = {
+            'operations': self.operations,
+            'timers': {stage: {'seconds': seconds, 'calls': calls} for stage, (seconds, calls) in self.timers.iteritems()},
+            'counters': self.counters,
+            'warnings': self.warnings,
+            }
+        if self.events is not None:
+            data['events'] = self.events
+        with open(path, 'wb') as jfile:
+            json.dump(data, jfile, indent=2, sort_keys=True)
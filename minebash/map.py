@@ -1,23 +1,66 @@
+import hashlib
+
+import numpy
 from PIL import Image
 
+import instrument
+import pngstream
+import util
 import world
 
-class Map:
+
+# relative brightness of a block at each light level
+BRIGHTNESS = [0.85 ** (15 - level) for level in range(16)]
+
+# sky light levels for named times of day
+SKYLIGHT = {'day': 15, 'night': 4}
+
+# faces of a block that can be given separate colours in the palette; top is the default
+FACES = ('top', 'side')
+
+# colours of chunk age maps, from the least to the most recently modified chunks
+AGE_COLOURS = [(0, 0, 96), (0, 96, 255), (0, 224, 128), (255, 224, 0), (255, 0, 0)]
+
+
+class Map(util.Parallel):
     def __init__(self, wld, colours=None, biomes=None):
         self.csize = world.CSIZE
         self.rsize = world.RSIZE
         self.rotate = 0
+        self.workers = 1
+        self.cache = None
+        self.skylight = None
+        self.ylimits = None
+        self.skip_ceiling = False
         
         self.world = wld
         self.colours = self._load_colours(colours or 'colours.csv')
         self.biomes = self._load_colours(biomes or 'biomes.csv')
+        self.palette = hashlib.sha1(repr((sorted(self.colours.items()), sorted(self.biomes.items())))).hexdigest()
+        self.colour_lut, self.side_lut = self._compile_palette(self.colours)
+        self.biome_lut = self._compile_colours(self.biomes, 256)
+        # only read block data values if the palette has colours for them
+        self.use_data = any(data is not None for id, data, face in self.colours)
         
         
-    def draw_map(self, wld, imgpath, type='block', bcrop=None):
-        """Gets map data from a subclass method, and saves it to an image file."""
-        image = self._generate_map(wld, type, bcrop)
-        image.save(imgpath)
-        print 'saved image to', imgpath
+    def draw_map(self, wld, imgpath, type='block', bcrop=None, stream=False):
+        """Gets map data from a subclass method, and saves it to an image file.
+        If stream is true, the map is written one row of regions at a time,
+        as PNG scanlines or (for .rgba or .raw paths) into a memory-mapped raw file."""
+        with instrument.operation('draw_map'):
+            if stream:
+                size, strips = self._generate_map_rows(wld, type, bcrop)
+                writer = pngstream.get_writer(imgpath, size)
+                for row, strip in strips:
+                    writer.fill_to(row)
+                    with instrument.timer('write'):
+                        writer.write_rows(strip.tobytes())
+                writer.close()
+            else:
+                image = self._generate_map(wld, type, bcrop)
+                with instrument.timer('write'):
+                    image.save(imgpath)
+        instrument.message('saved image to {0}'.format(imgpath))
         
     
     def draw_region(self, wld, (rx, rz), type):
@@ -25,6 +68,12 @@ class Map:
         return self._generate_region_map(wld.get_region((rx, rz)), type)
     
     
+    def draw_region_layers(self, wld, (rx, rz), types):
+        """Draw several layers of a single region (e.g. block, biome, heightmap, light),
+        reading and decoding each chunk only once. Returns a dict of images indexed by type."""
+        return self._generate_region_layers(wld.get_region((rx, rz)), types)
+    
+    
     def draw_region_at_point(self, wld, (x, z), type):
         """Determine which region file holds a certain block, and draw that region."""
         rbsize = self.csize * self.rsize
@@ -32,26 +81,153 @@ class Map:
         return self.draw_region(wld, wld, (rx, rz), type)
         
     
-    def draw_chunk_map(self, wld, imgpath, limits=None):
-        """Draws a small map showing all chunks present."""
-        w, e, n, s = wld.get_chunk_edges()
-        dimensions = (w - e + 1, s - n + 1)
-        img = Image.new('RGB', dimensions)
-        pix = img.load()
-        
-        for (rx, rz), region in sorted(wld.get_regions().items()):
-            print 'reading region', (rx, rz), '...'
-            for (cx, cz), chunk in region.read_chunks().items():
-                pixel = (cx - w, cz - n)
-                pix[pixel] = (255, 255, 255)
-
-        img.save(imgpath)
+    def draw_chunk_map(self, wld, imgpath, type='presence', bcrop=None):
+        """Draws a small map with one pixel per chunk, using only the region headers,
+        so no chunk data is read. A 'presence' map shows all chunks present in white;
+        an 'age' map colours them by last modification time, from blue for the oldest to red for the newest.
+        Takes an optional bounding box in blocks."""
+        with instrument.operation('draw_chunk_map'):
+            regions = wld.get_regions()
+            if not regions:
+                instrument.warning('no regions to draw')
+                return
+            
+            # assemble the mtime tables of all regions into one (z, x) array
+            rw, re, rn, rs = self._get_edges(regions.keys())
+            mtimes = numpy.zeros(((rs + 1 - rn) * self.rsize, (re + 1 - rw) * self.rsize), int) - 1
+            for (rx, rz), region in regions.iteritems():
+                bx, bz = (rx - rw) * self.rsize, (rz - rn) * self.rsize
+                mtimes[bz:bz + self.rsize, bx:bx + self.rsize] = region.get_mtime_table()
+                
+            # crop to the bounding box, then to the chunks present
+            if bcrop:
+                w, e, n, s = (b / world.CSIZE - offset for b, offset in
+                              zip(bcrop, (rw * self.rsize, rw * self.rsize, rn * self.rsize, rn * self.rsize)))
+                mtimes[:, :max(w, 0)] = -1
+                mtimes[:, max(e + 1, 0):] = -1
+                mtimes[:max(n, 0)] = -1
+                mtimes[max(s + 1, 0):] = -1
+            zs, xs = numpy.nonzero(mtimes >= 0)
+            if not len(zs):
+                instrument.warning('no chunks to draw')
+                return
+            mtimes = mtimes[zs.min():zs.max() + 1, xs.min():xs.max() + 1]
+            present = mtimes >= 0
+            
+            pixels = numpy.zeros(mtimes.shape + (4,), numpy.uint8)
+            if type == 'age':
+                ages = mtimes[present].astype(float)
+                oldest, newest = ages.min(), ages.max()
+                scaled = (ages - oldest) / (newest - oldest) if newest > oldest else numpy.ones_like(ages)
+                stops = numpy.linspace(0, 1, len(AGE_COLOURS))
+                for channel in range(3):
+                    pixels[:, :, channel][present] = numpy.interp(scaled, stops, [colour[channel] for colour in AGE_COLOURS])
+                pixels[:, :, 3][present] = 255
+            else:
+                pixels[present] = 255
+                
+            Image.fromarray(pixels, 'RGBA').save(imgpath)
+        instrument.message('saved image to {0}'.format(imgpath))
         
         
     def set_rotation(self, rotate):
         """Set the number of times to rotate the map a quarter turn clockwise."""
         self.rotate = rotate % 4
         return self
+    
+    
+    def get_render_params(self):
+        """Returns a tuple of everything besides the world data that affects how regions are drawn,
+        for use in cache keys."""
+        return (self.__class__.__name__, self.rotate, self.palette, self.skylight,
+                self.ylimits, self.skip_ceiling)
+    
+    
+    def set_lighting(self, skylight=None):
+        """Shade blocks by their light values, with the sky at the given light level
+        (or 'day' or 'night'), or turn lighting off if None."""
+        self.skylight = SKYLIGHT.get(skylight, skylight)
+        return self
+    
+    
+    def set_slice(self, ylimits=None, skip_ceiling=False):
+        """Draw only blocks within an inclusive (bottom, top) range of heights,
+        so that each column is coloured by the first block below the top of the range.
+        If skip_ceiling is true, the topmost solid layer of each column is also cut away
+        (e.g. the bedrock ceiling of the nether), showing the first block below the air beneath it."""
+        self.ylimits = ylimits
+        self.skip_ceiling = skip_ceiling
+        return self
+    
+    
+    def set_cache(self, cache):
+        """Set a region cache to draw regions through, so that only chunks modified
+        since the last render are redrawn."""
+        self.cache = cache
+        return self
+        
+        
+    def _draw_region_image(self, region, type='block', bcrop=None):
+        """Draw a region, through the cache if there is one, within an optional bounding box.
+        Cached images always cover the whole region, so anything outside the box is cleared from them."""
+        if self.cache:
+            image = self.cache.get_region_image(self, region, type)
+            return self._clear_outside(image, region.coords, bcrop) if bcrop else image
+        return self._generate_region_map(region, type, bcrop)
+        
+        
+    def _clear_outside(self, image, (rx, rz), (w, e, n, s)):
+        """Returns a copy of a whole-region image with everything outside a bounding box in blocks cleared."""
+        size = self.rsize * self.csize
+        box = tuple(min(max(edge, 0), size) for edge in (w - rx * size, n - rz * size, e + 1 - rx * size, s + 1 - rz * size))
+        cleared = Image.new('RGBA', image.size)
+        if box[0] < box[2] and box[1] < box[3]:
+            cleared.paste(image.crop(box), box[:2])
+        return cleared
+        
+        
+    def _draw_region_layers(self, region, types=('block',), refresh=False):
+        """Draw several types of map of a whole region, through the cache if there is one,
+        redrawing the whole region if refresh is specified. Returns a dict of images indexed by type."""
+        if self.cache:
+            return self.cache.get_region_layers(self, region, types, refresh)
+        return self._generate_region_layers(region, types)
+        
+        
+    def _get_pool(self):
+        """Returns a pool of worker processes to render regions with,
+        or None if regions are to be rendered serially."""
+        return util.get_pool(self.workers, _init_worker, (self, instrument.is_active()))
+        
+        
+    def _render_regions(self, regions, type='block', bcrop=None, pool=None):
+        """Render a list of regions, yielding (coords, image) pairs.
+        If a pool is given, regions are rendered in parallel and yielded as they finish."""
+        if pool is None:
+            for region in regions:
+                yield region.coords, self._draw_region_image(region, type, bcrop)
+        else:
+            for coords, size, data, stats in pool.imap_unordered(_render_region_worker,
+                                                                 ((region, type, bcrop) for region in regions)):
+                if stats:
+                    instrument.replay(*stats)
+                yield coords, Image.frombuffer('RGBA', size, data, 'raw', 'RGBA', 0, 1)
+        
+        
+    def _render_region_layers(self, regions, types=('block',), refresh=False, pool=None):
+        """Render several types of map of each of a list of whole regions, yielding (coords, images) pairs,
+        where images is a dict of images indexed by type. If a pool is given, regions are rendered in parallel,
+        started in the order given, and yielded as they finish."""
+        if pool is None:
+            for region in regions:
+                yield region.coords, self._draw_region_layers(region, types, refresh)
+        else:
+            for coords, images, stats in pool.imap_unordered(_render_region_layers_worker,
+                                                             ((region, types, refresh) for region in regions)):
+                if stats:
+                    instrument.replay(*stats)
+                yield coords, {type: Image.frombuffer('RGBA', size, data, 'raw', 'RGBA', 0, 1)
+                               for type, (size, data) in images.iteritems()}
         
         
     def _crop_coords(self, coords, bcrop=None, scale=1):
@@ -87,17 +263,160 @@ class Map:
         
         
     def _load_colours(self, path):
-        """Grab block colours from a file."""
+        """Grab block colours from a file, indexed by (ID, data value, face).
+        The first column of each line is an ID, optionally followed by :data and/or /face
+        (e.g. 35:14 for red wool, or 2/side for the sides of grass blocks);
+        the data value and face are None if not given."""
         colours = {}
         with open(path, 'rb') as cfile:
             for line in cfile.readlines():
                 if line.strip() and line[0] != '#':
                     values = line.split(',')
-                    id = int(values[0])
-                    colours[id] = tuple(int(x) for x in values[1:-1])
+                    key, face = (values[0].strip().split('/') + [None])[:2]
+                    id, data = (key.split(':') + [None])[:2]
+                    colours[int(id), None if data is None else int(data), face] = tuple(int(x) for x in values[1:-1])
         return colours
 
     
+    def _compile_colours(self, colours, size):
+        """Compile a dict of colours into an RGBA lookup table, indexed by ID.
+        Colours without an alpha value are opaque; missing IDs are transparent.
+        Colours for specific data values or faces are ignored."""
+        lut = numpy.zeros((size, 4), int)
+        for (id, data, face), colour in colours.iteritems():
+            if data is None and face is None:
+                lut[id] = (colour + (255,))[:4]
+        return lut
+    
+    
+    def _compile_palette(self, colours):
+        """Compile a dict of block colours into RGBA lookup tables for the top and side faces of blocks,
+        indexed by block ID << 4 | data value, as returned by _get_blocks.
+        Each entry takes the most specific colour given for its ID, data value and face."""
+        luts = numpy.zeros((len(FACES), 4096 << 4, 4), int)
+        # apply colours from least to most specific, so that more specific ones take precedence
+        for (id, data, face), colour in sorted(colours.iteritems(), key=lambda ((id, data, face), colour):
+                                               (data is not None, face is not None)):
+            faces = [FACES.index(face)] if face else range(len(FACES))
+            keys = [id << 4 | data] if data is not None else slice(id << 4, (id + 1) << 4)
+            for f in faces:
+                luts[f, keys] = (colour + (255,))[:4]
+        return luts[0], luts[1]
+    
+    
+    def _colour_blocks(self, blocks, chunk=None):
+        """Colour each column of an (x, z, y) block array by its top block,
+        blending partially transparent blocks with the blocks beneath them,
+        and shading by light level if lighting is on. Returns an (x, z) array of RGBA colours.
+        This is a vectorised equivalent of folding _combine_alpha and _adjust_colour
+        up each column, from the highest opaque block to the top block."""
+        height = blocks.shape[2]
+        xs, zs = numpy.indices(blocks.shape[:2])
+        
+        top = self._find_top(blocks > 0)
+        base = self._find_top((self.colour_lut[blocks, 3] == 255) & (numpy.arange(height) <= top[:, :, numpy.newaxis]))
+        base[base < 0] = 0
+        
+        colour = numpy.zeros(blocks.shape[:2] + (4,), int)
+        for step in range((top - base).max() + 1):
+            ys = numpy.minimum(base + step, height - 1)
+            front = self.colour_lut[blocks[xs, zs, ys]]
+            blended = numpy.where(front[:, :, 3:] == 255, front, self._combine_alpha_array(front, colour))
+            colour = numpy.where((base + step <= top)[:, :, numpy.newaxis], self._adjust_colour_array(blended, ys), colour)
+            
+        if self.skylight is not None and chunk is not None:
+            colour[:, :, :3] = colour[:, :, :3] * self._get_brightness(chunk, top + 1)[:, :, numpy.newaxis]
+        return colour.astype(numpy.uint8)
+    
+    
+    def _get_blocks(self, chunk, surface=False):
+        """Returns an (x, z, y) array of the palette indices of the blocks in a chunk that are to be drawn,
+        according to the slice settings. If surface is true, only enough of an Anvil chunk
+        is decoded to find the visible surface of each column; blocks below that are left as air."""
+        if surface and not self.skip_ceiling and isinstance(chunk, world.AnvilChunk):
+            return self._get_surface_blocks(chunk)
+        blocks = self._read_blocks(chunk, self.ylimits)
+        if self.skip_ceiling:
+            blocks = self._cut_ceiling(blocks)
+        return blocks
+    
+    
+    def _read_blocks(self, chunk, ylimits=None):
+        """Returns an (x, z, y) array of the palette indices of the blocks in a chunk
+        within an optional range of heights: each block's ID << 4 | its data value.
+        Data values are only read if the palette uses them. Air is always 0."""
+        blocks = chunk.get_data('block', ylimits=ylimits) << 4
+        if self.use_data:
+            blocks |= numpy.where(blocks, chunk.get_data('blockdata', ylimits=ylimits), 0).astype(blocks.dtype)
+        return blocks
+    
+    
+    def _get_surface_blocks(self, chunk):
+        """Decode only the sections of an Anvil chunk needed to colour its top-down surface.
+        Decoding starts at the section holding the lowest HeightMap value, which every column's top block
+        should be at or above, and continues one section at a time further down, only while some column
+        has no block at all or no opaque block beneath its top block in the decoded sections.
+        The result is exactly what _colour_blocks would see if the whole chunk were decoded."""
+        height = world.SECHEIGHT * world.SECTIONS
+        bottom, top = self.ylimits or (0, height - 1)
+        hmap = chunk.find_tag('HeightMap')
+        lowest = min(max(min(hmap) - 1, bottom), top) if hmap else bottom
+        
+        low = lowest / world.SECHEIGHT * world.SECHEIGHT
+        blocks = self._read_blocks(chunk, (max(low, bottom), top))
+        while low > bottom:
+            tops = self._find_top(blocks > 0)
+            opaque = (self.colour_lut[blocks, 3] == 255) & (numpy.arange(height) <= tops[:, :, numpy.newaxis])
+            if (tops >= 0).all() and opaque.any(2).all():
+                break
+            low -= world.SECHEIGHT
+            section = (max(low, bottom), low + world.SECHEIGHT - 1)
+            blocks[:, :, section[0]:section[1] + 1] = self._read_blocks(chunk, section)[:, :, section[0]:section[1] + 1]
+        return blocks
+    
+    
+    def _cut_ceiling(self, blocks):
+        """Clear the topmost run of solid blocks in each column of an (x, z, y) block array,
+        and everything above it, leaving the first block below the air under the ceiling on top."""
+        height = blocks.shape[2]
+        top = self._find_top(blocks > 0)
+        below = self._find_top((blocks == 0) & (numpy.arange(height) <= top[:, :, numpy.newaxis]))
+        return numpy.where(numpy.arange(height) > below[:, :, numpy.newaxis], 0, blocks)
+    
+    
+    def _find_top(self, mask):
+        """Returns an (x, z) array of the highest Y at which each column of an (x, z, y) boolean array
+        is true, or -1 where it is never true."""
+        height = mask.shape[2]
+        top = height - 1 - mask[:, :, ::-1].argmax(2)
+        top[~mask.any(2)] = -1
+        return top
+    
+    
+    def _get_brightness(self, chunk, ys, skylight=None):
+        """Returns the brightness of each column of a chunk, from the light values
+        at the given height in each column (i.e. the block above the visible block).
+        Uses the map's sky light level unless another is given."""
+        skylight = self.skylight if skylight is None else skylight
+        sky, block = chunk.get_light(ys)
+        level = numpy.maximum(sky.astype(int) - (15 - skylight), block)
+        return numpy.array(BRIGHTNESS)[level.clip(0, 15)]
+    
+    
+    def _adjust_colour_array(self, colour, lum, amount=1.5, offset=32):
+        """Vectorised _adjust_colour, for an array of colours and an array of luminance values."""
+        rgb = colour[:, :, :3]
+        adjust = numpy.minimum(rgb, 255 - rgb) * (lum[:, :, numpy.newaxis] - 128 + offset) / 255 * amount
+        return numpy.dstack(((rgb + adjust).astype(int), colour[:, :, 3:]))
+    
+    
+    def _combine_alpha_array(self, front, back):
+        """Vectorised _combine_alpha, for arrays of front and back colours."""
+        af, ab = front[:, :, 3:], back[:, :, 3:]
+        rgb = (front[:, :, :3] * af + back[:, :, :3] * ab * (255 - af) / 255) / 255
+        return numpy.dstack((rgb, af + ab - af * ab / 255))
+    
+    
     def _adjust_colour(self, colour, lum, amount=1.5, offset=32):
         """Lighten or darken a colour, depending on a luminance value."""
         return tuple(
@@ -119,3 +438,40 @@ class Map:
             af + ab - af * ab / 255
             )
 
+
+
+# worker process functions; these are module-level so that they can be pickled
+
+_worker_map = None
+_worker_summary = None
+
+
+def _init_worker(mapobj, instrumented=False):
+    """Store the map that this worker process will render regions with.
+    If the parent process is instrumented, timers and counters are collected here
+    and passed back with each region."""
+    global _worker_map, _worker_summary
+    _worker_map = mapobj
+    _worker_summary = instrument.add_sink(instrument.Summary()) if instrumented else None
+    
+    
+def _render_region_worker((region, type, bcrop)):
+    """Render a region, and return it as a compact RGBA buffer rather than an image object,
+    along with any timers and counters collected while rendering it."""
+    image = _worker_map._draw_region_image(region, type, bcrop)
+    return region.coords, image.size, image.tobytes(), _get_worker_stats()
+    
+    
+def _render_region_layers_worker((region, types, refresh)):
+    """Render several types of map of a region, and return them as a dict of (size, RGBA buffer) pairs
+    indexed by type, along with any timers and counters collected while rendering them."""
+    images = _worker_map._draw_region_layers(region, types, refresh)
+    return region.coords, {type: (image.size, image.tobytes()) for type, image in images.iteritems()}, _get_worker_stats()
+    
+    
+def _get_worker_stats():
+    """Returns the timers and counters collected since the last call, if instrumented."""
+    if _worker_summary:
+        stats = _worker_summary.timers, _worker_summary.counters
+        _worker_summary.timers, _worker_summary.counters = {}, {}
+        return stats
@@ -17,6 +17,7 @@ class NBT:
         'Compound',
         'Integer Array'
         ]
+    sizes = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8} # payload sizes of numeric tags, by type number
 
 
     
@@ -40,6 +41,66 @@ class NBTReader(NBT):
         return tags
 
 
+    def find_tags(self, data, names):
+        """Returns a dict of the payloads of the tags with the given names in NBT data, indexed by name,
+        without decoding anything else: compounds are searched, and all other tags are skipped over."""
+        self.data = data
+        self.pointer = 0
+
+        found = {}
+        self._find_tags(names, found)
+        return found
+
+
+    def _find_tags(self, names, found):
+        """Search the tags up to the end of the current compound, or of the input."""
+        while True:
+            type_byte = self._read(1)
+            if type_byte in ('', '\x00'): # eof or end tag
+                return
+
+            type = ord(type_byte)
+            namelength = struct.unpack('>H', self._read(2))[0]
+            name = self._read(namelength)
+            if name in names:
+                found[name] = self._get_tag_payload(type)
+            elif type == 10: # compound
+                self._find_tags(names, found)
+            else:
+                self._skip_tag_payload(type)
+
+
+    def _skip_tag_payload(self, type):
+        """Move the pointer past the payload of a tag, unpacking only its lengths."""
+        if type in self.sizes:
+            self.pointer += self.sizes[type]
+
+        elif type in (7, 11): # byte or integer array
+            length = struct.unpack('>I', self._read(4))[0]
+            self.pointer += length * (4 if type == 11 else 1)
+
+        elif type == 8: # string
+            length = struct.unpack('>H', self._read(2))[0]
+            self.pointer += length
+
+        elif type == 9: # list
+            subtype, length = struct.unpack('>BI', self._read(5))
+            if subtype in self.sizes:
+                self.pointer += length * self.sizes[subtype]
+            else:
+                for i in range(length):
+                    self._skip_tag_payload(subtype)
+
+        elif type == 10: # compound
+            while True:
+                subtype = ord(self._read(1))
+                if subtype == 0:
+                    break
+                namelength = struct.unpack('>H', self._read(2))[0]
+                self.pointer += namelength
+                self._skip_tag_payload(subtype)
+
+
     def _read(self, length):
         """Read a length of data from the original input, starting at the current
         pointer value, and advance the pointer."""
@@ -160,7 +221,7 @@ class NBTWriter(NBT):
             return struct.pack('>H{0}B'.format(len(payload)), len(payload), *[ord(x) for x in payload])
 
         elif type == 9: # list
-            subtype = self.types.index(payload[0][0])
+            subtype = self.types.index(payload[0][0]) if payload else 0 # empty lists have end tags as their type
             return ''.join([struct.pack('>BI', subtype, len(payload))]
                             + [self._write_tag_payload(subtype, tag) for type, name, tag in payload])
 
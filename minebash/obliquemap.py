@@ -1,12 +1,16 @@
+import numpy
 from PIL import Image, ImageDraw
 
+import instrument
 import map
+import world
 
 class ObliqueMap(map.Map):
-    def _generate_map_data(self, limits=None):
-        """Draw an angled oblique map of this world, within optional n/s/e/w block limits."""
-        chunklist = self.world.get_chunk_list(limits)
-        n, s, e, w = self._get_extremes(chunklist, self.csize) if limits is None else limits
+    def _generate_map(self, wld, type='block', bcrop=None):
+        """Draw an angled oblique map of this world, optionally cropped to a bounding box."""
+        chunklist = self._crop_coords(wld.get_chunk_list(), bcrop, self.csize)
+        w, e, n, s = self._scale_edges_up(self._get_edges(chunklist), self.csize) if bcrop is None else bcrop
+        height = world.SECHEIGHT * world.SECTIONS if wld.anvil else world.CHEIGHT
         
         # the outermost chunks on the map at this rotation
         cext = self._rotate(self._get_diagonal_extremes(chunklist))
@@ -18,35 +22,81 @@ class ObliqueMap(map.Map):
         
         # diagonal distance between opposite extremes
         width = (abs(right[0] - left[0]) + abs(right[1] - left[1]) + 2)
-        height = (abs(bottom[0] - top[0]) + abs(bottom[1] - top[1]) + 2) + self.height - 1
-
-        image = Image.new('RGBA', (width, height))
-        pixels = image.load()
+        height = (abs(bottom[0] - top[0]) + abs(bottom[1] - top[1]) + 2) + height - 1
+        
+        pixels = numpy.zeros((height, width, 4), numpy.uint8)
+        
+        # read chunks one at a time from back to front, so that nearer blocks are drawn over further ones
+        regions = wld.get_region_list(chunklist)
+        current, rnum = None, 0
+        for cnum, ((gx, gz), chunk) in enumerate(wld.iter_chunks(chunklist, order='backtofront', rotate=self.rotate)):
+            if (gx / self.rsize, gz / self.rsize) != current:
+                current, rnum = (gx / self.rsize, gz / self.rsize), rnum + 1
+                instrument.message('drawing region {0}/{1} {2}...'.format(rnum, len(regions), current))
+                instrument.progress('regions', rnum - 1, len(regions), region=current)
+            instrument.progress('chunks', cnum + 1, len(chunklist), region=current)
+            if chunk is not None:
+                with instrument.timer('colour'):
+                    self._draw_chunk(pixels, chunk, (gx, gz), left, top, (w, e, n, s))
+                    
+        return Image.fromarray(pixels, 'RGBA')
+    
+    
+    def _draw_chunk(self, pixels, chunk, (gx, gz), left, top, (w, e, n, s)):
+        """Draw the blocks of a chunk within a bounding box over a (y, x) array of RGBA pixels.
+        Each block covers 4 pixels: the top row shows its top face, and the bottom row its side.
+        The result is the same as painting the blocks one at a time, column by column from back to front
+        and upward within each column, blending each over the pixels beneath; but instead, the blocks
+        landing on each pixel are sorted into that order, and only those from the last opaque one up
+        are blended, a step at a time for all pixels at once."""
+        blocks = self._get_blocks(chunk)
+        height = blocks.shape[2]
+        bxs, bzs = numpy.indices(blocks.shape[:2])
+        bxs, bzs = bxs + gx * self.csize, bzs + gz * self.csize
+        inside = (w <= bxs) & (bxs <= e) & (n <= bzs) & (bzs <= s)
+        xs, zs, ys = numpy.nonzero((blocks > 0) & inside[:, :, numpy.newaxis])
+        if not len(xs):
+            return
+        
+        ids = blocks[xs, zs, ys]
+        topcolours, sidecolours = self.colour_lut[ids], self.side_lut[ids]
+        if self.skylight is not None:
+            # shade only the visible surface block of each column, from the light above it
+            surface = self._find_top(blocks > 0)
+            lit = ys == surface[xs, zs]
+            brightness = self._get_brightness(chunk, surface + 1)[xs[lit], zs[lit], numpy.newaxis]
+            topcolours[lit, :3] = (topcolours[lit, :3] * brightness).astype(int)
+            sidecolours[lit, :3] = (sidecolours[lit, :3] * brightness).astype(int)
         
-        regions = self.world.get_regions(limits)
-        for rnum, (rx, rz) in enumerate(self._order_coords(regions.keys())):
-            print 'reading region {0}/{1} {2}...'.format(rnum + 1, len(regions), (rx, rz))
-            chunks = regions[rx, rz].read_chunks(chunklist)
-            print 'drawing blocks in', len(chunks), 'chunks...'
-            for cnum, (cx, cz) in enumerate(self._order_coords(chunks.keys())):
-                print 'drawing region {0}/{1} chunk {2}/{3}'.format(rnum + 1, len(regions), cnum + 1, len(chunks))
-                blocks = chunks[cx, cz].get_blocks()
-                for x in range(self.csize) if self.rotate in [0, 1] else reversed(range(self.csize)):
-                    for z in range(self.csize) if self.rotate in [0, 3] else reversed(range(self.csize)):
-                        bx, bz = cx * self.csize + x, cz * self.csize + z
-                        if n <= bx <= s and e <= bz <= w:
-                            px, py = self._find_point((bx, bz), left, top)
-                            py += self.height # move to bottom block of this column, then draw upward
-                            for y in range(self.height):
-                                py -= 1
-                                if blocks[x][z][y]:
-                                    colour = self.colours[blocks[x][z][y]][:4]
-                                    #data[px, py] = colour # 1 pixel for each block
-                                    #for xx, yy in (px, pyy), (px, pyy + 1): # 2 pixels for each block
-                                    for xx, yy in (px, py), (px + 1, py), (px, py + 1), (px + 1, py + 1): # 4 pixels for each block
-                                        pixels[xx, yy] = self._adjust_colour(self._combine_alpha(colour, pixels[xx, yy]), y)
-                                        
-        return image
+        # the top left pixel of each block, counting up from the bottom block of its column
+        pxs, pys = self._find_point((bxs[xs, zs], bzs[xs, zs]), left, top)
+        pys = pys + height - 1 - ys
+        # the order the blocks would be painted in at this rotation
+        order = ((xs if self.rotate in [0, 1] else self.csize - 1 - xs) * self.csize +
+                 (zs if self.rotate in [0, 3] else self.csize - 1 - zs)) * height + ys
+        
+        # the 4 pixels of each block, sorted by pixel and then by painting order
+        flat = numpy.concatenate((pys * pixels.shape[1] + pxs, pys * pixels.shape[1] + pxs + 1,
+                                  (pys + 1) * pixels.shape[1] + pxs, (pys + 1) * pixels.shape[1] + pxs + 1))
+        sort = numpy.lexsort((numpy.tile(order, 4), flat))
+        flat = flat[sort]
+        colours = numpy.concatenate((topcolours, topcolours, sidecolours, sidecolours))[sort]
+        lums = numpy.tile(ys, 4)[sort]
+        
+        # the range of blocks on each pixel, starting from the last opaque one, since nothing beneath it shows
+        first = numpy.flatnonzero(numpy.r_[True, flat[1:] != flat[:-1]])
+        last = numpy.r_[first[1:], len(flat)] - 1
+        opaque = numpy.maximum.accumulate(numpy.where(colours[:, 3] == 255, numpy.arange(len(flat)), -1))
+        start = numpy.maximum(opaque[last], first)
+        
+        pys, pxs = flat[first] / pixels.shape[1], flat[first] % pixels.shape[1]
+        colour = pixels[pys, pxs].astype(int)[:, numpy.newaxis] # (pixel, 1, RGBA), as the array functions expect
+        for step in range((last - start).max() + 1):
+            active = start + step <= last
+            blocknum = start[active] + step
+            blended = self._combine_alpha_array(colours[blocknum][:, numpy.newaxis], colour[active])
+            colour[active] = self._adjust_colour_array(blended, lums[blocknum][:, numpy.newaxis])
+        pixels[pys, pxs] = colour[:, 0]
         
         
     def _get_diagonal_extremes(self, coords):
@@ -74,20 +124,6 @@ class ObliqueMap(map.Map):
         return (a, b, c, d)[self.rotate:] + (a, b, c, d)[:self.rotate]
     
     
-    def _order_coords(self, coords, reverse=False):
-        """Order a set of coordinates so that they proceed from back to front,
-        according to rotation (or front to back if reverse is true).
-        Returns a generator."""
-        xrange = sorted(set(x for (x, z) in coords))
-        zrange = sorted(set(z for (x, z) in coords))
-        
-        # xor each condition with boolean 'reverse'... != acts as xor
-        return ((x, z)
-            for x in (xrange if (self.rotate in [0, 1] != reverse) else reversed(xrange))
-                for z in (zrange if (self.rotate in [0, 3] != reverse) else reversed(zrange))
-                    if (x, z) in coords)
-
-
     def _find_point(self, (x, z), (leftx, leftz), (topx, topz)):
         """Finds the location of an (x, z) point on a grid when tilted diagonally,
         given the diagonal extremes that will be aligned at the top and left of the grid."""
@@ -1,71 +1,149 @@
+import numpy
 from PIL import Image, ImageDraw
 
+import instrument
 import map
+import world
+
+
+MARKER_COLOUR = (255, 0, 255, 255)
 
 class OrthoMap(map.Map):
+    def draw_markers(self, wld, imgpath, points, type='block', bcrop=None, colour=MARKER_COLOUR):
+        """Draw a top-down map like draw_map, with a small square around each of a list of (x, z) points in blocks,
+        e.g. the positions of entities found in an EntityIndex."""
+        with instrument.operation('draw_map'):
+            image = self._generate_map(wld, type, bcrop)
+            chunklist, (w, e, n, s) = self._get_map_bounds(wld, bcrop)
+            scale = float(self.csize) / world.CSIZE # pixels per block
+            draw = ImageDraw.Draw(image)
+            for x, z in points:
+                px, pz = int(x * scale) - w, int(z * scale) - n
+                draw.rectangle((px - 2, pz - 2, px + 2, pz + 2), outline=colour)
+            with instrument.timer('write'):
+                image.save(imgpath)
+        instrument.message('saved image to {0} with {1} markers'.format(imgpath, len(points)))
+        
+        
     def _generate_map(self, wld, type='block', bcrop=None):
         """Generate a single image with a top-down map of this world,
         optionally cropped to a bounding box. North is at the top."""
-        if bcrop:
-            print 'cropping map to {0} W, {1} E, {2} N, {3} S'.format(*bcrop)
-        chunklist = self._crop_coords(wld.get_chunk_list(), bcrop, self.csize)
-        w, e, n, s = self._scale_edges_up(self._get_edges(chunklist), self.csize) if bcrop is None else bcrop
-
+        chunklist, (w, e, n, s) = self._get_map_bounds(wld, bcrop)
         width, height = e + 1 - w, s + 1 - n
         image = Image.new('RGBA', (width, height))
         
         regions = self.world.get_regions(chunklist)
-        for rnum, ((rx, rz), region) in enumerate(sorted(regions.iteritems())):
-            print 'reading region {0} of {1} {2}...'.format(rnum + 1, len(regions), (rx, rz))
+        pool = self._get_pool()
+        rendered = self._render_regions((region for coords, region in sorted(regions.iteritems())), type, (w, e, n, s), pool)
+        for rnum, ((rx, rz), region_image) in enumerate(rendered):
+            instrument.message('drew region {0} of {1} {2}'.format(rnum + 1, len(regions), (rx, rz)))
+            instrument.progress('regions', rnum + 1, len(regions), region=(rx, rz))
             bx, bz = rx * self.rsize * self.csize - w, rz * self.rsize * self.csize - n
-            image.paste(self._generate_region_map(region, type, (w, e, n, s)), (bx, bz))
+            with instrument.timer('paste'):
+                image.paste(region_image, (bx, bz))
+        if pool:
+            pool.close()
+            pool.join()
             
         return image
+    
+    
+    def _generate_map_rows(self, wld, type='block', bcrop=None):
+        """Generate a top-down map of this world one row of regions at a time.
+        Returns the size of the whole map, and a generator of (top pixel row, strip image) pairs,
+        so that only one row of regions needs to be held in memory at once."""
+        chunklist, (w, e, n, s) = self._get_map_bounds(wld, bcrop)
+        width, height = e + 1 - w, s + 1 - n
+        rbsize = self.rsize * self.csize
+        
+        regions = self.world.get_regions(chunklist)
+        rows = sorted(set(rz for rx, rz in regions))
         
+        def strips():
+            pool = self._get_pool()
+            done = 0
+            for rownum, rz in enumerate(rows):
+                instrument.message('reading region row {0} of {1}...'.format(rownum + 1, len(rows)))
+                top, bottom = max(rz * rbsize, n), min((rz + 1) * rbsize - 1, s)
+                strip = Image.new('RGBA', (width, bottom + 1 - top))
+                row = [region for (rx, rrz), region in sorted(regions.iteritems()) if rrz == rz]
+                for (rx, rrz), region_image in self._render_regions(row, type, (w, e, n, s), pool):
+                    done += 1
+                    instrument.progress('regions', done, len(regions), region=(rx, rrz))
+                    with instrument.timer('paste'):
+                        strip.paste(region_image, (rx * rbsize - w, rz * rbsize - top))
+                yield top - n, strip
+            if pool:
+                pool.close()
+                pool.join()
         
-    def _generate_region_map(self, region, type='block', bcrop=None):
+        return (width, height), strips()
+    
+    
+    def _get_map_bounds(self, wld, bcrop=None):
+        """Returns the list of chunks to draw, and the bounding box of the map in blocks."""
+        if bcrop:
+            instrument.message('cropping map to {0} W, {1} E, {2} N, {3} S'.format(*bcrop))
+        chunklist = self._crop_coords(wld.get_chunk_list(), bcrop, self.csize)
+        edges = self._scale_edges_up(self._get_edges(chunklist), self.csize) if bcrop is None else bcrop
+        return chunklist, edges
+        
+        
+    def _generate_region_map(self, region, type='block', bcrop=None, chunks=None):
+        """Draw a top-down map of a single region, within an optional bounding box,
+        and optionally only the chunks in a whitelist of global chunk coordinates."""
+        return self._generate_region_layers(region, (type,), bcrop, chunks)[type]
+    
+    
+    def _generate_region_layers(self, region, types=('block',), bcrop=None, chunks=None):
+        """Draw top-down maps of several types for a single region, decoding each chunk only once.
+        Returns a dict of images indexed by type."""
         rx, rz = region.coords
         size = self.rsize * self.csize
         w, e, n, s = bcrop or (rx * size, (rx + 1) * size - 1, rz * size, (rz + 1) * size - 1)
-        image = Image.new('RGBA', (size, size))
-        pixels = image.load()
+        layers = {type: numpy.zeros((size, size, 4), numpy.uint8) for type in types} # z, x
         
-        chunks = region.read_chunks(set((x / self.csize, z / self.csize) for x in range(w, e + 1) for z in range(n, s + 1)))
-        print 'drawing {0} chunks...'.format(len(chunks))
-        for (cx, cz), chunk in chunks.iteritems():
-            data = chunk.get_data(type)
-            for (x, z) in ((x, z) for x in range(self.csize) for z in range(self.csize)):
-                bx, bz = (cx * self.csize + x, cz * self.csize + z)
-                if w <= rx * size + bx <= e and n <= rz * size + bz <= s:
-                    pixels[bx, bz] = self._get_colour(type, data[x, z])
+        rect = w / self.csize, e / self.csize, n / self.csize, s / self.csize
+        instrument.message('drawing chunks...')
+        for (cx, cz), chunk in region.iter_chunks(None if chunks is None else set(chunks), rect):
+            if chunk is not None:
+                bx, bz = cx * self.csize, cz * self.csize
+                with instrument.timer('colour'):
+                    chunklayers = self._get_chunk_layers(chunk, types)
+                for type, colours in chunklayers.iteritems():
+                    layers[type][bz:bz + self.csize, bx:bx + self.csize] = colours.transpose(1, 0, 2)
+                    
+        images = {}
+        for type, pixels in layers.iteritems():
+            # clear any blocks outside the bounding box
+            pixels[:, :max(w - rx * size, 0)] = 0
+            pixels[:, max(e + 1 - rx * size, 0):] = 0
+            pixels[:max(n - rz * size, 0)] = 0
+            pixels[max(s + 1 - rz * size, 0):] = 0
+            images[type] = Image.fromarray(pixels, 'RGBA')
         
-        return image
+        return images
     
     
-    def _get_colour(self, type, index):
-        if type == 'heightmap':
-            return (index, index, index)
-        elif type == 'biome':
-            return self.biomes[index]
-        else:
-            return self._get_block_colour(index)
-                
-                
-    def _get_block_colour(self, column):
-        for y in reversed(range(len(column))):
-            if column[y]:
-                return self._get_block_column_colour(column, y)
-                
-                
-    def _get_block_column_colour(self, column, y):
-        """If a block is partially transparent, combine its colour with that of the block below."""
-        top = self.colours[column[y]][:4]
-        
-        if top[3] < 255:
-            bottom = self._get_block_column_colour(column, y - 1) if y > 0 else (0, 0, 0, 0)
-            colour = self._combine_alpha(top, bottom)
-        else:
-            colour = top
-            
-        return self._adjust_colour(colour, y)
-
+    def _get_chunk_layers(self, chunk, types=('block',)):
+        """Returns a dict of (x, z) arrays of the RGBA colours of each column in a chunk,
+        for each of the given types, indexed by type. Blocks are only read once for all types."""
+        layers = {}
+        blocks = None
+        for type in types:
+            if type == 'heightmap':
+                hmap = chunk.get_data('heightmap')
+                layers[type] = numpy.dstack((hmap, hmap, hmap, numpy.zeros_like(hmap) + 255))
+            elif type == 'biome':
+                layers[type] = self.biome_lut[chunk.get_data('biome')].astype(numpy.uint8)
+            else:
+                if blocks is None:
+                    blocks = self._get_blocks(chunk, surface=True)
+                if type == 'light':
+                    # brightness of the visible block in each column, in daylight unless lighting is set
+                    light = (self._get_brightness(chunk, self._find_top(blocks > 0) + 1,
+                                                         15 if self.skylight is None else self.skylight) * 255).astype(numpy.uint8)
+                    layers[type] = numpy.dstack((light, light, light, numpy.zeros_like(light) + 255))
+                else:
+                    layers[type] = self._colour_blocks(blocks, chunk)
+        return layers
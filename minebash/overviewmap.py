@@ -0,0 +1,58 @@
+import numpy
+
+import orthomap
+import world
+
+class OverviewMap(orthomap.OrthoMap):
+    """A low-resolution top-down map, with one pixel per chunk or per square of blocks.
+    Each pixel is coloured from the cheapest data available: block maps are coloured
+    by biome and shaded by the height in the HeightMap (and by light, if lighting is on), and only chunks without biome data,
+    or maps with slice settings, fall back to colouring a sample of surface columns.
+    Bounding boxes are still given in blocks."""
+    def __init__(self, wld, colours=None, biomes=None):
+        orthomap.OrthoMap.__init__(self, wld, colours, biomes)
+        self.set_scale(world.CSIZE)
+
+
+    def set_scale(self, scale):
+        """Set the number of blocks along each side of a pixel, which must divide the chunk size."""
+        if world.CSIZE % scale:
+            raise ValueError('scale must divide the chunk size of {0}'.format(world.CSIZE))
+        self.scale = scale
+        self.csize = world.CSIZE / scale # pixels per chunk
+        return self
+
+
+    def get_render_params(self):
+        return orthomap.OrthoMap.get_render_params(self) + (self.scale,)
+
+
+    def _get_map_bounds(self, wld, bcrop=None):
+        """Returns the list of chunks to draw, and the bounding box of the map in pixels."""
+        return orthomap.OrthoMap._get_map_bounds(self, wld, tuple(b / self.scale for b in bcrop) if bcrop else None)
+
+
+    def _get_chunk_layers(self, chunk, types=('block',)):
+        """Returns a dict of (x, z) arrays of the RGBA colours of a sample of the columns in a chunk,
+        one at the centre of each pixel, for each of the given types, indexed by type."""
+        sample = (slice(self.scale / 2, None, self.scale),) * 2
+        cheap = isinstance(chunk, world.AnvilChunk) and not (self.ylimits or self.skip_ceiling)
+        layers = {}
+        for type in types:
+            if type == 'heightmap':
+                hmap = chunk.get_data('heightmap')[sample]
+                layers[type] = numpy.dstack((hmap, hmap, hmap, numpy.zeros_like(hmap) + 255))
+            elif type == 'biome':
+                layers[type] = self.biome_lut[chunk.get_data('biome')[sample]].astype(numpy.uint8)
+            elif type == 'block' and cheap and chunk.find_tag('Biomes') and chunk.find_tag('HeightMap'):
+                # the HeightMap holds the height above the top block of each column
+                hmap = chunk.get_data('heightmap')
+                colour = self._adjust_colour_array(self.biome_lut[chunk.get_data('biome')[sample]], hmap[sample].astype(int) - 1)
+                if self.skylight is not None:
+                    colour[:, :, :3] = colour[:, :, :3] * self._get_brightness(chunk, hmap)[sample][:, :, numpy.newaxis]
+                layers[type] = colour.astype(numpy.uint8)
+            elif type == 'block':
+                layers[type] = self._colour_blocks(self._get_blocks(chunk, surface=True)[sample])
+            else:
+                layers[type] = orthomap.OrthoMap._get_chunk_layers(self, chunk, (type,))[type][sample]
+        return layers
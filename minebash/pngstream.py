@@ -0,0 +1,97 @@
+import os
+import struct
+import zlib
+
+import numpy
+
+
+class PNGWriter:
+    """Writes an RGBA PNG file a strip of rows at a time, so the whole image
+    never has to be held in memory."""
+    def __init__(self, path, (width, height)):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows = 0
+
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(6)
+
+        self.file.write('\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, colour type 6 (RGBA), no interlacing
+        self._write_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+
+    def write_rows(self, data):
+        """Append rows of raw RGBA data, which must be a whole number of rows wide."""
+        strip = numpy.frombuffer(data, numpy.uint8).reshape((-1, self.width * 4))
+        rows = len(strip)
+        # prefix each scanline with filter type 0 (none)
+        lines = numpy.zeros((rows, self.width * 4 + 1), numpy.uint8)
+        lines[:, 1:] = strip
+        compressed = self.compressor.compress(lines.tostring())
+        if compressed:
+            self._write_chunk('IDAT', compressed)
+        self.rows += rows
+
+
+    def fill_to(self, row):
+        """Write transparent rows up to the given row, a bounded number at a time."""
+        while self.rows < row:
+            self.write_rows('\x00' * self.width * 4 * min(row - self.rows, 256))
+
+
+    def close(self):
+        """Pad out any rows that were never written, and finish the file."""
+        self.fill_to(self.height)
+        self._write_chunk('IDAT', self.compressor.flush())
+        self._write_chunk('IEND', '')
+        self.file.close()
+
+
+    def _write_chunk(self, type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(type + data) & 0xffffffff))
+
+
+
+class RawWriter:
+    """Writes raw RGBA data into a memory-mapped file, a strip of rows at a time.
+    The file has no header; its dimensions are written to a file alongside it, named by adding .txt to its path."""
+    def __init__(self, path, (width, height)):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows = 0
+
+        self.array = numpy.memmap(path, numpy.uint8, 'w+', shape=(height, width, 4))
+        with open(path + '.txt', 'wb') as sizefile:
+            sizefile.write('{0} {1} RGBA\n'.format(width, height))
+
+
+    def write_rows(self, data):
+        """Copy rows of raw RGBA data into the file, then flush them to disk."""
+        strip = numpy.frombuffer(data, numpy.uint8).reshape((-1, self.width, 4))
+        self.array[self.rows:self.rows + len(strip)] = strip
+        self.array.flush()
+        self.rows += len(strip)
+
+
+    def fill_to(self, row):
+        """Skip ahead to the given row; the file starts out zeroed, i.e. transparent."""
+        self.rows = max(self.rows, row)
+
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+
+def get_writer(path, size):
+    """Choose a writer by file extension: raw RGBA for .rgba or .raw, otherwise PNG."""
+    if os.path.splitext(path)[1].lower() in ('.rgba', '.raw'):
+        return RawWriter(path, size)
+    return PNGWriter(path, size)
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import mmap
+import os
+import time
+
+import instrument
+import util
+import world
+
+
+class SnapshotStore:
+    """Incremental snapshots of the chunks of a world. Each chunk's compressed data is stored once,
+    keyed by its hash, packed end to end in a single data file; a snapshot is a directory with
+    a small manifest for each region, giving the header mtime and hash of each of its chunks.
+    When a snapshot is taken, chunks whose mtime matches the previous snapshot are not read at all,
+    so a snapshot costs about the size of the chunks that have changed since the last one.
+    Only region files are stored, not level.dat or player data."""
+    def __init__(self, path):
+        self.path = path
+        self.snapshotpath = os.path.join(self.path, 'snapshots')
+        if not os.path.exists(self.snapshotpath):
+            os.makedirs(self.snapshotpath)
+
+        self.indexpath = os.path.join(self.path, 'index.json')
+        self.datapath = os.path.join(self.path, 'chunks.dat')
+        self.lockpath = os.path.join(self.path, 'lock')
+
+        self.index = {'end': 0, 'chunks': {}} # offsets and lengths of chunk data, indexed by hash
+        self.mapped = None
+
+
+    def get_snapshots(self):
+        """Returns a list of the names of all snapshots, oldest first."""
+        return sorted(name for name in os.listdir(self.snapshotpath)
+                      if os.path.exists(os.path.join(self.snapshotpath, name, 'snapshot.json')))
+
+
+    def get_manifest(self, name, (rx, rz)):
+        """Returns the manifest of a region in a snapshot: a dict of (mtime, hash) pairs indexed by
+        REGIONAL chunk coords. Returns an empty dict if the region wasn't in the snapshot."""
+        path = os.path.join(self.snapshotpath, name, 'r.{0}.{1}.json'.format(rx, rz))
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'rb') as mfile:
+            return {(cx, cz): (mtime, digest) for cx, cz, mtime, digest in json.load(mfile)}
+
+
+    def take(self, wld, name=None):
+        """Take a snapshot of all the chunks in a world, named by the current time unless a name is given.
+        Chunks are compared with the latest snapshot by header mtime, and only new or modified chunks are read.
+        Returns the name of the snapshot."""
+        name = name or time.strftime('%Y%m%d-%H%M%S')
+        snapshots = self.get_snapshots()
+        if name in snapshots:
+            raise ValueError('there is already a snapshot called {0}'.format(name))
+        parent = snapshots[-1] if snapshots else None
+        path = os.path.join(self.snapshotpath, name)
+        if not os.path.exists(path): # it may be left over from an interrupted snapshot
+            os.makedirs(path)
+
+        with instrument.operation('snapshot'), util.FileLock(self.lockpath, True):
+            self._load_index()
+            with open(self.datapath, 'ab') as dfile:
+                dfile.seek(self.index['end'])
+                dfile.truncate()
+                for rnum, ((rx, rz), region) in enumerate(sorted(wld.get_regions().iteritems())):
+                    instrument.progress('regions', rnum, len(wld.regionlist), region=(rx, rz))
+                    manifest = self._snapshot_region(region, self.get_manifest(parent, (rx, rz)) if parent else {}, dfile)
+                    util.write_json(os.path.join(path, 'r.{0}.{1}.json'.format(rx, rz)),
+                                    [[cx, cz, mtime, digest] for (cx, cz), (mtime, digest) in sorted(manifest.iteritems())])
+                instrument.progress('regions', len(wld.regionlist), len(wld.regionlist))
+            util.write_json(self.indexpath, self.index)
+            # written last, so that an interrupted snapshot is ignored
+            util.write_json(os.path.join(path, 'snapshot.json'),
+                            {'world': os.path.abspath(wld.path), 'time': time.time(), 'anvil': wld.anvil, 'parent': parent})
+        instrument.message('saved snapshot {0}'.format(name))
+        return name
+
+
+    def restore(self, name, wld, regions=None):
+        """Rebuild the region files of a world as they were in a snapshot, or only the regions in a list
+        of region coords. When the whole world is restored, region files that weren't in the snapshot are removed."""
+        snapshotpath = os.path.join(self.snapshotpath, name)
+        if name not in self.get_snapshots():
+            raise ValueError('no snapshot called {0}; there are {1}'.format(name, ', '.join(self.get_snapshots()) or 'none'))
+        with open(os.path.join(snapshotpath, 'snapshot.json'), 'rb') as sfile:
+            anvil = json.load(sfile)['anvil']
+        saved = set(tuple(int(c) for c in filename.split('.')[1:3])
+                    for filename in os.listdir(snapshotpath) if filename.startswith('r.'))
+
+        with instrument.operation('restore'), util.FileLock(self.lockpath, False):
+            self._load_index()
+            if regions is None:
+                for rx, rz in set(wld.regionlist) - saved:
+                    instrument.message('removing region {0}'.format((rx, rz)))
+                    os.remove(wld.get_region((rx, rz)).path)
+            regionlist = sorted(saved if regions is None else saved & set(regions))
+            for rnum, (rx, rz) in enumerate(regionlist):
+                instrument.progress('regions', rnum, len(regionlist), region=(rx, rz))
+                manifest = self.get_manifest(name, (rx, rz))
+                data = self._map_data() if manifest else None
+                chunks = {}
+                for (cx, cz), (mtime, digest) in manifest.iteritems():
+                    offset, length = self.index['chunks'][digest]
+                    chunks[cx, cz] = mtime, data[offset:offset + length]
+                region = world.Region(wld.path, (rx, rz), anvil)
+                region.save(chunks, removed=region.chunkinfo.keys()) # replace the region's chunks, rather than adding to them
+            instrument.progress('regions', len(regionlist), len(regionlist))
+        wld.reload()
+        instrument.message('restored snapshot {0} to {1}'.format(name, wld.path))
+
+
+    def _snapshot_region(self, region, previous, dfile):
+        """Returns the manifest of a region, given the manifest of the same region in the previous snapshot.
+        Chunks whose header mtime hasn't changed keep their previous hash; the rest are read and hashed,
+        and their data is appended to the data file unless it is already in the store."""
+        manifest = {}
+        modified = set()
+        rx, rz = region.coords
+        for (cx, cz), info in region.chunkinfo.iteritems():
+            if (cx, cz) in previous and previous[cx, cz][0] == info['mtime']:
+                manifest[cx, cz] = previous[cx, cz]
+            else:
+                modified.add((rx * world.RSIZE + cx, rz * world.RSIZE + cz))
+        instrument.count('chunks_unchanged', len(manifest))
+
+        for (cx, cz), payload in region.iter_chunks(modified, payload='raw'):
+            if payload is None:
+                continue # unreadable chunks have already been warned about
+            mtime, data = payload
+            digest = hashlib.sha1(data).hexdigest()
+            if digest not in self.index['chunks']:
+                dfile.write(data)
+                self.index['chunks'][digest] = self.index['end'], len(data)
+                self.index['end'] += len(data)
+                instrument.count('bytes_stored', len(data))
+            manifest[cx, cz] = mtime, digest
+            instrument.count('chunks_hashed')
+        return manifest
+
+
+    def _map_data(self):
+        """Returns a read-only memory map of the data file, remapping it if it has grown."""
+        if self.mapped is None or len(self.mapped) < self.index['end']:
+            with open(self.datapath, 'rb') as dfile:
+                self.mapped = mmap.mmap(dfile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapped
+
+
+    def _load_index(self):
+        if os.path.exists(self.indexpath):
+            with open(self.indexpath, 'rb') as ifile:
+                self.index = json.load(ifile)
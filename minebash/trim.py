@@ -0,0 +1,124 @@
+import os
+import time
+
+import numpy
+
+import instrument
+import util
+import world
+
+
+# IDs of blocks found in generated terrain. Blocks of generated structures (dungeons, mineshafts, villages,
+# strongholds, fortresses) are left out, so chunks containing them are treated as having been built on
+NATURAL_BLOCKS = (0, 1, 2, 3, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 21, 24, 31, 32, 37, 38, 39, 40,
+                  49, 51, 56, 73, 74, 78, 79, 80, 81, 82, 83, 86, 87, 88, 89, 97, 99, 100, 106, 110, 111, 121)
+
+
+class Trimmer(util.Parallel):
+    """Deletes chunks that match a set of rules, e.g. chunks that were generated but never built on.
+    A chunk is trimmed if it matches every rule that has been set: older than an age, by its header mtime;
+    outside (or inside) a rectangle; and containing only natural blocks. Header rules are checked first,
+    and chunks are only decoded if there is a content rule and they have passed the others.
+    Regions are scanned in parallel if there are several workers, and each region with chunks to trim
+    is rewritten once, by the worker that scanned it."""
+    def __init__(self, wld):
+        self.world = wld
+        self.age = None
+        self.rect = None
+        self.outside = True
+        self.natural = None
+
+        self.trimmed = {} # lists of REGIONAL coords of trimmed chunks, indexed by region coords
+        self.sectors = 0 # number of 4 KB sectors freed by trimming
+        self.kept = 0
+
+
+    def set_age(self, days=None):
+        """Trim only chunks whose header mtime is more than a number of days old."""
+        self.age = days
+        return self
+
+
+    def set_rect(self, rect=None, outside=True):
+        """Trim only chunks outside (or inside, if outside is false) an inclusive rectangle
+        (w, e, n, s) of global chunk coordinates."""
+        self.rect = rect
+        self.outside = outside
+        return self
+
+
+    def set_natural(self, blocks=NATURAL_BLOCKS):
+        """Trim only chunks that contain nothing but a list of block IDs, by default NATURAL_BLOCKS;
+        None removes the rule."""
+        self.natural = blocks
+        return self
+
+
+    def trim(self, dryrun=False):
+        """Find the chunks that match the rules, and delete them unless this is a dry run."""
+        if self.age is None and self.rect is None and self.natural is None:
+            raise ValueError('no trimming rules have been set')
+        rules = (time.time() - self.age * 86400 if self.age is not None else None, self.rect, self.outside,
+                 tuple(self.natural) if self.natural is not None else None)
+        regions = [region for coords, region in sorted(self.world.get_regions().iteritems())]
+
+        with instrument.operation('trim'):
+            self.trimmed, self.sectors, self.kept = {}, 0, 0
+            jobs = [(region, rules, dryrun) for region in regions]
+            for rnum, ((rx, rz), trimmed, sectors, kept, decoded) in enumerate(util.imap_jobs(_trim_region, jobs, self.workers)):
+                instrument.progress('regions', rnum + 1, len(jobs), region=(rx, rz))
+                instrument.count('chunks_decoded', decoded)
+                instrument.count('chunks_trimmed', len(trimmed))
+                if trimmed:
+                    self.trimmed[rx, rz] = trimmed
+                self.sectors += sectors
+                self.kept += kept
+        if not dryrun:
+            self.world.reload()
+        return self
+
+
+    def report(self):
+        """Returns a text listing of the number of chunks trimmed in each region, with a summary line."""
+        lines = ['{0} chunks trimmed in {1} regions, {2} kept; {3:.1f} MB freed'.format(
+            sum(len(chunks) for chunks in self.trimmed.itervalues()), len(self.trimmed), self.kept,
+            self.sectors * 4096 / 1048576.0)]
+        lines.extend('r.{0}.{1}: {2}'.format(rx, rz, len(chunks)) for (rx, rz), chunks in sorted(self.trimmed.iteritems()))
+        return '\n'.join(lines)
+
+
+
+def _trim_region((region, (before, rect, outside, natural), dryrun)):
+    """Find the chunks in a region that match the trimming rules, and rewrite the region without them
+    unless this is a dry run. Returns the region's coords, a list of REGIONAL coords of trimmed chunks,
+    the number of sectors they took up, the number of chunks kept, and the number of chunks decoded."""
+    rx, rz = region.coords
+    candidates = []
+    for (cx, cz), info in region.chunkinfo.iteritems():
+        if before is not None and info['mtime'] >= before:
+            continue
+        if rect is not None and outside == (rect[0] <= rx * world.RSIZE + cx <= rect[1] and
+                                            rect[2] <= rz * world.RSIZE + cz <= rect[3]):
+            continue
+        candidates.append((cx, cz))
+
+    decoded = 0
+    if natural is not None and candidates:
+        table = numpy.zeros(1 << 16, bool)
+        table[list(natural)] = True
+        trimmed = []
+        for (cx, cz), chunk in region.iter_chunks(set((rx * world.RSIZE + cx, rz * world.RSIZE + cz) for cx, cz in candidates)):
+            decoded += 1
+            if chunk is not None and table[chunk.get_data('block')].all():
+                trimmed.append((cx, cz))
+    else:
+        trimmed = candidates
+
+    sectors = sum(region.chunkinfo[coords]['sectorlength'] for coords in trimmed)
+    kept = len(region.chunkinfo) - len(trimmed)
+    if trimmed and not dryrun:
+        if kept:
+            region.save(removed=trimmed)
+        else:
+            os.remove(region.path)
+    return region.coords, sorted(trimmed, key=lambda (cx, cz): (cz, cx)), sectors, kept, decoded
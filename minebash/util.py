@@ -0,0 +1,81 @@
+import json
+import multiprocessing
+import os
+
+try:
+    import fcntl
+except ImportError: # no file locking on windows; files are then only safe for one process
+    fcntl = None
+
+
+class Parallel:
+    """Base class for jobs that can be spread over several worker processes."""
+    workers = 1
+
+
+    def set_workers(self, workers):
+        """Set the number of worker processes to use.
+        1 works serially in this process; 0 uses one worker per CPU."""
+        self.workers = workers or multiprocessing.cpu_count()
+        return self
+
+
+
+class FileLock:
+    """Holds a shared or exclusive lock on a file, for use in a with statement."""
+    def __init__(self, path, exclusive):
+        self.path = path
+        self.exclusive = exclusive
+
+
+    def __enter__(self):
+        self.file = open(self.path, 'ab')
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+
+def replace_file(temppath, path):
+    """Move a finished temporary file over another file. Windows can't rename over an existing file,
+    so there the old one is removed first; callers should hold an exclusive lock on it."""
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temppath, path)
+
+
+def write_json(path, value):
+    """Write a JSON file through a temporary file, so that it is never left half-written."""
+    temppath = path + '.tmp'
+    with open(temppath, 'wb') as jfile:
+        json.dump(value, jfile)
+    replace_file(temppath, path)
+
+
+def get_pool(workers, initializer=None, initargs=()):
+    """Returns a pool of worker processes, or None if there is only one worker,
+    in which case jobs are to be run serially in this process."""
+    if workers > 1:
+        return multiprocessing.Pool(workers, initializer, initargs)
+
+
+def imap_jobs(func, jobs, workers=1):
+    """Yields the results of a function applied to each of a list of jobs. If there are several workers
+    and jobs, they are run in a pool of worker processes and yielded as they finish, so the function
+    must be defined at module level, where it can be pickled; otherwise they are run serially in order."""
+    pool = get_pool(min(workers, len(jobs)))
+    if pool is None:
+        for job in jobs:
+            yield func(job)
+        return
+    try:
+        for result in pool.imap_unordered(func, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
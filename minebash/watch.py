@@ -0,0 +1,127 @@
+import os
+import time
+
+import instrument
+import world
+
+
+class Watcher:
+    """Keeps a top-down map image of a world up to date while the world is being modified,
+    e.g. by a running server. The region directory is polled for files whose size or
+    modification time has changed; the headers of those regions are then compared with
+    their last known state, and only the chunks whose mtimes have changed are redrawn
+    and pasted into the map image."""
+    def __init__(self, mapobj, wld, imgpath, type='block', bcrop=None):
+        self.map = mapobj
+        self.world = wld
+        self.imgpath = imgpath
+        self.type = type
+        self.bcrop = bcrop
+        self.regionpath = os.path.join(wld.path, 'region')
+
+        self.image = None
+        self.edges = None
+        self.stats = {}
+
+
+    def run(self, interval=2, debounce=1, min_period=10):
+        """Draw the whole map, then watch for changes until interrupted, redrawing changed chunks.
+        The region directory is checked every interval seconds. Once a change is seen, the map is
+        not redrawn until no further changes have been seen for debounce seconds, and never
+        more than once every min_period seconds."""
+        self.stats = self._stat_regions()
+        self.redraw_all()
+        drawn = time.time()
+        pending = set()
+        lastchange = None
+
+        while True:
+            time.sleep(interval)
+            changed = self.poll()
+            if changed:
+                pending.update(changed)
+                lastchange = time.time()
+            now = time.time()
+            if pending and now - lastchange >= debounce and now - drawn >= min_period:
+                self.update(pending)
+                drawn = time.time()
+                pending = set()
+
+
+    def poll(self):
+        """Returns a list of the coordinates of region files that have been added, removed
+        or modified since the last poll. Only the directory and file stats are read."""
+        stats = self._stat_regions()
+        changed = [coords for coords in set(stats) | set(self.stats) if stats.get(coords) != self.stats.get(coords)]
+        self.stats = stats
+        return changed
+
+
+    def update(self, regions):
+        """Re-read the headers of the given regions, and redraw any chunks that have changed.
+        If the map needs to grow to fit new chunks, the whole map is redrawn instead."""
+        changed = self.world.reload(regions)
+        chunks = set((rx * world.RSIZE + cx, rz * world.RSIZE + cz)
+                     for (rx, rz), chunklist in changed.iteritems() for cx, cz in chunklist)
+        if not chunks:
+            return
+
+        w, e, n, s = self.edges
+        csize = self.map.csize
+        if any(not (w <= cx * csize and (cx + 1) * csize - 1 <= e and n <= cz * csize and (cz + 1) * csize - 1 <= s)
+               for cx, cz in chunks) and self.bcrop is None:
+            instrument.message('map bounds have changed; redrawing')
+            self.redraw_all()
+            return
+
+        instrument.message('redrawing {0} chunks in {1} regions'.format(len(chunks), len(changed)))
+        with instrument.operation('update_map'):
+            for rx, rz in changed:
+                region = self.world.get_region((rx, rz))
+                if region is None: # the region file was removed; clear its chunks
+                    rimage = None
+                else:
+                    rimage = self.map._draw_region_image(region, self.type, self.edges) if self.map.cache else \
+                        self.map._generate_region_map(region, self.type, self.edges, chunks)
+                with instrument.timer('paste'):
+                    for cx, cz in changed[rx, rz]:
+                        box = (cx * csize, cz * csize, (cx + 1) * csize, (cz + 1) * csize)
+                        bx, bz = (rx * world.RSIZE + cx) * csize - w, (rz * world.RSIZE + cz) * csize - n
+                        if rimage is None:
+                            self.image.paste((0, 0, 0, 0), (bx, bz, bx + csize, bz + csize))
+                        else:
+                            self.image.paste(rimage.crop(box), (bx, bz))
+            self._save()
+
+
+    def redraw_all(self):
+        """Draw the whole map from scratch."""
+        with instrument.operation('draw_map'):
+            self.world.reload()
+            chunklist, self.edges = self.map._get_map_bounds(self.world, self.bcrop)
+            self.image = self.map._generate_map(self.world, self.type, self.bcrop)
+            self._save()
+
+
+    def _save(self):
+        """Save the map image, replacing the old one in a single step so that readers
+        never see a partly written file."""
+        root, ext = os.path.splitext(self.imgpath)
+        temppath = root + '.tmp' + ext
+        with instrument.timer('write'):
+            self.image.save(temppath)
+        os.rename(temppath, self.imgpath)
+        instrument.message('saved image to {0}'.format(self.imgpath))
+
+
+    def _stat_regions(self):
+        """Returns a dict of the modification time and size of each region file, indexed by region coordinates."""
+        stats = {}
+        ext = 'mca' if self.world.anvil else 'mcr'
+        if os.path.isdir(self.regionpath):
+            for filename in os.listdir(self.regionpath):
+                parts = filename.split('.')
+                if len(parts) == 4 and parts[0] == 'r' and parts[3] == ext:
+                    stat = os.stat(os.path.join(self.regionpath, filename))
+                    stats[int(parts[1]), int(parts[2])] = stat.st_mtime, stat.st_size
+        return stats
@@ -6,6 +6,7 @@ import zlib
 
 import numpy
 
+import instrument
 import nbt
 
 
@@ -14,6 +15,8 @@ CSIZE = 16
 SECTIONS = 16
 SECHEIGHT = 16
 CHEIGHT = 128
+ORDERS = ('region', 'zorder', 'backtofront')
+PAYLOADS = ('chunk', 'raw', 'lazy')
 
 
 class World:
@@ -21,13 +24,34 @@ class World:
         self.path = path
         self.name = os.path.basename(path)
         self.regionlist, self.anvil = self._read_region_list(force_region)
-        print '{0}: world type is {1}'.format(self.name, 'Anvil' if self.anvil else 'McRegion')
+        instrument.message('{0}: world type is {1}'.format(self.name, 'Anvil' if self.anvil else 'McRegion'))
 
         self.regions = {}
         for rx, rz in self.get_region_list():
             self.regions[rx, rz] = Region(self.path, (rx, rz), self.anvil)
-            
-            
+
+
+    def reload(self, regions=None):
+        """Re-read the list of region files, and the headers of the given regions (or all of them),
+        in case the world has been modified since it was loaded. Returns a dict of lists of
+        REGIONAL coordinates of chunks that were added, removed or modified, indexed by region
+        coordinates, for each region that has changed."""
+        regionlist, anvil = self._read_region_list(not self.anvil)
+        changed = {}
+        for rx, rz in set(self.regionlist) - regionlist:
+            changed[rx, rz] = self.regions.pop((rx, rz)).get_chunk_list()
+        for rx, rz in regionlist - set(self.regionlist):
+            self.regions[rx, rz] = Region(self.path, (rx, rz), self.anvil)
+            changed[rx, rz] = self.regions[rx, rz].get_chunk_list()
+        for rx, rz in regionlist & set(self.regionlist) if regions is None else regionlist & set(regions):
+            if (rx, rz) not in changed:
+                chunks = self.regions[rx, rz].reload()
+                if chunks:
+                    changed[rx, rz] = chunks
+        self.regionlist = regionlist
+        return changed
+
+
     def get_chunk_list(self, whitelist=None):
         """Returns a list of global coordinates of all existing chunks,
         within an optional whitelist of global chunk coordinates."""
@@ -48,8 +72,8 @@ class World:
         if whitelist is None:
             return self.regionlist
         else:
-            return set((rx, rz) for rx, rz in self.regionlist
-                       if (rx, rz) in set((cx / RSIZE, cz / RSIZE) for (cx, cz) in whitelist))
+            regions = set((cx / RSIZE, cz / RSIZE) for (cx, cz) in whitelist)
+            return set((rx, rz) for rx, rz in self.regionlist if (rx, rz) in regions)
         
         
     def get_chunk(self, (cx, cz), raw=False):
@@ -59,10 +83,22 @@ class World:
     
     def get_chunks(self, whitelist=None, raw=False):
         """Returns a dict of all existing chunks, indexed by global chunk coordinates,
-        within an optional whitelist of global chunk coordinates."""
-        return {(rx * RSIZE + cx, rz * RSIZE + cz): chunk
-                for (rx, rz), region in self.regions.iteritems()
-                    for (cx, cz), chunk in region.read_chunks(whitelist, raw).iteritems()}
+        within an optional whitelist of global chunk coordinates.
+        Every chunk is held in memory at once, so use iter_chunks for large areas."""
+        return dict(self.iter_chunks(whitelist, payload='raw' if raw else 'chunk'))
+    
+    
+    def iter_chunks(self, whitelist=None, rect=None, since=None, order='region', rotate=0, payload='chunk', window=256):
+        """Yields (coords, chunk) pairs for existing chunks, with GLOBAL chunk coordinates, one region at a time.
+        Regions are visited in the same order as the chunks within each of them; takes the same filters,
+        payloads and window as Region.iter_chunks, so memory use doesn't depend on the size of the world."""
+        regions = self.get_region_list(whitelist)
+        if rect is not None:
+            w, e, n, s = rect
+            regions = [(rx, rz) for rx, rz in regions if w / RSIZE <= rx <= e / RSIZE and n / RSIZE <= rz <= s / RSIZE]
+        for rx, rz in _order_coords(regions, order, rotate):
+            for (cx, cz), chunk in self.regions[rx, rz].iter_chunks(whitelist, rect, since, order, rotate, payload, window):
+                yield (rx * RSIZE + cx, rz * RSIZE + cz), chunk
     
     
     def get_region_chunks(self, (rx, rz), whitelist=None, raw=False):
@@ -86,7 +122,7 @@ class World:
         """Returns a list of players along with their current coordinates."""
         ppath = os.path.join(self.path, 'players')
         if not os.path.isdir(ppath):
-            print 'Not a multiplayer world!'
+            instrument.warning('Not a multiplayer world!')
             
         else:
             players = {}
@@ -112,7 +148,7 @@ class World:
         regionlist = set()
         regionpath = os.path.join(self.path, 'region')
         if not os.path.isdir(regionpath):
-            print "Dir doesn't exist!"
+            instrument.warning("Dir doesn't exist!")
             
         else:
             for filename in os.listdir(regionpath):
@@ -128,12 +164,36 @@ class World:
     
 class Region:
     def __init__(self, worldpath, (rx, rz), anvil=True):
+        self.worldpath = worldpath
         self.path = os.path.join(worldpath, 'region', 'r.{0}.{1}.{2}'.format(rx, rz, 'mca' if anvil else 'mcr'))
         self.coords = rx, rz
         self.chunkinfo = self._read_chunk_info()
         self.anvil = anvil
         
         
+    def reload(self):
+        """Re-read the region header, in case the file has been modified since it was loaded.
+        Returns a list of REGIONAL coordinates of chunks that were added, removed or modified."""
+        oldmtimes = self.get_mtimes()
+        self.chunkinfo = self._read_chunk_info()
+        newmtimes = self.get_mtimes()
+        return [(cx, cz) for cx, cz in set(oldmtimes) | set(newmtimes)
+                if oldmtimes.get((cx, cz)) != newmtimes.get((cx, cz))]
+        
+        
+    def get_mtimes(self):
+        """Returns a dict of the header modification times of all chunks in the region,
+        indexed by REGIONAL chunk coordinates."""
+        return {(cx, cz): info['mtime'] for (cx, cz), info in self.chunkinfo.iteritems()}
+        
+        
+    def get_mtime_table(self):
+        """Returns a (z, x) array of the header modification times of all chunks in the region,
+        with -1 where there is no chunk."""
+        return numpy.array([self.chunkinfo[cx, cz]['mtime'] if (cx, cz) in self.chunkinfo else -1
+                            for cz in range(RSIZE) for cx in range(RSIZE)]).reshape((RSIZE, RSIZE))
+        
+        
     def get_chunk_list(self, whitelist=None):
         """Returns a list of REGIONAL chunk coordinates existing in the region file,
         within an optional whitelist of GLOBAL chunk coordinates."""
@@ -148,26 +208,61 @@ class Region:
     def read_chunks(self, whitelist=None, raw=False):
         """Returns a dict of all chunks in the region, indexed by REGIONAL chunk coordinates,
         within an optional whitelist of GLOBAL chunk coordinates."""
-        chunklist = self.get_chunk_list(whitelist)
+        return dict(self.iter_chunks(whitelist, payload='raw' if raw else 'chunk', window=RSIZE * RSIZE))
+    
+    
+    def iter_chunks(self, whitelist=None, rect=None, since=None, order='region', rotate=0, payload='chunk', window=256):
+        """Yields (coords, chunk) pairs for chunks in the region, with REGIONAL chunk coordinates.
+        Chunks can be filtered by a whitelist of GLOBAL chunk coordinates, an inclusive rectangle (w, e, n, s)
+        of GLOBAL chunk coordinates, and a header mtime that they must be newer than. Order is 'region'
+        (rows from north to south), 'zorder' (along a Z-order curve, keeping neighbours together) or 'backtofront'
+        (for drawing an oblique map at the given rotation). Payloads are decoded chunks ('chunk'), (mtime, data)
+        pairs of compressed data ('raw'), or ChunkRefs that are only read when loaded ('lazy').
+        Chunks are read a window at a time, in the order they are stored in the file,
+        so at most window chunks are held in memory at once."""
+        if payload not in PAYLOADS:
+            raise ValueError('unknown payload {0}; must be one of {1}'.format(payload, ', '.join(PAYLOADS)))
+        rx, rz = self.coords
+        chunklist = [(cx, cz) for cx, cz in self.get_chunk_list(whitelist)
+                     if (rect is None or rect[0] <= rx * RSIZE + cx <= rect[1] and rect[2] <= rz * RSIZE + cz <= rect[3])
+                     and (since is None or self.chunkinfo[cx, cz]['mtime'] > since)]
+        chunklist = _order_coords(chunklist, order, rotate)
+        if payload == 'lazy':
+            for cx, cz in chunklist:
+                yield (cx, cz), ChunkRef(self, (cx, cz))
+            return
         if not chunklist or not os.path.exists(self.path):
-            return {}
+            return
         
-        print 'reading', self.path
-        with open(self.path, 'rb') as rfile:
-            return {(cx, cz): self._read_chunk((cx, cz), rfile, raw)
-                    for cz in range(RSIZE) for cx in range(RSIZE) if (cx, cz) in chunklist}
+        instrument.message('reading {0}'.format(self.path))
+        for start in range(0, len(chunklist), window):
+            batch = chunklist[start:start + window]
+            chunks = {}
+            with open(self.path, 'rb') as rfile:
+                for cx, cz in sorted(batch, key=lambda coords: self.chunkinfo[coords]['sectornum']):
+                    chunks[cx, cz] = self._read_chunk((cx, cz), rfile, payload == 'raw')
+            instrument.progress('read_chunks', start + len(batch), len(chunklist), region=self.coords)
+            for cx, cz in batch:
+                yield (cx, cz), chunks.pop((cx, cz))
         
         
-    def save(self, newchunks={}):
+    def save(self, newchunks={}, removed=()):
+        """Rewrite the region file with new chunks, given as (mtime, data) pairs of compressed data indexed by
+        REGIONAL chunk coordinates, in place of or as well as the chunks already in it, and without any chunks
+        in an optional list of REGIONAL coordinates to remove."""
+        for cx, cz in removed:
+            self.chunkinfo.pop((cx, cz), None)
         oldchunks = self.read_chunks(raw=True)
 
         if not os.path.exists(os.path.dirname(self.path)):
             os.makedirs(os.path.dirname(self.path))
             
-        print 'chunks to save in region {0}: {1} old, {2} new, {3} replaced'.format(
-            self.coords, len(oldchunks), len(newchunks), len(set((cx, cz) for cx, cz in oldchunks if (cx, cz) in newchunks)))
+        instrument.message('chunks to save in region {0}: {1} old, {2} new, {3} replaced, {4} removed'.format(
+            self.coords, len(oldchunks), len(newchunks), len(set((cx, cz) for cx, cz in oldchunks if (cx, cz) in newchunks)),
+            len(removed)))
         
-        with open(self.path, 'wb') as rfile:
+        with instrument.timer('save'), open(self.path, 'wb') as rfile:
+            rfile.write('\0' * 8192) # empty header, so that the file is valid even without any chunks
             sectornum = 2
             version = 2
             for cz in range(RSIZE):
@@ -206,8 +301,7 @@ class Region:
                     
                     sectornum += sectorlength
                     
-        print 'saved to', self.path
-        print
+        instrument.message('saved to {0}'.format(self.path))
 
 
     def _read_chunk_info(self):
@@ -239,25 +333,50 @@ class Region:
         #print '{0}: reading chunk at sector {1} ({2}),'.format(
         #    (cx, cz), self.chunkinfo[cx, cz]['sectornum'], hex(self.chunkinfo[cx, cz]['sectornum'] * 4096)),
             
-        rfile.seek(self.chunkinfo[cx, cz]['sectornum'] * 4096)
-        length, version = struct.unpack('>ib', rfile.read(5))
-        #print 'stated length {0},'.format(hex(length)),
+        with instrument.timer('read'):
+            rfile.seek(self.chunkinfo[cx, cz]['sectornum'] * 4096)
+            length, version = struct.unpack('>ib', rfile.read(5))
+            #print 'stated length {0},'.format(hex(length)),
 
-        # use ONE of the following two lines:
-        data = rfile.read(length - 1) # this trusts that the length field is correct
-        #data = rfile.read(self.chunkinfo[(cx, cz)]['sectorlength'] * 4096 - 5).rstrip('\x00') # this does not trust the length field
-        #print 'data length {0} bytes'.format(len(data))
+            # use ONE of the following two lines:
+            data = rfile.read(length - 1) # this trusts that the length field is correct
+            #data = rfile.read(self.chunkinfo[(cx, cz)]['sectorlength'] * 4096 - 5).rstrip('\x00') # this does not trust the length field
+            #print 'data length {0} bytes'.format(len(data))
+        instrument.count('bytes_read', len(data) + 5)
 
         if version == 2:
             if raw:
                 return self.chunkinfo[cx, cz]['mtime'], data
             else:
                 try:
-                    return AnvilChunk(zlib.decompress(data)) if self.anvil else Chunk(zlib.decompress(data))
+                    with instrument.timer('decompress'):
+                        data = zlib.decompress(data)
                 except zlib.error as error:
-                    print '\nzlib error with chunk {0}: {1}\n'.format((cx, cz), error)
+                    instrument.warning('zlib error with chunk {0}: {1}'.format((cx, cz), error))
+                    return
+                with instrument.timer('parse'):
+                    chunk = AnvilChunk(data) if self.anvil else Chunk(data)
+                instrument.count('chunks_decoded')
+                return chunk
         else:
-            print 'chunk {0}: wrong version {1} at offset {2}'.format((cx, cz), version, hex(self.chunkinfo[cx, cz]['sectornum'] * 4096))
+            instrument.warning('chunk {0}: wrong version {1} at offset {2}'.format(
+                (cx, cz), version, hex(self.chunkinfo[cx, cz]['sectornum'] * 4096)))
+        
+        
+
+class ChunkRef:
+    """A chunk in a region file that has not been read yet. Its header mtime is known,
+    but its data is only read when loaded, so large areas can be filtered and sorted cheaply."""
+    def __init__(self, region, (cx, cz)):
+        self.region = region
+        self.coords = cx, cz
+        self.mtime = region.chunkinfo[cx, cz]['mtime']
+        
+        
+    def load(self, raw=False):
+        """Read the chunk, decoded or as an (mtime, data) pair of compressed data if raw is specified."""
+        with open(self.region.path, 'rb') as rfile:
+            return self.region._read_chunk(self.coords, rfile, raw)
         
         
 
@@ -274,11 +393,15 @@ class Chunk:
                 return tag[2]
     
     
-    def get_data(self, type='block'):
+    def get_data(self, type='block', ylimits=None):
+        """Returns an array of data of the given type. Block data may be limited
+        to an inclusive (bottom, top) range of heights; blocks outside it are returned as air."""
         if type == 'heightmap':
             return self._get_heightmap()
+        elif type == 'blockdata':
+            return _clear_outside(self._get_block_data(), ylimits)
         else:
-            return self._get_blocks()
+            return _clear_outside(self._get_blocks(), ylimits)
         
         
     def _get_heightmap(self):
@@ -291,26 +414,27 @@ class Chunk:
     
     def _get_blocks(self):
         bdata = self.find_tag('Blocks')
-        blocks = numpy.zeros((CSIZE, CSIZE, self.cheight), numpy.uint16) # x, z, y
-        for x in range(CSIZE):
-            for z in range(CSIZE):
-                colstart = x * self.cheight * CSIZE + z * self.cheight
-                blocks[x, z, :] = bdata[colstart:colstart + self.cheight]
-        return blocks
+        # blocks are stored in XZY order
+        return numpy.array(bdata, numpy.uint16).reshape((CSIZE, CSIZE, self.cheight)) # x, z, y
+    
+    
+    def get_light(self, ys):
+        """Returns arrays of the sky light and block light values at a single height in each column,
+        given an (x, z) array of heights. Heights above the top of the chunk are fully sky-lit."""
+        xs, zs = numpy.indices((CSIZE, CSIZE))
+        inside = ys < self.cheight
+        index = (xs * CSIZE * self.cheight + zs * self.cheight + numpy.minimum(ys, self.cheight - 1))[inside]
+        sky = numpy.zeros((CSIZE, CSIZE), numpy.ubyte) + 15
+        block = numpy.zeros((CSIZE, CSIZE), numpy.ubyte)
+        for array, tagname in (sky, 'SkyLight'), (block, 'BlockLight'):
+            array[inside] = _get_nibbles(self.find_tag(tagname), index)
+        return sky, block
 
 
     def _get_block_data(self):
-        ddata = self.find_tag('Data')
-        data = []
-        for x in range(CSIZE):
-            data.append([])
-            for z in range(CSIZE):
-                data[x].append([])
-                for y in range(self.cheight):
-                    byte = ddata[x * self.cheight * CSIZE + z * self.cheight + y]
-                    # block data is stored as 4 bits per block, so we have to break each byte in half
-                    data[x][z].append(byte % 16 if y % 2 else byte / 16)
-        return data
+        # block data is stored in XZY order, as 4 bits per block
+        return _get_nibbles(self.find_tag('Data'), numpy.arange(CSIZE * CSIZE * self.cheight)).astype(numpy.uint16).reshape(
+            (CSIZE, CSIZE, self.cheight)) # x, z, y
 
         
 
@@ -324,19 +448,22 @@ class AnvilChunk(Chunk):
         return nbt.NBTWriter().to_string(tags)
 
     
-    def get_data(self, type='block', coords=None):
+    def get_data(self, type='block', coords=None, ylimits=None):
+        """Returns an array of data of the given type. Per-block data may be limited
+        to an inclusive (bottom, top) range of heights, in which case only the sections
+        overlapping that range are decoded, and everything outside it is returned as zero."""
         if type == 'heightmap':
             data = self._get_chunk_array('HeightMap')
         elif type == 'biome':
             data = self._get_chunk_array('Biomes')
         elif type == 'blocklight':
-            data = self._get_block_array('BlockLight', 4)
+            data = self._get_block_array('BlockLight', 4, ylimits)
         elif type == 'skylight':
-            data = self._get_block_array('SkyLight', 4)
+            data = self._get_block_array('SkyLight', 4, ylimits)
         elif type == 'blockdata':
-            data = self._get_block_array('Data', 4)
+            data = self._get_block_array('Data', 4, ylimits)
         else:
-            data = self._get_blocks()
+            data = self._get_blocks(ylimits)
             
         return data[coords] if coords else data
     
@@ -349,32 +476,82 @@ class AnvilChunk(Chunk):
         return array
         
         
-    def _get_block_array(self, tagname, bits=8):
+    def _get_block_array(self, tagname, bits=8, ylimits=None):
         array = numpy.zeros((CSIZE, CSIZE, SECHEIGHT * SECTIONS), numpy.uint16) # x, z, y
-        sections = {}
-        for section in (tag[2] for tag in self.find_tag('Sections')):
-            sections[self.find_tag('Y', section)] = self.find_tag(tagname, section)
-        for x in range(CSIZE):
-            for z in range(CSIZE):
-                for s, section in sections.items():
-                    sy = s * SECHEIGHT
-                    start = CSIZE * z + x
-                    # get a Y column from data stored in YZX order
-                    if bits == 8:
-                        section_y = section[start:start + SECHEIGHT * CSIZE * CSIZE:CSIZE * CSIZE]
-                    if bits == 4:
-                        section_y = []
-                        for y in range(SECHEIGHT):
-                            byte = section[start + y / 2 * CSIZE * CSIZE]
-                            #if byte != 0:
-                            #    print bin(byte)
-                            section_y.append(byte % 16 if y % 2 else byte / 16)
-                    array[x, z, sy:sy + SECHEIGHT] = section_y
-        return array
+        bottom, top = ylimits or (0, SECHEIGHT * SECTIONS - 1)
+        for s, section in self._get_sections().iteritems():
+            if not bottom / SECHEIGHT <= s <= top / SECHEIGHT:
+                continue
+            data = numpy.array(self.find_tag(tagname, section), numpy.ubyte)
+            if bits == 4:
+                # 4-bit values are packed two to a byte, the first in the low bits
+                data = numpy.dstack((data & 15, data >> 4)).flatten()
+            # sections are stored in YZX order
+            array[:, :, s * SECHEIGHT:(s + 1) * SECHEIGHT] = data.reshape((SECHEIGHT, CSIZE, CSIZE)).transpose(2, 1, 0)
+        return _clear_outside(array, ylimits)
+    
+    
+    def get_light(self, ys):
+        """Returns arrays of the sky light and block light values at a single height in each column,
+        given an (x, z) array of heights. Only the sections containing those heights are read;
+        heights above the top of the chunk, or in missing sections, are fully sky-lit."""
+        xs, zs = numpy.indices((CSIZE, CSIZE))
+        sky = numpy.zeros((CSIZE, CSIZE), numpy.ubyte) + 15
+        block = numpy.zeros((CSIZE, CSIZE), numpy.ubyte)
+        sections = self._get_sections()
+        for s in set(numpy.unique(ys / SECHEIGHT)) & set(sections):
+            inside = ys / SECHEIGHT == s
+            index = (((ys % SECHEIGHT) * CSIZE + zs) * CSIZE + xs)[inside]
+            for array, tagname in (sky, 'SkyLight'), (block, 'BlockLight'):
+                array[inside] = _get_nibbles(self.find_tag(tagname, sections[s]), index)
+        return sky, block
+    
+    
+    def _get_sections(self):
+        """Returns a dict of the tags of each section in this chunk, indexed by section Y."""
+        return {self.find_tag('Y', section): section for section in (tag[2] for tag in self.find_tag('Sections'))}
             
 
-    def _get_blocks(self):
+    def _get_blocks(self, ylimits=None):
         # still have to implement the extra data layer in the anvil format
-        return self._get_block_array('Blocks')
+        return self._get_block_array('Blocks', ylimits=ylimits)
+
+
+
+def _order_coords(coords, order='region', rotate=0):
+    """Sort a list of (x, z) coordinates in one of the ORDERS: by rows from north to south,
+    along a Z-order curve, or from back to front for an oblique map at the given rotation."""
+    if order == 'region':
+        return sorted(coords, key=lambda (x, z): (z, x))
+    elif order == 'zorder':
+        xmin, zmin = min([0] + [x for x, z in coords]), min([0] + [z for x, z in coords])
+        return sorted(coords, key=lambda (x, z): _interleave_bits(x - xmin, z - zmin))
+    elif order == 'backtofront':
+        return sorted(coords, key=lambda (x, z): (x if rotate in (0, 1) else -x, z if rotate in (0, 3) else -z))
+    raise ValueError('unknown order {0}; must be one of {1}'.format(order, ', '.join(ORDERS)))
+
+
+def _interleave_bits(x, z):
+    """Returns the position of non-negative (x, z) along a Z-order curve, by interleaving their bits."""
+    key = 0
+    bit = 0
+    while x >> bit or z >> bit:
+        key |= ((x >> bit) & 1) << (2 * bit) | ((z >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return key
+
+
+def _get_nibbles(data, index):
+    """Get 4-bit values at the given indices from an array of bytes, where values are
+    packed two to a byte, the first in the low bits."""
+    data = numpy.array(data, numpy.ubyte)[index / 2]
+    return numpy.where(index % 2, data >> 4, data & 15)
 
 
+def _clear_outside(array, ylimits=None):
+    """Zero everything in an (x, z, y) array outside an inclusive (bottom, top) range of heights."""
+    if ylimits is not None:
+        bottom, top = ylimits
+        array[:, :, :max(bottom, 0)] = 0
+        array[:, :, top + 1:] = 0
+    return array
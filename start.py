@@ -1,7 +1,17 @@
 import argparse
 
+from minebash import cache
+from minebash import convert
+from minebash import diff
+from minebash import entities
+from minebash import export
+from minebash import instrument
 from minebash import obliquemap
 from minebash import orthomap
+from minebash import overviewmap
+from minebash import snapshot
+from minebash import trim
+from minebash import watch
 from minebash import world
 
 if __name__ == '__main__':
@@ -10,8 +20,153 @@ if __name__ == '__main__':
     argp.add_argument('--colours', '-c')
     argp.add_argument('--biomes', '-b')
     argp.add_argument('--output', '-o')
-    argp.add_argument('--type', '-t')
+    argp.add_argument('--type', '-t', default='block',
+                      help="block, heightmap, biome or light; or presence or age for a map of chunks from region headers")
+    argp.add_argument('--light', '-l', metavar='SKYLIGHT', choices=['day', 'night'] + [str(level) for level in range(16)],
+                      help="shade blocks by light level, with the sky light at 'day', 'night' or a level from 0 to 15")
+    argp.add_argument('--slice', metavar='BOTTOM:TOP',
+                      help='draw only blocks within a range of heights')
+    argp.add_argument('--cave', action='store_true',
+                      help='cut away the topmost solid layer of each column, e.g. the nether ceiling')
+    argp.add_argument('--overview', type=int, metavar='SCALE', choices=(1, 2, 4, 8, 16),
+                      help='draw a low-resolution overview, with one pixel per SCALE x SCALE blocks')
+    argp.add_argument('--stream', '-s', action='store_true',
+                      help='write the map one row of regions at a time, to limit memory use')
+    argp.add_argument('--workers', '-j', type=int, default=1,
+                      help='number of processes to render regions with (0 for one per CPU)')
+    argp.add_argument('--cache', nargs='?', const='cache',
+                      help='cache region images in a directory, and redraw only modified chunks')
+    argp.add_argument('--cache-size', type=int, default=1024,
+                      help='maximum size of the cache in megabytes')
+    argp.add_argument('--watch', action='store_true',
+                      help='keep running, and redraw chunks in the map as the world is modified')
+    argp.add_argument('--interval', type=float, default=2,
+                      help='seconds between checks for modified region files when watching')
+    argp.add_argument('--debounce', type=float, default=1,
+                      help='seconds to wait for modifications to stop before redrawing when watching')
+    argp.add_argument('--min-period', type=float, default=10,
+                      help='minimum seconds between redraws when watching')
+    argp.add_argument('--diff', metavar='OLDWORLD',
+                      help='list the chunks that differ from an older copy of the world, and draw a change map to the output if given')
+    argp.add_argument('--diff-blocks', action='store_true',
+                      help='with --diff, also decode changed chunks and count the blocks that differ')
+    argp.add_argument('--snapshot', metavar='STORE',
+                      help='save a snapshot of the world in a snapshot store, storing only chunks modified since the last one')
+    argp.add_argument('--name', help='name of the snapshot to save, instead of the current time')
+    argp.add_argument('--restore', nargs='?', const='', metavar='NAME',
+                      help='with --snapshot, restore the world from a snapshot in the store (by default the latest)')
+    argp.add_argument('--export', metavar='DIR',
+                      help='export block data as memory-mappable .npy arrays per region, rewriting only modified chunks')
+    argp.add_argument('--export-types', default='block,blockdata,biome,heightmap',
+                      help='comma-separated types of data to export: ' + ', '.join(sorted(export.EXPORT_TYPES)))
+    argp.add_argument('--rect', metavar='W:E:N:S',
+                      help='with --export or --entities, only include chunks within an inclusive rectangle of chunk coordinates; '
+                      'with --trim, keep them')
+    argp.add_argument('--trim', action='store_true',
+                      help='delete chunks that match all the trimming rules given by --older-than, --rect and --natural-only')
+    argp.add_argument('--older-than', type=float, metavar='DAYS',
+                      help='with --trim, trim only chunks last saved more than DAYS ago')
+    argp.add_argument('--natural-only', action='store_true',
+                      help='with --trim, trim only chunks containing nothing but naturally generated blocks')
+    argp.add_argument('--dry-run', action='store_true',
+                      help='with --trim, list the chunks that would be trimmed without deleting them')
+    argp.add_argument('--convert', metavar='DEST',
+                      help='convert a McRegion world to Anvil, writing it to DEST (which may be the world itself)')
+    argp.add_argument('--entities', metavar='DIR',
+                      help='update an index of entities and tile entities in DIR, then list those matching --find, '
+                      '--rect and --slice, and draw them on a map to the output if given')
+    argp.add_argument('--find', metavar='IDS',
+                      help="with --entities, comma-separated entity IDs to find, e.g. 'Chest,MobSpawner'")
+    argp.add_argument('--quiet', '-q', action='store_true', help="don't print progress messages")
+    argp.add_argument('--stats', action='store_true', help='print a summary of timings and counters when done')
+    argp.add_argument('--stats-json', metavar='PATH', help='write timings and counters to a JSON file')
     
     args = argp.parse_args()
+    if args.watch and args.stream:
+        argp.error('--watch keeps the whole map in memory, and cannot be used with --stream')
     
-    orthomap.OrthoMap(world.World(args.world), args.colours, args.biomes).draw_map(args.output, args.type)
+    if not args.quiet:
+        instrument.add_sink(instrument.PrintSink())
+    summary = instrument.add_sink(instrument.TextSummary()) if args.stats else None
+    exporter = instrument.add_sink(instrument.JSONExporter()) if args.stats_json else None
+    
+    wld = world.World(args.world)
+    if args.diff:
+        wdiff = diff.WorldDiff(world.World(args.diff), wld).set_workers(args.workers).compare()
+        if args.diff_blocks:
+            wdiff.compare_blocks()
+        print wdiff.report()
+        if args.output:
+            wdiff.draw_map(args.output)
+    elif args.export:
+        exp = export.ArrayExport(args.export).set_types(args.export_types.split(',')).set_workers(args.workers)
+        if args.slice:
+            exp.set_slice(tuple(int(y) for y in args.slice.split(':')))
+        if args.rect:
+            exp.set_rect(tuple(int(c) for c in args.rect.split(':')))
+        exp.export(wld)
+    elif args.trim:
+        trimmer = trim.Trimmer(wld).set_age(args.older_than).set_workers(args.workers)
+        if args.rect:
+            trimmer.set_rect(tuple(int(c) for c in args.rect.split(':')))
+        if args.natural_only:
+            trimmer.set_natural()
+        try:
+            print trimmer.trim(args.dry_run).report()
+        except ValueError as e:
+            argp.error(str(e))
+    elif args.convert:
+        try:
+            convert.WorldConverter(wld, args.convert).set_workers(args.workers).convert()
+        except ValueError as e:
+            argp.error(str(e))
+    elif args.entities:
+        index = entities.EntityIndex(args.entities).set_workers(args.workers).update(wld)
+        box = None
+        if args.rect:
+            w, e, n, s = (int(c) for c in args.rect.split(':'))
+            box = w * world.CSIZE, (e + 1) * world.CSIZE - 1, n * world.CSIZE, (s + 1) * world.CSIZE - 1
+        found = index.query(args.find.split(',') if args.find else None, box,
+                            tuple(int(y) for y in args.slice.split(':')) if args.slice else None)
+        for entity in found:
+            fields = u', '.join(u'{0}={1}'.format(key, value) for key, value in sorted(entity.iteritems())
+                               if key not in ('kind', 'id', 'x', 'y', 'z'))
+            print u'{0} ({1}) at {2}, {3}, {4}{5}'.format(entity['id'], entity['kind'], entity['x'], entity['y'], entity['z'],
+                                                         ': ' + fields if fields else '').encode('utf-8')
+        if args.output:
+            orthomap.OrthoMap(wld, args.colours, args.biomes).set_workers(args.workers).draw_markers(
+                wld, args.output, [(entity['x'], entity['z']) for entity in found if entity['x'] is not None])
+    elif args.snapshot:
+        store = snapshot.SnapshotStore(args.snapshot)
+        if args.restore is None:
+            store.take(wld, args.name)
+        elif args.restore or store.get_snapshots():
+            store.restore(args.restore or store.get_snapshots()[-1], wld)
+        else:
+            argp.error('there are no snapshots in {0} to restore'.format(args.snapshot))
+    else:
+        if args.overview:
+            mapobj = overviewmap.OverviewMap(wld, args.colours, args.biomes).set_scale(args.overview)
+        else:
+            mapobj = orthomap.OrthoMap(wld, args.colours, args.biomes)
+        mapobj.set_workers(args.workers)
+        if args.light:
+            mapobj.set_lighting(int(args.light) if args.light.isdigit() else args.light)
+        if args.slice or args.cave:
+            mapobj.set_slice(tuple(int(y) for y in args.slice.split(':')) if args.slice else None, args.cave)
+        if args.cache:
+            mapobj.set_cache(cache.RegionCache(args.cache, args.cache_size << 20))
+        if args.type in ('presence', 'age'):
+            mapobj.draw_chunk_map(wld, args.output, args.type)
+        elif args.watch:
+            try:
+                watch.Watcher(mapobj, wld, args.output, args.type).run(args.interval, args.debounce, args.min_period)
+            except KeyboardInterrupt:
+                pass
+        else:
+            mapobj.draw_map(wld, args.output, args.type, stream=args.stream)
+    
+    if summary:
+        print summary.text()
+    if exporter:
+        exporter.export(args.stats_json)